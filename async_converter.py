@@ -0,0 +1,172 @@
+import asyncio
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, AsyncIterator, Callable, Dict, Optional, TextIO, Tuple, Union
+
+from converter import ConversionCancelled, MODE_LATEX_TO_UNIMATH, WRAP_KEEP, convert
+from latex_to_unicodemath import latex_to_unicodemath
+from markdown_to_latex import Formula, FormulaList, extract_all_formulas, iter_formulas, validate_latex
+
+# end-of-stream marker put on the queue by the extraction thread
+_DONE = object()
+
+
+class _Failure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class AsyncConverter:
+    """asyncio 应用中使用的转换接口
+
+    所有转换都在有界线程池中执行，不阻塞事件循环；同时执行的任务不超过
+    max_concurrency 个，超出的调用在 await 处排队等待（背压）。
+    await 中的任务被取消时，尚未开始的转换直接丢弃，convert() 和
+    iter_formulas() 在下一个检查点停止；单个公式的转换无法中途打断，
+    但它占用的并发名额会一直保留到线程真正结束，不会超出上限。
+
+        async with AsyncConverter(max_concurrency=4) as converter:
+            output = await converter.latex_to_unicodemath("\\frac{a}{b}")
+            async for formula in converter.iter_formulas(document, convert=True):
+                ...
+    """
+
+    def __init__(self, max_concurrency: int = 4, queue_size: int = 64,
+                 chunk_size: int = 1 << 16) -> None:
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency 必须为正数")
+        if queue_size <= 0:
+            raise ValueError("queue_size 必须为正数")
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                            thread_name_prefix="formula-convert")
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self) -> "AsyncConverter":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """丢弃排队中的任务并关闭线程池，正在执行的转换会自然结束"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _submit(self, func: Callable[..., Any], *args: Any) -> "Future[Any]":
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        def release(_: "Future[Any]") -> None:
+            try:
+                loop.call_soon_threadsafe(self._slots.release)
+            except RuntimeError:
+                pass  # the event loop is already closed
+
+        # the slot is held until the thread finishes, even if the caller gave up
+        future.add_done_callback(release)
+        return future
+
+    async def _run(self, func: Callable[..., Any], *args: Any,
+                   cancel: Optional[threading.Event] = None) -> Any:
+        future = await self._submit(func, *args)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            if cancel is not None:
+                cancel.set()
+            raise
+
+    async def latex_to_unicodemath(self, latex: str) -> str:
+        """异步版 latex_to_unicodemath"""
+        return await self._run(latex_to_unicodemath, latex)
+
+    async def validate_latex(self, latex: str) -> Tuple[bool, str]:
+        """异步版 validate_latex"""
+        return await self._run(validate_latex, latex)
+
+    async def extract_all_formulas(self, markdown_text: str) -> FormulaList:
+        """异步版 extract_all_formulas"""
+        return await self._run(extract_all_formulas, markdown_text)
+
+    async def convert(self, text: str, mode: str = MODE_LATEX_TO_UNIMATH,
+                      wrap: str = WRAP_KEEP) -> str:
+        """异步版 converter.convert；任务取消后在下一个进度检查点中止"""
+        cancel = threading.Event()
+
+        def progress(percent: int, stage: str) -> None:
+            if cancel.is_set():
+                raise ConversionCancelled()
+
+        return await self._run(convert, text, mode, wrap, progress, cancel=cancel)
+
+    async def iter_formulas(self, source: Union[str, TextIO],
+                            convert: bool = False) -> AsyncIterator[Union[Formula, Dict[str, Any]]]:
+        """逐个异步产出 source（文本或文件类对象）中的公式
+
+        产出的记录与 markdown_to_latex.iter_formulas 相同；convert 为 True 时
+        改为产出 to_dict() 字典，另含 'output' 转换结果。提取在线程中分块进行，结果经容量为 queue_size
+        的队列交给调用方：队列满时提取线程暂停（背压）；提前退出循环或取消任务时
+        提取线程在处理下一个公式前停止。提取线程是每个流单独的线程，不占用
+        max_concurrency 名额，循环体中可以继续 await 本对象的其他转换。
+        """
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Any]" = asyncio.Queue(self.queue_size)
+        stop = threading.Event()
+        stream = io.StringIO(source) if isinstance(source, str) else source
+
+        def put(item: Any) -> None:
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            # wake up now and then, so a consumer that went away cannot strand this thread
+            while True:
+                try:
+                    return future.result(timeout=0.1)
+                except FutureTimeout:
+                    if stop.is_set() or loop.is_closed():
+                        future.cancel()
+                        return
+
+        def produce() -> None:
+            try:
+                for formula in iter_formulas(stream, self.chunk_size):
+                    if stop.is_set():
+                        return
+                    if convert:
+                        output = latex_to_unicodemath(formula.content)
+                        formula = formula.to_dict()
+                        formula['output'] = output
+                    put(formula)
+            except Exception as e:
+                if not stop.is_set():
+                    put(_Failure(e))
+                return
+            if not stop.is_set():
+                put(_DONE)
+
+        # not run through _submit: the producer spends most of its life blocked on
+        # the queue, and holding a slot meanwhile would starve a consumer that
+        # awaits further conversions inside the loop
+        threading.Thread(target=produce, name="formula-stream", daemon=True).start()
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            # unblock a producer waiting on a full queue so it sees the stop flag
+            while not queue.empty():
+                queue.get_nowait()
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+公式转换工具性能测试脚本
+用于对比公式提取等环节在大文档上的耗时，以及可重复的基准测试套件：
+
+    python benchmark.py                                  # 对比演示
+    python benchmark.py suite -o baseline.json           # 运行套件并保存结果
+    python benchmark.py suite -o new.json --compare baseline.json --threshold 0.1
+    python benchmark.py compare baseline.json new.json   # 比较两次结果，退化超过阈值时退出码为 1
+    python benchmark.py profile notes/*.md                # 统计各转换阶段的耗时（省略文件时用合成语料）
+    python benchmark.py startup                           # 各模块的导入耗时和单次转换的冷启动耗时
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import chain
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from conversion_profile import disable_profiling, enable_profiling
+from converter import md_doc_to_unimath
+from latex_to_unicodemath import latex_to_unicodemath
+from markdown_to_latex import (
+    DISPLAY_PATTERN,
+    FENCED_MATH_PATTERN,
+    INLINE_PATTERN,
+    extract_all_formulas,
+    extract_first_formula_latex,
+    map_formulas,
+    normalize_latex_for_word,
+    validate_latex,
+)
+
+
+def make_markdown_document(paragraphs: int, prose_lines: int = 0) -> str:
+    """生成包含行内、展示和围栏公式的 Markdown 文档；prose_lines 为每节额外的纯文字行数"""
+    block = (
+        "## 第 {i} 节\n\n"
+        "设 $x_{i}$ 满足 $\\alpha x^2 + \\beta = 0$，价格为 \\$5，代码 `a = $b$` 不算公式。\n\n"
+        "$$\\lim_{{n \\to \\infty}} \\sum_{{k=1}}^{{n}} \\frac{{1}}{{k^2}} = \\frac{{\\pi^2}}{{6}}$$\n\n"
+        "```math\n\\int_0^1 f(x) dx = F(1) - F(0)\n```\n\n"
+        "普通文字段落，没有公式，只是用来增加文档长度的一些说明文字。\n\n"
+    )
+    prose = "This paragraph is plain prose without any formula, used to pad the section.\n" * prose_lines
+    return "".join(block.format(i=i) + prose for i in range(paragraphs))
+
+
+def three_regex_extract_all_formulas(markdown_text: str) -> List[Dict[str, str]]:
+    """旧实现：三个正则分别扫描全文后排序（会重复报告重叠的公式）"""
+    text = markdown_text.strip()
+    formulas = []
+    for pattern, kind, mode in (
+        (FENCED_MATH_PATTERN, "fenced", "display"),
+        (DISPLAY_PATTERN, "display", "display"),
+        (INLINE_PATTERN, "inline", "inline"),
+    ):
+        for match in pattern.finditer(text):
+            formulas.append({
+                'content': match.group(1).strip(),
+                'type': kind,
+                'display_mode': mode,
+                'start': match.start(),
+                'end': match.end()
+            })
+    formulas.sort(key=lambda x: x['start'])
+    return formulas
+
+
+def convert_all(extract: Callable[[str], List[Dict[str, str]]]) -> Callable[[str], List[str]]:
+    """提取后逐个转换为 UnicodeMath（下游实际要做的工作）"""
+    return lambda text: [latex_to_unicodemath(f['content']) for f in extract(text)]
+
+
+def best_of(func: Callable[[str], object], arg: str, repeat: int = 5) -> float:
+    """多次运行取最短耗时（秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_extraction(paragraphs: int = 5000, prose_lines: int = 0) -> None:
+    doc = make_markdown_document(paragraphs, prose_lines)
+    old_count = len(three_regex_extract_all_formulas(doc))
+    new_count = len(extract_all_formulas(doc))
+    old = best_of(three_regex_extract_all_formulas, doc)
+    new = best_of(extract_all_formulas, doc)
+    print(f"  文档 {len(doc) / 1e6:.1f} M 字符")
+    print(f"  三正则：{old * 1000:8.1f} ms，{old_count} 个结果（含重复）")
+    print(f"  单遍扫描：{new * 1000:8.1f} ms，{new_count} 个结果")
+    print(f"  加速比：{old / new:.2f}x")
+    old = best_of(convert_all(three_regex_extract_all_formulas), doc, repeat=1)
+    new = best_of(convert_all(extract_all_formulas), doc, repeat=1)
+    print(f"  提取并转换：三正则 {old * 1000:.1f} ms，单遍扫描 {new * 1000:.1f} ms，加速比 {old / new:.2f}x")
+
+
+def bench_rewrite(sizes: Tuple[int, ...] = (1000, 4000, 16000)) -> None:
+    for paragraphs in sizes:
+        doc = make_markdown_document(paragraphs, prose_lines=5)
+        seconds = best_of(md_doc_to_unimath, doc, repeat=3)
+        print(f"  {len(doc) / 1e6:5.1f} M 字符：{seconds * 1000:8.1f} ms，"
+              f"{len(doc) / seconds / 1e6:5.1f} M 字符/秒")
+
+
+def peak_memory(func: Callable[[], object]) -> int:
+    """运行 func 期间 Python 分配内存的峰值（字节）"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_mapped_file(paragraphs: int = 2000, prose_lines: int = 20) -> None:
+    doc = make_markdown_document(paragraphs, prose_lines)
+    fd, path = tempfile.mkstemp(suffix=".md")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(doc)
+        del doc
+
+        def read_whole() -> int:
+            with open(path, "r", encoding="utf-8") as f:
+                return sum(1 for _ in extract_all_formulas(f.read()))
+
+        def mapped() -> int:
+            return sum(1 for _ in map_formulas(path))
+
+        print(f"  文件 {os.path.getsize(path) / 1e6:.1f} MB，{mapped()} 个公式")
+        for label, func in (("整体读入", read_whole), ("内存映射", mapped)):
+            seconds = best_of(lambda _: func(), None, repeat=3)
+            peak = peak_memory(func)
+            print(f"  {label}：{seconds * 1000:8.1f} ms，Python 内存峰值 {peak / 1e6:7.1f} MB")
+    finally:
+        os.remove(path)
+
+
+# ---------------------------------------------------------------------------
+# 基准测试套件
+# ---------------------------------------------------------------------------
+
+# 每个语料包含一组 LaTeX 公式（供逐条处理公式的函数使用）和一组 Markdown 文档
+# （供提取函数使用）；规模由 scale 线性放大，内容完全确定，便于前后对比
+Corpus = Tuple[List[str], List[str]]
+
+_SYMBOLS = ("\\alpha", "\\beta", "\\gamma", "\\leq", "\\infty", "\\partial", "\\nabla",
+            "\\times", "\\cdot", "\\pm", "\\in", "\\subseteq", "\\rightarrow", "\\sum", "\\int")
+
+
+def _deep_formula(depth: int, i: int) -> str:
+    s = f"x_{{{i}}}"
+    for level in range(depth):
+        if level % 3 == 0:
+            s = f"\\frac{{{s}}}{{1 + {s[:12] if len(s) > 40 else s}}}"
+        elif level % 3 == 1:
+            s = f"\\sqrt{{{s} + y^{{{level}}}}}"
+        else:
+            s = f"{{({s})}}^{{{level}}}"
+    return s
+
+
+def make_corpora(scale: int = 1) -> Dict[str, Corpus]:
+    """生成套件使用的合成语料：深层嵌套、符号密集、长文档、大量小公式、大矩阵"""
+    deep = [_deep_formula(8 + i % 5, i) for i in range(40 * scale)]
+    dense = [
+        " ".join(f"{_SYMBOLS[(i + k) % len(_SYMBOLS)]} a_{{{k}}}^{{2}}" for k in range(30))
+        for i in range(40 * scale)
+    ]
+    long_doc = make_markdown_document(400 * scale, prose_lines=5)
+    small = [("x_{i}", "a^2", "\\alpha", "n!", "f(x)", "\\pi r^2", "e^{x}", "y_1")[i % 8]
+             for i in range(2000 * scale)]
+    envs = ("pmatrix", "bmatrix", "vmatrix")
+    cells = " \\\\ ".join(" & ".join(f"a_{{{r},{c}}}" for c in range(30)) for r in range(30))
+    matrices = [f"\\begin{{{envs[i % 3]}}}{cells}\\end{{{envs[i % 3]}}}" for i in range(10 * scale)]
+    return {
+        "deep_nesting": (deep, [f"推导：$${f}$$\n" for f in deep]),
+        "symbol_dense": (dense, [f"其中 ${f}$。\n" for f in dense]),
+        "long_document": ([f["content"] for f in extract_all_formulas(long_doc)], [long_doc]),
+        "many_small": (small, [f"设 ${f}$ 为变量。" for f in small]),
+        "large_matrices": (matrices, [f"矩阵：$${f}$$\n" for f in matrices]),
+    }
+
+
+# 被测函数及其输入（"formulas" 或 "documents"）
+BENCH_FUNCTIONS: Dict[str, Tuple[Callable[[str], object], str]] = {
+    "latex_to_unicodemath": (latex_to_unicodemath, "formulas"),
+    "extract_all_formulas": (extract_all_formulas, "documents"),
+    "extract_first_formula_latex": (extract_first_formula_latex, "documents"),
+    "validate_latex": (validate_latex, "formulas"),
+    "normalize_latex_for_word": (normalize_latex_for_word, "formulas"),
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩法百分位数，sorted_values 须已升序排列"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def measure(func: Callable[[str], object], samples: List[str], repeat: int = 5,
+            warmup: int = 1) -> Dict[str, float]:
+    """逐条计时 samples，返回吞吐量和延迟百分位数
+
+    吞吐量取 repeat 轮中总耗时最短的一轮；延迟百分位数基于所有轮次的单次调用耗时。
+    """
+    clock = time.perf_counter_ns
+    for _ in range(warmup):
+        for sample in samples:
+            func(sample)
+    latencies: List[int] = []
+    best = None
+    for _ in range(repeat):
+        round_start = clock()
+        for sample in samples:
+            start = clock()
+            func(sample)
+            latencies.append(clock() - start)
+        elapsed = clock() - round_start
+        best = elapsed if best is None else min(best, elapsed)
+    latencies.sort()
+    seconds = max(best, 1) / 1e9
+    chars = sum(map(len, samples))
+    return {
+        "calls": len(samples),
+        "chars": chars,
+        "best_round_ms": seconds * 1e3,
+        "mean_us": seconds * 1e6 / max(len(samples), 1),
+        "ops_per_s": len(samples) / seconds,
+        "chars_per_s": chars / seconds,
+        "p50_us": percentile(latencies, 50) / 1e3,
+        "p90_us": percentile(latencies, 90) / 1e3,
+        "p99_us": percentile(latencies, 99) / 1e3,
+        "max_us": latencies[-1] / 1e3 if latencies else 0.0,
+    }
+
+
+def run_suite(scale: int = 1, repeat: int = 5, only: Optional[List[str]] = None,
+              log: Optional[Callable[[str], None]] = print) -> Dict[str, Any]:
+    """对每个被测函数和每个语料运行基准测试，返回可直接写成 JSON 的结果
+
+    结果键为 "函数/语料"；only 给出时只运行键中包含其中任一子串的项目。
+    转换缓存保持默认的关闭状态，测得的是实际转换耗时。
+    """
+    corpora = make_corpora(scale)
+    results: Dict[str, Dict[str, float]] = {}
+    for func_name, (func, kind) in BENCH_FUNCTIONS.items():
+        for corpus_name, (formulas, documents) in corpora.items():
+            key = f"{func_name}/{corpus_name}"
+            if only and not any(part in key for part in only):
+                continue
+            samples = formulas if kind == "formulas" else documents
+            stats = measure(func, samples, repeat)
+            results[key] = stats
+            if log is not None:
+                log(f"  {key:<48} {stats['mean_us']:10.2f} µs/次  p50 {stats['p50_us']:9.2f}  "
+                    f"p99 {stats['p99_us']:9.2f}  {stats['chars_per_s'] / 1e6:7.2f} M 字符/秒")
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "scale": scale,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any],
+                    metric: str = "mean_us") -> List[Tuple[str, float, float, float]]:
+    """比较两次套件结果，返回 (键, 基线值, 当前值, 变化比例) 列表
+
+    metric 为耗时类指标（越小越好）；只比较两边都有的项目。
+    变化比例 = 当前 / 基线 - 1，由 report_comparison 按阈值判断是否退化。
+    """
+    rows = []
+    base = baseline["results"]
+    for key, stats in current["results"].items():
+        if key not in base:
+            continue
+        old, new = base[key][metric], stats[metric]
+        change = new / old - 1 if old > 0 else 0.0
+        rows.append((key, old, new, change))
+    return rows
+
+
+def report_comparison(rows: List[Tuple[str, float, float, float]], threshold: float,
+                      metric: str) -> int:
+    """打印比较表，返回退化项目数"""
+    regressions = 0
+    print(f"  {'项目':<46} {'基线':>10} {'当前':>10} {'变化':>8}   ({metric})")
+    for key, old, new, change in rows:
+        flag = ""
+        if change > threshold:
+            flag = "  ✗ 退化"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  ✓ 提升"
+        print(f"  {key:<48} {old:10.2f} {new:10.2f} {change:+8.1%}{flag}")
+    if regressions:
+        print(f"\n{regressions} 个项目退化超过 {threshold:.0%}")
+    else:
+        print(f"\n没有项目退化超过 {threshold:.0%}")
+    return regressions
+
+
+def profile_stages(formulas: List[str], engines: List[str]) -> str:
+    """用 conversion_profile 统计各引擎每个阶段的耗时，返回报表"""
+    profiler = enable_profiling()
+    try:
+        for engine in engines:
+            for formula in formulas:
+                latex_to_unicodemath(formula, engine=engine)
+        return profiler.report()
+    finally:
+        disable_profiling()
+
+
+def _load_json(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="公式转换工具性能测试")
+    sub = parser.add_subparsers(dest="command")
+
+    suite = sub.add_parser("suite", help="运行基准测试套件")
+    suite.add_argument("-o", "--output", help="把结果写入 JSON 文件")
+    suite.add_argument("--scale", type=int, default=1, help="语料规模倍数（默认 %(default)s）")
+    suite.add_argument("--repeat", type=int, default=5, help="每项重复轮数（默认 %(default)s）")
+    suite.add_argument("--only", action="append",
+                       help="只运行键中包含该子串的项目，可重复，如 --only validate_latex")
+    suite.add_argument("--compare", metavar="BASELINE", help="运行后与该基线 JSON 比较")
+
+    compare = sub.add_parser("compare", help="比较两次套件结果")
+    compare.add_argument("baseline", help="基线 JSON")
+    compare.add_argument("current", help="当前 JSON")
+
+    profile = sub.add_parser("profile", help="统计 latex_to_unicodemath 各阶段的耗时")
+    profile.add_argument("paths", nargs="*", help="从这些 Markdown 文件中提取公式；省略时使用合成语料")
+    profile.add_argument("--engine", choices=["fast", "reference", "both"], default="both",
+                         help="统计的转换引擎（默认 %(default)s）")
+
+    sub.add_parser("startup", help="测量模块导入耗时和单次转换的冷启动耗时")
+
+    for p in (suite, compare):
+        p.add_argument("--threshold", type=float, default=0.10,
+                       help="允许的退化比例，超过时退出码为 1（默认 %(default)s）")
+        p.add_argument("--metric", default="mean_us",
+                       choices=["mean_us", "p50_us", "p90_us", "p99_us"],
+                       help="比较的耗时指标（默认 %(default)s）")
+    return parser
+
+
+# modules whose import time is reported, lowest layer first
+STARTUP_MODULES = ("latex_to_unicodemath", "markdown_to_latex", "converter", "cli", "server")
+_COLD_CONVERSION = ("from latex_to_unicodemath import latex_to_unicodemath; "
+                    "latex_to_unicodemath(r'\\frac{a}{b}')")
+
+
+def _python(code: str, *flags: str) -> "subprocess.CompletedProcess[str]":
+    return subprocess.run([sys.executable, *flags, "-c", code], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+
+def import_time_us(module: str, repeat: int = 5) -> int:
+    """用 python -X importtime 测量导入 module（含其依赖）的最短累计耗时（微秒）"""
+    best = None
+    for _ in range(repeat):
+        stderr = _python(f"import {module}", "-X", "importtime").stderr
+        for line in stderr.splitlines():
+            # "import time: self [us] | cumulative | imported package"
+            parts = line.split("|")
+            if len(parts) == 3 and parts[2].strip() == module:
+                cumulative = int(parts[1])
+                best = cumulative if best is None else min(best, cumulative)
+    return best or 0
+
+
+def cold_start_ms(code: str, repeat: int = 5) -> float:
+    """新启动的解释器执行 code 的最短耗时（毫秒，含解释器本身的启动）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _python(code)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def bench_startup(repeat: int = 5) -> None:
+    for module in STARTUP_MODULES:
+        print(f"  import {module:<22} {import_time_us(module, repeat) / 1e3:7.1f} ms")
+    interpreter = cold_start_ms("pass", repeat)
+    conversion = cold_start_ms(_COLD_CONVERSION, repeat)
+    print(f"  空解释器启动：{interpreter:7.1f} ms")
+    print(f"  冷启动并转换一个公式：{conversion:7.1f} ms（比空解释器多 {conversion - interpreter:.1f} ms）")
+    # server keeps a process pool, so only the one-shot entry points are checked
+    loaded = _python("import sys, cli, converter; "
+                     "print(sorted(m for m in ('PySide6', 'pyperclip', 'multiprocessing') if m in sys.modules))")
+    print(f"  导入 cli/converter 后已加载的重量级模块：{loaded.stdout.strip()}")
+
+
+def run_demos() -> None:
+    print("=== 公式提取：单遍扫描 vs 三正则（公式密集） ===")
+    bench_extraction()
+    print("\n=== 公式提取：单遍扫描 vs 三正则（以文字为主） ===")
+    bench_extraction(2000, prose_lines=20)
+    print("\n=== 大文件公式提取：整体读入 vs 内存映射 ===")
+    bench_mapped_file()
+    print("\n=== 整篇文档改写为 UnicodeMath（耗时应随长度线性增长） ===")
+    bench_rewrite()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(encoding="utf-8")
+    if args.command is None:
+        run_demos()
+        return 0
+
+    if args.command == "startup":
+        print("=== 导入与冷启动耗时（取多次运行的最短值） ===")
+        bench_startup()
+        return 0
+
+    if args.command == "profile":
+        if args.paths:
+            formulas = [f["content"] for f in chain.from_iterable(map_formulas(p) for p in args.paths)]
+        else:
+            formulas = [f for fs, _ in make_corpora().values() for f in fs]
+        engines = ["fast", "reference"] if args.engine == "both" else [args.engine]
+        print(f"=== 各阶段耗时（{len(formulas)} 个公式） ===")
+        print(profile_stages(formulas, engines))
+        return 0
+
+    if args.command == "suite":
+        print(f"=== 基准测试套件（scale={args.scale}，repeat={args.repeat}） ===")
+        current = run_suite(args.scale, args.repeat, args.only)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(current, f, ensure_ascii=False, indent=2)
+            print(f"\n结果已写入 {args.output}")
+        if not args.compare:
+            return 0
+        baseline = _load_json(args.compare)
+    else:
+        baseline, current = _load_json(args.baseline), _load_json(args.current)
+
+    print(f"\n=== 与基线比较（阈值 {args.threshold:.0%}） ===")
+    rows = compare_results(baseline, current, args.metric)
+    return 1 if report_comparison(rows, args.threshold, args.metric) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+公式转换工具命令行入口
+不依赖 PySide6，可在无图形界面的环境中批量转换文件、目录或标准输入
+"""
+
+import argparse
+import os
+import sys
+from typing import List, Optional, Tuple
+
+from conversion_cache import enable_disk_cache
+from converter import (MODES, MODE_LATEX_TO_UNIMATH, MODE_MD_DOC_TO_UNIMATH, WRAP_DISPLAY, WRAP_INLINE,
+                       WRAP_KEEP, convert_documents, convert_many)
+from latex_macros import MacroRegistry
+
+
+def _collect_files(paths: List[str], pattern_exts: Tuple[str, ...]) -> List[Tuple[str, str]]:
+    """展开输入路径，返回 (文件路径, 相对名) 列表"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(pattern_exts):
+                        full = os.path.join(root, name)
+                        files.append((full, os.path.relpath(full, path)))
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+
+def _read_text(path: str) -> str:
+    if path == "-":
+        return sys.stdin.read()
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _split_inputs(text: str, each_line: bool) -> List[Tuple[int, str]]:
+    """拆分输入，返回 (行号, 内容) 列表；-l 时跳过空行，行号仍为原文件中的行号"""
+    if each_line:
+        return [(number, line) for number, line in enumerate(text.splitlines(), 1) if line.strip()]
+    return [(1, text)]
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="cli.py",
+        description="将 Markdown / LaTeX 公式转换为 LaTeX 或 UnicodeMath（无需图形界面）",
+    )
+    parser.add_argument("paths", nargs="*", default=["-"],
+                        help="输入文件或目录，省略或 - 表示标准输入")
+    parser.add_argument("-m", "--mode", choices=MODES, default=MODE_LATEX_TO_UNIMATH,
+                        help="转换模式（默认 %(default)s）")
+    parser.add_argument("--wrap", choices=[WRAP_KEEP, WRAP_INLINE, WRAP_DISPLAY], default=WRAP_KEEP,
+                        help="md2latex 模式下的 LaTeX 输出包装（默认 %(default)s）")
+    parser.add_argument("-l", "--each-line", action="store_true",
+                        help="把每个非空行当作一条独立输入")
+    parser.add_argument("-o", "--output",
+                        help="输出文件；输入为多个文件或目录时为输出目录。省略时写到标准输出")
+    parser.add_argument("--ext", default=".txt",
+                        help="写入输出目录时追加的扩展名（默认 %(default)s）")
+    parser.add_argument("--include", default=".md,.markdown,.tex,.txt",
+                        help="遍历目录时处理的扩展名，逗号分隔（默认 %(default)s）")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="并行进程数，0 表示 CPU 核数（默认 1）")
+    parser.add_argument("--macros", action="append", default=[], metavar="FILE",
+                        help="从文件（如导言区 .tex）收集 \\newcommand 等宏定义，可多次指定；"
+                             "输入自身的宏定义总会生效")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="持久缓存文件（sqlite），多次运行之间复用转换结果，转换表改动后自动失效")
+    parser.add_argument("--cache-mb", type=int, default=256,
+                        help="持久缓存的大小上限，单位 MB（默认 %(default)s）")
+    parser.add_argument("--stats", action="store_true",
+                        help="mddoc2unimath 模式下在标准错误输出公式去重统计")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(encoding="utf-8")
+
+    macros = None
+    if args.macros:
+        macros = MacroRegistry()
+        for path in args.macros:
+            try:
+                macros.collect(_read_text(path))
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"{path}: 读取失败：{e}", file=sys.stderr)
+                return 1
+
+    if args.cache:
+        enable_disk_cache(args.cache, args.cache_mb << 20)
+
+    exts = tuple(e.strip().lower() for e in args.include.split(",") if e.strip())
+    files = _collect_files(args.paths, exts)
+    to_dir = args.output is not None and (len(files) > 1 or any(os.path.isdir(p) for p in args.paths))
+
+    # 所有输入一次性交给批量接口，再按文件拆回
+    inputs: List[str] = []
+    line_numbers: List[int] = []
+    spans: List[Tuple[str, str, int, int]] = []
+    for path, rel in files:
+        try:
+            items = _split_inputs(_read_text(path), args.each_line)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"{path}: 读取失败：{e}", file=sys.stderr)
+            spans.append((path, rel, len(inputs), -1))
+            continue
+        spans.append((path, rel, len(inputs), len(inputs) + len(items)))
+        for number, item in items:
+            line_numbers.append(number)
+            inputs.append(item)
+
+    if args.mode == MODE_MD_DOC_TO_UNIMATH:
+        # formulas repeat heavily across a corpus: each distinct one is converted once
+        results, plan = convert_documents(inputs, workers=args.workers or None, macros=macros)
+        if args.stats:
+            print(f"公式 {plan.occurrences} 个，其中不同的 {len(plan.unique)} 个，"
+                  f"重复 {plan.dedup_ratio:.1%}", file=sys.stderr)
+    else:
+        results = convert_many(inputs, args.mode, args.wrap, workers=args.workers or None, macros=macros)
+
+    failed = 0
+    single_out = None
+    if args.output is not None and not to_dir:
+        single_out = open(args.output, "w", encoding="utf-8")
+    try:
+        for path, rel, start, end in spans:
+            if end < 0:
+                failed += 1
+                continue
+            lines = []
+            for result in results[start:end]:
+                if result.ok:
+                    lines.append(result.output)
+                else:
+                    failed += 1
+                    where = f"{path}:{line_numbers[result.index]}" if args.each_line else path
+                    print(f"{where}: {result.error}", file=sys.stderr)
+            text = "\n".join(lines)
+            if lines and not text.endswith("\n"):
+                text += "\n"
+            if to_dir:
+                target = os.path.join(args.output, rel + args.ext)
+                os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+                with open(target, "w", encoding="utf-8") as f:
+                    f.write(text)
+            elif single_out is not None:
+                single_out.write(text)
+            else:
+                sys.stdout.write(text)
+    finally:
+        if single_out is not None:
+            single_out.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
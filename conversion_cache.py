@@ -0,0 +1,176 @@
+import functools
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_MISSING = object()
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size_bytes: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _sizeof(value: Any) -> int:
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class ConversionCache:
+    """有界 LRU 转换缓存，按条目数和字节数两种预算淘汰最久未用的结果"""
+
+    # results live in this process only (DiskCache sets this to True)
+    persistent = False
+
+    def __init__(self, max_entries: int = 4096, max_bytes: Optional[int] = None) -> None:
+        if max_entries <= 0:
+            raise ValueError("max_entries 必须为正数")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._size_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self._misses += 1
+                return default
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = _sizeof(key) + _sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._sizes.pop(key, None)
+            if old is not None:
+                self._size_bytes -= old
+                del self._data[key]
+            self._data[key] = value
+            self._sizes[key] = size
+            self._size_bytes += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._data) > self.max_entries or (
+            self.max_bytes is not None and self._size_bytes > self.max_bytes
+        ):
+            key, _ = self._data.popitem(last=False)
+            self._size_bytes -= self._sizes.pop(key)
+            self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._size_bytes = 0
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._hits = self._misses = self._evictions = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._data), self._size_bytes)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Process-wide cache used by the @cached functions; None means disabled
+_active_cache: Optional[ConversionCache] = None
+
+
+def enable_cache(max_entries: int = 4096, max_bytes: Optional[int] = None) -> ConversionCache:
+    """启用全局转换缓存（默认关闭），返回缓存对象"""
+    global _active_cache
+    _active_cache = ConversionCache(max_entries, max_bytes)
+    return _active_cache
+
+
+def enable_disk_cache(path: str, max_bytes: int = 256 << 20, memory_entries: int = 4096) -> Any:
+    """启用持久的磁盘缓存（sqlite 文件，多次运行、多个进程共享），返回 DiskCache
+
+    转换表改动后旧结果自动失效，总大小超过 max_bytes 时淘汰最久未用的结果。
+    """
+    global _active_cache
+    # imported here: sqlite3 is only needed once a disk cache is requested
+    from disk_cache import DiskCache
+
+    _active_cache = DiskCache(path, max_bytes, memory_entries)  # type: ignore[assignment]
+    return _active_cache
+
+
+def use_cache(cache: Optional[ConversionCache]) -> None:
+    """把给定的缓存对象设为全局缓存（如进程池子进程中沿用父进程的磁盘缓存）"""
+    global _active_cache
+    _active_cache = cache
+
+
+def disable_cache() -> None:
+    """关闭并丢弃全局转换缓存"""
+    global _active_cache
+    _active_cache = None
+
+
+def get_cache() -> Optional[ConversionCache]:
+    return _active_cache
+
+
+def cache_stats() -> Optional[CacheStats]:
+    """全局缓存的命中、未命中和淘汰统计；未启用时返回 None"""
+    return _active_cache.stats() if _active_cache is not None else None
+
+
+def strip_cr(text: str) -> str:
+    return text.replace("\r", "")
+
+
+def strip_text(text: str) -> str:
+    return text.replace("\r", "").strip()
+
+
+def cached(kind: str, normalize: Optional[Callable[[str], str]] = strip_cr) -> Callable[[F], F]:
+    """为以公式文本为首参数的转换函数加上缓存
+
+    缓存键为 (kind, 规范化后的文本, 其余参数)；全局缓存未启用时直接调用。
+    normalize 只能做不改变函数结果的规范化，为 None 时以原文为键。
+    """
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(text: str, *args: Any, **kwargs: Any) -> Any:
+            cache = _active_cache
+            if cache is None:
+                return func(text, *args, **kwargs)
+            key = (kind, normalize(text) if normalize is not None else text, args, tuple(sorted(kwargs.items())) if kwargs else ())
+            value = cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = func(text, *args, **kwargs)
+                cache.put(key, value)
+            return value
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
@@ -0,0 +1,133 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+
+class StageEvent(NamedTuple):
+    """一次阶段执行的记录"""
+    stage: str
+    seconds: float
+    iterations: int
+    bytes_in: int
+    bytes_out: int
+
+
+class StageStats(NamedTuple):
+    calls: int
+    seconds: float
+    iterations: int
+    bytes_in: int
+    bytes_out: int
+
+    @property
+    def mean_us(self) -> float:
+        return self.seconds * 1e6 / self.calls if self.calls else 0.0
+
+
+def _byte_size(value: Any) -> int:
+    # stages pass either text or a token list that concatenates back to text
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return sum(len(item.encode("utf-8")) for item in value)
+
+
+class ConversionProfiler:
+    """按阶段累计耗时、调用次数、不动点迭代次数和输入/输出字节数
+
+    给出 callback 时每次阶段执行后以 StageEvent 调用它（在转换线程中调用）。
+    """
+
+    def __init__(self, callback: Optional[Callable[[StageEvent], None]] = None) -> None:
+        self.callback = callback
+        self._stats: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, data_in: Any, data_out: Any,
+               iterations: int = 0) -> None:
+        self.record_sizes(stage, seconds, _byte_size(data_in), _byte_size(data_out), iterations)
+
+    def record_sizes(self, stage: str, seconds: float, bytes_in: int, bytes_out: int,
+                     iterations: int = 0) -> None:
+        """与 record 相同，但直接给出输入/输出的字节数"""
+        event = StageEvent(stage, seconds, iterations, bytes_in, bytes_out)
+        with self._lock:
+            totals = self._stats.get(stage)
+            if totals is None:
+                totals = self._stats[stage] = [0, 0.0, 0, 0, 0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += iterations
+            totals[3] += event.bytes_in
+            totals[4] += event.bytes_out
+        if self.callback is not None:
+            self.callback(event)
+
+    def stats(self) -> Dict[str, StageStats]:
+        """各阶段的累计统计，按执行顺序排列"""
+        with self._lock:
+            return {stage: StageStats(*totals) for stage, totals in self._stats.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def report(self) -> str:
+        """按总耗时从高到低排列的文本报表"""
+        stats = self.stats()
+        total = sum(s.seconds for s in stats.values()) or 1.0
+        # CJK headers take two columns per character, hence the narrower header fields
+        lines = [f"{'阶段':<44} {'次数':>6} {'总耗时ms':>7} {'µs/次':>8} {'占比':>5} {'迭代':>5} {'入字节':>7} {'出字节':>7}"]
+        for stage, s in sorted(stats.items(), key=lambda item: -item[1].seconds):
+            lines.append(f"{stage:<46} {s.calls:8d} {s.seconds * 1e3:10.2f} {s.mean_us:9.2f} "
+                         f"{s.seconds / total:7.1%} {s.iterations:7d} {s.bytes_in:10d} {s.bytes_out:10d}")
+        return "\n".join(lines)
+
+
+# Process-wide profiler read by the conversion pipeline; None means disabled,
+# in which case the pipeline pays a single None check per conversion
+_active_profiler: Optional[ConversionProfiler] = None
+
+
+def enable_profiling(callback: Optional[Callable[[StageEvent], None]] = None) -> ConversionProfiler:
+    """启用全局分阶段性能统计（默认关闭），返回统计对象"""
+    global _active_profiler
+    _active_profiler = ConversionProfiler(callback)
+    return _active_profiler
+
+
+def disable_profiling() -> None:
+    """关闭并丢弃全局分阶段性能统计"""
+    global _active_profiler
+    _active_profiler = None
+
+
+def get_profiler() -> Optional[ConversionProfiler]:
+    return _active_profiler
+
+
+def profile_stats() -> Optional[Dict[str, StageStats]]:
+    """各阶段的累计统计；未启用时返回 None"""
+    return _active_profiler.stats() if _active_profiler is not None else None
+
+
+def run_stages(stages: Any, value: Any, profiler: ConversionProfiler,
+               fixpoints: Optional[Dict[Callable, Callable]] = None) -> Any:
+    """依次执行 (阶段名, 函数) 序列并逐个计时
+
+    fixpoints 把阶段函数映射到返回 (结果, 迭代次数) 的等价实现，用于统计迭代次数。
+    """
+    clock = time.perf_counter
+    fixpoints = fixpoints or {}
+    for stage, func in stages:
+        counted = fixpoints.get(func)
+        # measured up front: a stage may consume its input (parse_emit pops the token list)
+        size_in = _byte_size(value)
+        start = clock()
+        if counted is None:
+            out, iterations = func(value), 0
+        else:
+            out, iterations = counted(value)
+        elapsed = clock() - start
+        profiler.record_sizes(stage, elapsed, size_in, _byte_size(out), iterations)
+        value = out
+    return value
@@ -0,0 +1,406 @@
+import os
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+from conversion_cache import get_cache, use_cache
+from latex_macros import MacroRegistry, collect_macros, has_definitions
+from markdown_to_latex import (_LEADING_WS_PATTERN, LatexDiagnostic, check_latex, extract_all_formulas,
+                               extract_first_formula_latex, iter_formula_candidates)
+from latex_to_unicodemath import latex_to_unicodemath
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Conversion modes (same three modes as the GUI)
+MODE_MD_TO_LATEX = "md2latex"
+MODE_MD_TO_UNIMATH = "md2unimath"
+MODE_LATEX_TO_UNIMATH = "latex2unimath"
+MODE_MD_DOC_TO_UNIMATH = "mddoc2unimath"  # every formula of a document, rewritten in place
+MODES = (MODE_MD_TO_LATEX, MODE_MD_TO_UNIMATH, MODE_LATEX_TO_UNIMATH, MODE_MD_DOC_TO_UNIMATH)
+
+# LaTeX output wrapping for MODE_MD_TO_LATEX
+WRAP_KEEP = "keep"
+WRAP_INLINE = "inline"
+WRAP_DISPLAY = "display"
+
+
+class FormulaNotFoundError(ValueError):
+    """Markdown 输入中没有找到公式"""
+
+
+class LatexSyntaxError(ValueError):
+    """LaTeX 括号不配对等语法错误，diagnostic 中含出错的行列位置"""
+
+    def __init__(self, diagnostic: LatexDiagnostic) -> None:
+        super().__init__(f"LaTeX 语法错误：{diagnostic}")
+        self.diagnostic = diagnostic
+
+
+class ConversionCancelled(Exception):
+    """转换被取消（由进度回调抛出）"""
+
+
+# progress(percent, stage): called between stages; raise ConversionCancelled to abort
+ProgressCallback = Callable[[int, str], None]
+
+
+def _report(progress: Optional[ProgressCallback], percent: int, stage: str) -> None:
+    if progress is not None:
+        progress(percent, stage)
+
+
+def _wrap_latex(latex: str, display_mode: Optional[str], wrap: str) -> str:
+    if wrap == WRAP_INLINE:
+        return f"${latex}$"
+    if wrap == WRAP_DISPLAY:
+        return f"$${latex}$$"
+    return f"$${latex}$$" if display_mode == "display" else f"${latex}$"
+
+
+def _with_document_macros(text: str, macros: Optional[MacroRegistry]) -> Optional[MacroRegistry]:
+    # text's own definitions added to (a copy of) macros; None when there is nothing to expand
+    if has_definitions(text):
+        return collect_macros(text, macros)
+    return macros if macros else None
+
+
+def _first_expanded_formula(md_text: str, macros: Optional[MacroRegistry]) -> Tuple[Optional[str], Optional[str]]:
+    # the first formula (in extract_first_formula_latex's priority) left with
+    # content once the document's macros are expanded: a formula holding only
+    # \newcommand definitions is skipped rather than converted to nothing
+    macros = _with_document_macros(md_text, macros)
+    if macros is None:
+        return extract_first_formula_latex(md_text)
+    for latex, display_mode in iter_formula_candidates(md_text):
+        expanded = macros.expand(latex)
+        if expanded.strip():
+            return expanded, display_mode
+    return None, None
+
+
+def md_to_latex(md_text: str, wrap: str = WRAP_KEEP,
+                progress: Optional[ProgressCallback] = None) -> str:
+    """Markdown 转 LaTeX，未找到公式时返回空字符串"""
+    _report(progress, 10, "提取公式")
+    latex, display_mode = extract_first_formula_latex(md_text)
+    if latex is None:
+        return ""
+    return _wrap_latex(latex, display_mode, wrap)
+
+
+def md_to_unimath(md_text: str, progress: Optional[ProgressCallback] = None,
+                  macros: Optional[MacroRegistry] = None) -> str:
+    """Markdown 转 UnicodeMath，未找到公式时返回空字符串
+
+    第一个公式中的宏按 macros 和整篇文档中的宏定义展开；只含宏定义的公式跳过。
+    """
+    _report(progress, 10, "提取公式")
+    latex, _ = _first_expanded_formula(md_text, macros)
+    if latex is None:
+        return ""
+    _report(progress, 50, "转换为 UnicodeMath")
+    return latex_to_unicodemath(latex)
+
+
+def latex_to_unimath(latex_text: str, progress: Optional[ProgressCallback] = None,
+                     macros: Optional[MacroRegistry] = None) -> str:
+    """LaTeX 转 UnicodeMath，语法错误时抛出 LatexSyntaxError（ValueError 的子类）
+
+    语法检查只做几次 C 层的计数，逐字符的遍历只有转换本身一遍。
+    公式中的宏按 macros 和公式自身的 \\newcommand 等定义展开。
+    """
+    _report(progress, 10, "检查语法")
+    diagnostic = check_latex(latex_text)
+    if diagnostic is not None:
+        raise LatexSyntaxError(diagnostic)
+    macros = _with_document_macros(latex_text, macros)
+    if macros is not None:
+        latex_text = macros.expand(latex_text)
+    _report(progress, 50, "转换为 UnicodeMath")
+    return latex_to_unicodemath(latex_text)
+
+
+# unique formulas converted between progress reports in md_doc_to_unimath
+_DOC_PROGRESS_STEP = 256
+
+
+class BatchPlan(NamedTuple):
+    """去重后的转换计划
+
+    unique 为按首次出现顺序排列的不同内容，slots[i] 为第 i 次出现在 unique 中的下标。
+    只需转换 unique，再用 scatter 把结果按出现顺序分发回去。
+    """
+
+    unique: List[str]
+    slots: List[int]
+
+    @property
+    def occurrences(self) -> int:
+        return len(self.slots)
+
+    @property
+    def dedup_ratio(self) -> float:
+        """重复出现、无需再转换的比例"""
+        return 1 - len(self.unique) / len(self.slots) if self.slots else 0.0
+
+    def scatter(self, outputs: Sequence[T]) -> List[T]:
+        """把与 unique 一一对应的结果展开为与每次出现一一对应的列表"""
+        return [outputs[slot] for slot in self.slots]
+
+
+def plan_batch(contents: Iterable[str]) -> BatchPlan:
+    """为一组公式内容生成去重计划，相同的内容只保留首次出现的那个字符串"""
+    index: Dict[str, int] = {}
+    # setdefault evaluates len(index) before inserting, which is exactly the new
+    # key's position; dicts keep insertion order, so the keys are the unique list
+    slots = [index.setdefault(content, len(index)) for content in contents]
+    return BatchPlan(list(index), slots)
+
+
+def _document_formulas(md_text: str, macros: Optional[MacroRegistry]) -> Tuple[List[int], List[str]]:
+    # absolute formula boundaries [start0, end0, start1, end1, ...] and the
+    # contents with the document's macros expanded
+    macros = _with_document_macros(md_text, macros)
+    formulas = extract_all_formulas(md_text)
+    # extract_all_formulas 的偏移相对于去掉前导空白后的文本
+    lead = _LEADING_WS_PATTERN.match(md_text).end()
+    bounds: List[int] = []
+    contents: List[str] = []
+    expanded: Dict[str, str] = {}
+    for formula in formulas:
+        bounds.append(formula.start + lead)
+        bounds.append(formula.end + lead)
+        content = formula.content
+        if macros is not None:
+            result = expanded.get(content)
+            if result is None:
+                result = expanded[content] = macros.expand(content)
+            content = result
+        contents.append(content)
+    return bounds, contents
+
+
+def _splice(md_text: str, bounds: List[int], outputs: Sequence[str]) -> str:
+    # replace each formula span with its output, cutting all pieces before one join
+    parts: List[str] = []
+    pos = 0
+    for i, output in enumerate(outputs):
+        parts.append(md_text[pos:bounds[2 * i]])
+        parts.append(output)
+        pos = bounds[2 * i + 1]
+    parts.append(md_text[pos:])
+    return "".join(parts)
+
+
+def md_doc_to_unimath(md_text: str, progress: Optional[ProgressCallback] = None,
+                      macros: Optional[MacroRegistry] = None) -> str:
+    """把 Markdown 文档中的每个公式原地替换为 UnicodeMath，其余文本保持不变
+
+    基于 extract_all_formulas 的偏移，先切好所有片段再一次 join，
+    耗时与文档长度近似线性；按 plan_batch 去重，重复的公式只转换一次。
+    未找到公式时原样返回。转换过程中每 256 个不同的公式调用一次 progress，
+    长文档也能及时取消。文档中的宏定义先统一收集（与 macros 合并），
+    再在每个公式中展开；只含定义的公式转换为空。
+    """
+    _report(progress, 10, "提取公式")
+    bounds, contents = _document_formulas(md_text, macros)
+    plan = plan_batch(contents)
+    _report(progress, 50, "转换为 UnicodeMath")
+    outputs: List[str] = []
+    for i, content in enumerate(plan.unique):
+        if progress is not None and i and i % _DOC_PROGRESS_STEP == 0:
+            progress(50 + 49 * i // len(plan.unique), "转换为 UnicodeMath")
+        outputs.append(latex_to_unicodemath(content))
+    return _splice(md_text, bounds, plan.scatter(outputs))
+
+
+def extract_formula(text: str, mode: str, progress: Optional[ProgressCallback] = None,
+                    macros: Optional[MacroRegistry] = None) -> Tuple[Optional[str], Optional[str]]:
+    """取出该模式下实际要转换的公式，返回 (latex, display_mode)
+
+    Markdown 模式提取第一个公式，未找到时为 (None, None)；md2unimath 模式下
+    公式中的宏已按 macros 和整篇输入中的定义展开。LaTeX 模式和整篇文档模式
+    原样返回输入。结果相同时 convert_formula 的输出也相同，可用来跳过重复转换。
+    """
+    if mode == MODE_LATEX_TO_UNIMATH or mode == MODE_MD_DOC_TO_UNIMATH:
+        return text, None
+    if mode != MODE_MD_TO_LATEX and mode != MODE_MD_TO_UNIMATH:
+        raise ValueError(f"未知的转换模式：{mode}")
+    _report(progress, 10, "提取公式")
+    if mode == MODE_MD_TO_UNIMATH:
+        # expanded here rather than in convert_formula: definitions elsewhere in
+        # the document change the result, so they must be part of the returned key
+        return _first_expanded_formula(text, macros)
+    return extract_first_formula_latex(text)
+
+
+def convert_formula(latex: Optional[str], display_mode: Optional[str], mode: str,
+                    wrap: str = WRAP_KEEP, progress: Optional[ProgressCallback] = None,
+                    macros: Optional[MacroRegistry] = None) -> str:
+    """转换 extract_formula 取出的公式（macros 须与传给 extract_formula 的相同）"""
+    if mode == MODE_LATEX_TO_UNIMATH:
+        result = latex_to_unimath(latex or "", progress, macros)
+    elif mode == MODE_MD_DOC_TO_UNIMATH:
+        result = md_doc_to_unimath(latex or "", progress, macros)
+    else:
+        if latex is None:
+            result = ""
+        elif mode == MODE_MD_TO_LATEX:
+            result = _wrap_latex(latex, display_mode, wrap)
+        else:
+            _report(progress, 50, "转换为 UnicodeMath")
+            result = latex_to_unicodemath(latex)
+        if not result:
+            raise FormulaNotFoundError("未检测到 $...$、$$...$$ 或 ```math 公式块")
+    _report(progress, 100, "完成")
+    return result
+
+
+def convert(text: str, mode: str = MODE_LATEX_TO_UNIMATH, wrap: str = WRAP_KEEP,
+            progress: Optional[ProgressCallback] = None,
+            macros: Optional[MacroRegistry] = None) -> str:
+    """按转换模式转换一段输入
+
+    progress 为可选的进度回调 progress(百分比, 阶段名)，在各阶段之间调用；
+    回调中抛出 ConversionCancelled 可中止转换。macros 为额外的宏定义表
+    （如从导言区收集的），输入自身的 \\newcommand 等定义总会生效。
+    """
+    latex, display_mode = extract_formula(text, mode, progress, macros)
+    return convert_formula(latex, display_mode, mode, wrap, progress, macros)
+
+
+class BatchResult(NamedTuple):
+    index: int
+    output: Optional[str]
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _convert_chunk(start: int, items: List[str], mode: str, wrap: str,
+                   macros: Optional[MacroRegistry] = None) -> List[BatchResult]:
+    results = []
+    for offset, text in enumerate(items):
+        try:
+            results.append(BatchResult(start + offset, convert(text, mode, wrap, None, macros), None))
+        except Exception as e:
+            results.append(BatchResult(start + offset, None, str(e)))
+    return results
+
+
+def _chunks(inputs: Iterable[str], chunksize: int) -> Iterator[Tuple[int, List[str]]]:
+    it = iter(inputs)
+    start = 0
+    while True:
+        chunk = list(islice(it, chunksize))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def _map_chunks(func: Callable[..., List[R]], calls: Iterable[Tuple[Any, ...]],
+                workers: Optional[int]) -> List[R]:
+    # func(*args) for each chunk, in this process or a pool; results in submission order
+    if workers is None:
+        workers = os.cpu_count() or 1
+    results: List[R] = []
+    if workers <= 1:
+        for args in calls:
+            results.extend(func(*args))
+        return results
+    # imported here: multiprocessing is by far the slowest import on the
+    # single-conversion path, and only parallel batches need it
+    from concurrent.futures import ProcessPoolExecutor
+
+    # a disk cache is shared through its file, so workers open the same one;
+    # in-memory caches stay per process
+    cache = get_cache()
+    shared = cache if cache is not None and cache.persistent else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=use_cache if shared else None,
+                             initargs=(shared,) if shared else ()) as executor:
+        futures = [executor.submit(func, *args) for args in calls]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def convert_many(
+    inputs: Iterable[str],
+    mode: str = MODE_LATEX_TO_UNIMATH,
+    wrap: str = WRAP_KEEP,
+    workers: Optional[int] = None,
+    chunksize: int = 256,
+    macros: Optional[MacroRegistry] = None,
+) -> List[BatchResult]:
+    """批量转换，结果按输入顺序返回
+
+    单条失败不会中断批处理，错误信息记录在对应结果的 error 中。
+    workers 为进程数（默认 CPU 核数），为 1 时在当前进程内顺序转换；
+    输入按 chunksize 分块派发给进程池。在 Windows 上使用进程池时，
+    调用方需放在 if __name__ == "__main__" 保护下。macros 为所有输入共用的宏定义表。
+    """
+    if mode not in MODES:
+        raise ValueError(f"未知的转换模式：{mode}")
+    if chunksize <= 0:
+        raise ValueError("chunksize 必须为正数")
+    calls = ((start, chunk, mode, wrap, macros) for start, chunk in _chunks(inputs, chunksize))
+    return _map_chunks(_convert_chunk, calls, workers)
+
+
+def _unicodemath_chunk(items: List[str]) -> List[Tuple[Optional[str], Optional[str]]]:
+    results: List[Tuple[Optional[str], Optional[str]]] = []
+    for latex in items:
+        try:
+            results.append((latex_to_unicodemath(latex), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def convert_documents(
+    texts: Iterable[str],
+    workers: Optional[int] = None,
+    chunksize: int = 256,
+    macros: Optional[MacroRegistry] = None,
+) -> Tuple[List[BatchResult], BatchPlan]:
+    """批量改写多篇 Markdown 文档（同 mddoc2unimath 模式），返回 (结果, 去重计划)
+
+    先提取所有文档的公式（宏按各自文档的定义展开），用 plan_batch 跨文档去重，
+    只转换不同的公式（workers、chunksize 含义同 convert_many），
+    再按偏移把结果写回每一处出现。plan.dedup_ratio 即省去的转换比例。
+    某篇文档的公式转换失败时，该文档的结果记录第一个错误，不影响其他文档。
+    """
+    if chunksize <= 0:
+        raise ValueError("chunksize 必须为正数")
+    documents: List[Tuple[str, Optional[List[int]], Optional[str]]] = []
+    contents: List[str] = []
+    for text in texts:
+        try:
+            bounds, found = _document_formulas(text, macros)
+        except Exception as e:
+            documents.append((text, None, str(e)))
+            continue
+        documents.append((text, bounds, None))
+        contents.extend(found)
+    plan = plan_batch(contents)
+    calls = ((chunk,) for _, chunk in _chunks(plan.unique, chunksize))
+    outcomes = plan.scatter(_map_chunks(_unicodemath_chunk, calls, workers))
+
+    results: List[BatchResult] = []
+    pos = 0
+    for index, (text, bounds, error) in enumerate(documents):
+        if bounds is None:
+            results.append(BatchResult(index, None, error))
+            continue
+        mine = outcomes[pos:pos + len(bounds) // 2]
+        pos += len(mine)
+        error = next((e for _, e in mine if e is not None), None)
+        if error is not None:
+            results.append(BatchResult(index, None, error))
+        else:
+            results.append(BatchResult(index, _splice(text, bounds, [o for o, _ in mine]), None))  # type: ignore[arg-type]
+    return results, plan
+
@@ -0,0 +1,253 @@
+import hashlib
+import marshal
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from conversion_cache import CacheStats, ConversionCache
+from lazy_re import LazyPattern
+
+# Modules whose constant tables determine conversion results
+FINGERPRINT_MODULES = ("latex_lexer", "latex_parser", "latex_to_unicodemath", "latex_to_omml",
+                       "markdown_to_latex")
+
+# Bump when conversion logic changes in a way the tables do not show
+_CACHE_VERSION = 1
+
+_MISSING = object()
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value BLOB NOT NULL,"
+    " size INTEGER NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)",
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)",
+    "INSERT OR IGNORE INTO meta VALUES ('bytes', 0)",
+    # the total size is kept by triggers so eviction never has to scan the table
+    "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN"
+    " UPDATE meta SET value = value + new.size WHERE name = 'bytes'; END",
+    "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN"
+    " UPDATE meta SET value = value - old.size WHERE name = 'bytes'; END",
+)
+
+# touched keys collected before their last-used times are written back
+_TOUCH_BATCH = 256
+
+
+def _canonical(value: Any) -> Any:
+    # a repr-stable form of a table; None for values that are not tables, such
+    # as functions, whose repr carries a memory address and differs per process
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (re.Pattern, LazyPattern)):
+        return ("re", value.pattern, value.flags)
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted((_canonical(v) for v in value), key=repr))
+    # dicts and dict-like tables (SymbolTable, extended by register_symbols)
+    items = getattr(value, "items", None)
+    if callable(items):
+        pairs = []
+        for k, v in items():
+            key, canonical = _canonical(k), _canonical(v)
+            if key is not None and canonical is not None:
+                pairs.append((key, canonical))
+        return tuple(pairs)
+    return None
+
+
+def table_fingerprint(modules: Iterable[str] = FINGERPRINT_MODULES) -> str:
+    """由各转换模块中的常量表（符号表、函数名、正则等全大写的模块级常量）计算指纹
+
+    任何一张表改动后指纹随之改变，磁盘缓存中按旧表得到的结果自动失效。
+    register_symbols / register_functions 扩充的条目也计入指纹，因此扩充应在
+    启用磁盘缓存之前完成。函数等无法跨进程稳定表示的值不计入。
+    """
+    import importlib
+
+    digest = hashlib.blake2b(repr((_CACHE_VERSION, marshal.version)).encode(), digest_size=16)
+    for module_name in modules:
+        module = importlib.import_module(module_name)
+        for name in sorted(vars(module)):
+            if name.strip("_").upper() != name.strip("_") or name.startswith("__"):
+                continue
+            canonical = _canonical(vars(module)[name])
+            if canonical is not None:
+                digest.update(repr((module_name, name, canonical)).encode())
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """基于 sqlite 的持久转换缓存，可被多个进程同时读写
+
+    接口与 ConversionCache 相同，可直接作为全局缓存使用（见
+    conversion_cache.enable_disk_cache）。键为缓存键的哈希，并混入转换表的指纹，
+    打开时指纹与文件中记录的不同则清空旧结果。数据库使用 WAL 模式，读不阻塞写；
+    每个进程（包括 fork 出的进程池子进程）使用自己的连接。总大小超过 max_bytes
+    时按最近使用时间淘汰到 90% 以下；命中结果的使用时间成批写回，读取不产生写事务。
+    前面另有 memory_entries 条的内存 LRU，同一进程中的重复命中不访问数据库。
+    """
+
+    persistent = True
+
+    def __init__(self, path: str, max_bytes: int = 256 << 20, memory_entries: int = 4096,
+                 fingerprint: Optional[str] = None, timeout: float = 30.0) -> None:
+        if max_bytes <= 0:
+            raise ValueError("max_bytes 必须为正数")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.fingerprint = fingerprint if fingerprint is not None else table_fingerprint()
+        self._memory = ConversionCache(memory_entries)
+        self._seed = hashlib.blake2b(self.fingerprint.encode(), digest_size=16)
+        self._lock = threading.Lock()
+        self._pid = -1
+        self._db: Optional[sqlite3.Connection] = None
+        self._touched: List[Tuple[int, bytes]] = []
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        # called with the lock held (or from __init__); reconnects after fork
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        # a connection inherited over fork must not be used, nor closed, by the child
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                             check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            for statement in _SCHEMA:
+                db.execute(statement)
+            row = db.execute("SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+            if row is None or row[0] != self.fingerprint:
+                db.execute("DELETE FROM entries")
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (self.fingerprint,))
+        self._db = db
+        self._pid = os.getpid()
+        self._touched = []
+        self._memory.clear()
+        return db
+
+    def _key(self, key: Hashable) -> bytes:
+        digest = self._seed.copy()
+        digest.update(repr(key).encode("utf-8", "surrogatepass"))
+        return digest.digest()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._memory.get(key, _MISSING)
+        if value is not _MISSING:
+            with self._lock:
+                self._hits += 1
+            return value
+        digest = self._key(key)
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT value FROM entries WHERE key = ?", (digest,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._touched.append((time.time_ns(), digest))
+            if len(self._touched) >= _TOUCH_BATCH:
+                with db:
+                    db.execute("BEGIN IMMEDIATE")
+                    self._flush_touched(db)
+        value = marshal.loads(row[0])
+        self._memory.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        try:
+            data = marshal.dumps(value)
+        except ValueError:
+            return  # not a plain value; such results are simply not persisted
+        self._memory.put(key, value)
+        digest = self._key(key)
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                # results are deterministic, so an existing entry is already correct
+                size = len(digest) + len(data)
+                db.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?)",
+                           (digest, data, size, time.time_ns()))
+                self._flush_touched(db)
+                self._evict(db, size)
+
+    def _flush_touched(self, db: sqlite3.Connection) -> None:
+        if self._touched:
+            db.executemany("UPDATE entries SET used = ? WHERE key = ?", self._touched)
+            self._touched = []
+
+    def _size(self, db: sqlite3.Connection) -> int:
+        return db.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+
+    def _evict(self, db: sqlite3.Connection, entry_size: int) -> None:
+        size = self._size(db)
+        if size <= self.max_bytes:
+            return
+        target = self.max_bytes * 9 // 10
+        while size > target:
+            # batch sized from the entry just written; entries are of similar size
+            batch = min((size - target) // max(entry_size, 1) + 1, 4096)
+            count = db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used LIMIT ?)", (batch,)
+            ).rowcount
+            if count <= 0:
+                break
+            self._evictions += count
+            size = self._size(db)
+
+    def flush(self) -> None:
+        """写回尚未保存的使用时间"""
+        with self._lock:
+            if self._touched and self._pid == os.getpid():
+                with self._db:  # type: ignore[union-attr]
+                    self._db.execute("BEGIN IMMEDIATE")  # type: ignore[union-attr]
+                    self._flush_touched(self._db)  # type: ignore[arg-type]
+
+    def clear(self) -> None:
+        self._memory.clear()
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("DELETE FROM entries")
+            self._touched = []
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._hits = self._misses = self._evictions = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            db = self._connect()
+            entries = db.execute("SELECT count(*) FROM entries").fetchone()[0]
+            return CacheStats(self._hits, self._misses, self._evictions, entries, self._size(db))
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT count(*) FROM entries").fetchone()[0]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # sent to spawned pool workers as its settings; each process opens its own connection
+        return {"path": self.path, "max_bytes": self.max_bytes,
+                "memory_entries": self._memory.max_entries,
+                "fingerprint": self.fingerprint, "timeout": self.timeout}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(**state)  # type: ignore[misc]
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List
+
+from latex_to_unicodemath import latex_to_unicodemath
+from markdown_to_latex import _Span, _scan_formulas
+
+# Characters compared per step when diffing old and new text
+_DIFF_BLOCK = 4096
+# First re-scan window after the edit; doubled until the scan re-synchronises
+_RESCAN_WINDOW = 1024
+
+
+def _common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n:
+        j = min(i + _DIFF_BLOCK, n)
+        if a[i:j] != b[i:j]:
+            while a[i] == b[i]:
+                i += 1
+            return i
+        i = j
+    return n
+
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    n = min(len(a), len(b), limit)
+    i = 0
+    while i < n:
+        j = min(i + _DIFF_BLOCK, n)
+        if a[len(a) - j:len(a) - i] != b[len(b) - j:len(b) - i]:
+            while a[len(a) - i - 1] == b[len(b) - i - 1]:
+                i += 1
+            return i
+        i = j
+    return n
+
+
+def _shift(span: _Span, delta: int) -> _Span:
+    kind, start, end, content_start, content_end = span
+    return kind, start + delta, end + delta, content_start + delta, content_end + delta
+
+
+class FormulaDocument:
+    """多公式文档的增量模型
+
+    保存每个公式的区间和转换结果。edit() 之后只从受影响的位置重新扫描，
+    扫描结果与旧区间重新对齐后即停止，后面的公式只平移偏移；
+    内容没变的公式直接沿用原来的输出。start/end 为相对整个文本的偏移。
+    """
+
+    def __init__(self, text: str = "", convert: Callable[[str], str] = latex_to_unicodemath) -> None:
+        self._convert = convert
+        self.text = ""
+        self._spans: List[_Span] = []
+        self._contents: List[str] = []
+        self._outputs: List[str] = []
+        # unclosed delimiters passed over as text; whether they close depends
+        # on everything after them, so an edit anywhere later can change them
+        self._skipped: List[int] = []
+        self.edit(0, 0, text)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def outputs(self) -> List[str]:
+        return list(self._outputs)
+
+    def formulas(self) -> List[Dict[str, str]]:
+        """字段与 extract_all_formulas 的结果相同的字典列表，另含 'output' 转换结果"""
+        return [
+            {
+                'content': content,
+                'type': kind,
+                'display_mode': 'inline' if kind == 'inline' else 'display',
+                'start': start,
+                'end': end,
+                'output': output
+            }
+            for (kind, start, end, _, _), content, output
+            in zip(self._spans, self._contents, self._outputs)
+        ]
+
+    def set_text(self, text: str) -> range:
+        """用新的全文更新文档，自动找出改动的区间后调用 edit()"""
+        prefix = _common_prefix(self.text, text)
+        suffix = _common_suffix(self.text, text, min(len(self.text), len(text)) - prefix)
+        return self.edit(prefix, len(self.text) - suffix, text[prefix:len(text) - suffix])
+
+    def edit(self, start: int, end: int, new_text: str) -> range:
+        """把 text[start:end] 替换为 new_text，返回重新扫描过的公式下标范围"""
+        old = self.text
+        if not 0 <= start <= end <= len(old):
+            raise ValueError(f"编辑区间越界：[{start}, {end})，文本长度 {len(old)}")
+        text = old[:start] + new_text + old[end:]
+        delta = len(new_text) - (end - start)
+        edit_end = start + len(new_text)
+        spans = self._spans
+
+        # Successful matches read at most one character past their end, so a
+        # formula ending before `start` is unaffected -- unless an unclosed
+        # delimiter before the edit could now pair with new text
+        threshold = start
+        if self._skipped and self._skipped[0] < start:
+            threshold = self._skipped[0] + 1
+        first = bisect_left(spans, threshold, key=lambda s: s[2])
+        pos = spans[first - 1][2] if first else 0
+
+        # Re-scan until a new span coincides with a shifted old span past the edit;
+        # from there on both scans are in the same state over the same text
+        new_spans: List[_Span] = []
+        skipped: List[int] = []
+        sync = len(spans)
+        window = _RESCAN_WINDOW
+        while True:
+            stop = min(max(edit_end, pos) + window, len(text))
+            found, pos = _scan_formulas(text, pos, True, stop=stop, skipped=skipped)
+            for span in found:
+                if span[1] >= edit_end:
+                    j = bisect_left(spans, span[1] - delta, lo=first, key=lambda s: s[1])
+                    if j < len(spans) and _shift(spans[j], delta) == span:
+                        sync = j
+                        break
+                new_spans.append(span)
+            if sync < len(spans) or stop >= len(text):
+                break
+            window *= 2
+
+        # unclosed delimiters never precede the re-scan start (see threshold), so
+        # the re-scan replaces them up to the synchronisation point; shift the rest
+        if sync < len(spans):
+            sync_end = spans[sync][2]
+            skipped = [u for u in skipped if u < sync_end + delta]
+            tail = self._skipped[bisect_left(self._skipped, sync_end):]
+            skipped.extend(u + delta for u in tail)
+        self._skipped = skipped
+
+        # reuse outputs of re-scanned formulas whose content did not change
+        reusable = dict(zip(self._contents[first:sync], self._outputs[first:sync]))
+        contents = [text[cs:ce].strip() for _, _, _, cs, ce in new_spans]
+        outputs = []
+        for content in contents:
+            output = reusable.get(content)
+            if output is None:
+                output = self._convert(content)
+                reusable[content] = output
+            outputs.append(output)
+
+        self.text = text
+        tail_spans = [_shift(span, delta) for span in spans[sync:]] if delta else spans[sync:]
+        self._spans = spans[:first] + new_spans + tail_spans
+        self._contents[first:sync] = contents
+        self._outputs[first:sync] = outputs
+        return range(first, first + len(new_spans))
@@ -0,0 +1,46 @@
+import re
+from typing import List, Tuple
+
+# Token kinds
+CONTROL_WORD = "cw"      # \alpha, \frac ... (value: name without backslash)
+CONTROL_SYMBOL = "cs"    # \, \{ \\ ... (value: the single char after backslash)
+GROUP_OPEN = "{"
+GROUP_CLOSE = "}"
+SUP = "^"
+SUB = "_"
+TEXT = "text"           # plain text run, including whitespace
+
+# (kind, value, start, end)
+Token = Tuple[str, str, int, int]
+
+# Every character belongs to exactly one token, so the tokens of a formula
+# concatenate back to the formula and the kind follows from the first chars
+_TOKEN_RE = re.compile(r"\\[A-Za-z]+|\\[\s\S]?|[{}^_]|[^\\{}^_]+")
+
+_LETTERS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+_SINGLE_KINDS = {"{": GROUP_OPEN, "}": GROUP_CLOSE, "^": SUP, "_": SUB}
+
+
+def split(latex: str) -> List[str]:
+    """将 LaTeX 公式一次性切分为记号原文列表（拼接后即为原公式）"""
+    return _TOKEN_RE.findall(latex)
+
+
+def token_kind(token: str) -> str:
+    """由记号原文判断记号类型"""
+    if token[0] == "\\":
+        return CONTROL_WORD if token[1:2] in _LETTERS else CONTROL_SYMBOL
+    return _SINGLE_KINDS.get(token, TEXT)
+
+
+def tokenize(latex: str) -> List[Token]:
+    """将 LaTeX 公式一次性切分为控制序列、分组、上下标和文本记号"""
+    tokens = []
+    pos = 0
+    for token in split(latex):
+        end = pos + len(token)
+        kind = token_kind(token)
+        value = token[1:] if kind == CONTROL_WORD or kind == CONTROL_SYMBOL else token
+        tokens.append((kind, value, pos, end))
+        pos = end
+    return tokens
@@ -0,0 +1,406 @@
+import re
+from typing import Any, Dict, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+from latex_lexer import _LETTERS, split
+from lazy_re import compile_lazy
+
+# A body token: source text, or the index of a parameter (#1 -> 0)
+Piece = Union[str, int]
+
+_CONTROL_WORD_RE = re.compile(r"\\[A-Za-z]+")
+# Definition commands, parsed from the source text when definitions are collected
+_DEFINITION_RE = compile_lazy(
+    r"\\(newcommand|renewcommand|providecommand|DeclareMathOperator|def)(?![A-Za-z])(\*?)")
+_NARGS_RE = compile_lazy(r"\[\s*([0-9])\s*\]")
+_DEF_PARAMS_RE = compile_lazy(r"(?:#[1-9])*")
+_PARAM_RE = compile_lazy(r"#([1-9])")
+
+
+class MacroError(ValueError):
+    """宏定义无效，或展开时出现循环定义、超出深度或长度限制"""
+
+
+class MacroDefinition(NamedTuple):
+    name: str                 # control word with backslash, e.g. "\\norm"
+    body: str                 # replacement text, parameters written as #1..#9
+    nargs: int = 0
+    default: Optional[str] = None  # default of an optional first argument
+
+
+def has_definitions(text: str) -> bool:
+    """文本中是否可能含有宏定义（只做子串判断，供调用方跳过收集）"""
+    return "command" in text or "\\DeclareMathOperator" in text or "\\def" in text
+
+
+def _skip_ws(s: str, pos: int) -> int:
+    n = len(s)
+    while pos < n and s[pos].isspace():
+        pos += 1
+    return pos
+
+
+def _scan_to(s: str, pos: int, close: str) -> int:
+    # index just past the `close` that ends the group opened before pos, or -1
+    depth = 0
+    n = len(s)
+    while pos < n:
+        ch = s[pos]
+        if ch == "\\":
+            pos += 2
+            continue
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            if depth == 0:
+                return pos + 1 if close == "}" else -1
+            depth -= 1
+        elif ch == close and depth == 0:
+            return pos + 1
+        pos += 1
+    return -1
+
+
+def _parse_definition(s: str, match: "re.Match[str]") -> Optional[Tuple[int, str, MacroDefinition]]:
+    # (end, command, definition) of the definition starting at match, None if malformed
+    command, star = match.group(1), match.group(2)
+    pos = _skip_ws(s, match.end())
+    if s.startswith("{", pos):
+        end = _scan_to(s, pos + 1, "}")
+        if end < 0:
+            return None
+        name = s[pos + 1:end - 1].strip()
+        pos = end
+    else:
+        m = _CONTROL_WORD_RE.match(s, pos)
+        if m is None:
+            return None
+        name, pos = m.group(0), m.end()
+    if not _CONTROL_WORD_RE.fullmatch(name):
+        return None
+
+    nargs = 0
+    default = None
+    if command == "def":
+        params = _DEF_PARAMS_RE.match(s, pos)
+        nargs = params.group(0).count("#")
+        pos = params.end()
+    elif command != "DeclareMathOperator":
+        m = _NARGS_RE.match(s, _skip_ws(s, pos))
+        if m is not None:
+            nargs, pos = int(m.group(1)), m.end()
+            opt = _skip_ws(s, pos)
+            if nargs and s.startswith("[", opt):
+                end = _scan_to(s, opt + 1, "]")
+                if end < 0:
+                    return None
+                default, pos = s[opt + 1:end - 1], end
+
+    pos = _skip_ws(s, pos)
+    if not s.startswith("{", pos):
+        return None
+    end = _scan_to(s, pos + 1, "}")
+    if end < 0:
+        return None
+    body = s[pos + 1:end - 1]
+    if command == "DeclareMathOperator":
+        body = ("\\operatorname*{" if star else "\\operatorname{") + body + "}"
+    return end, command, MacroDefinition(name, body, nargs, default)
+
+
+def iter_definitions(text: str) -> Iterator[Tuple[int, int, str, MacroDefinition]]:
+    """逐个产出文本中的宏定义 (起始偏移, 结束偏移, 定义命令, 定义)
+
+    支持 \\newcommand、\\renewcommand、\\providecommand（可带 * 和可选参数默认值）、
+    \\DeclareMathOperator(*) 和 \\def\\name#1#2{...}；格式不完整的定义被跳过。
+    """
+    if not has_definitions(text):
+        return
+    pos = 0
+    while True:
+        match = _DEFINITION_RE.search(text, pos)
+        if match is None:
+            return
+        parsed = _parse_definition(text, match)
+        if parsed is None:
+            pos = match.end()
+            continue
+        end, command, definition = parsed
+        yield match.start(), end, command, definition
+        pos = end
+
+
+def strip_definitions(latex: str) -> str:
+    """删除公式中的宏定义（与 TeX 一样，定义本身不产生输出）"""
+    parts = []
+    pos = 0
+    for start, end, _, _ in iter_definitions(latex):
+        parts.append(latex[pos:start])
+        pos = end
+    if not pos:
+        return latex
+    parts.append(latex[pos:])
+    return "".join(parts)
+
+
+def _body_pieces(body: str) -> List[Piece]:
+    pieces: List[Piece] = []
+    for tok in split(body):
+        if "#" not in tok or tok[0] == "\\":
+            pieces.append(tok)
+            continue
+        # "#1+#2" -> 0, "+", 1
+        for i, part in enumerate(_PARAM_RE.split(tok)):
+            if i % 2:
+                pieces.append(int(part) - 1)
+            elif part:
+                pieces.append(part)
+    return pieces
+
+
+def _read_argument(toks: List[Any], i: int) -> Tuple[int, List[Any]]:
+    # one undelimited argument starting at toks[i]: a {...} group (braces
+    # dropped), a control sequence or a single character; toks may be updated
+    n = len(toks)
+    while i < n:
+        tok = toks[i]
+        if tok.__class__ is int:
+            return i + 1, [tok]
+        head = tok[0]
+        if head == "{":
+            depth = 0
+            for j in range(i + 1, n):
+                t = toks[j]
+                if t == "{":
+                    depth += 1
+                elif t == "}":
+                    if depth == 0:
+                        return j + 1, toks[i + 1:j]
+                    depth -= 1
+            return n, toks[i + 1:]
+        if head == "}":
+            return i, []
+        if head == "\\" or head == "^" or head == "_":
+            return i + 1, [tok]
+        text = tok.lstrip()
+        if not text:
+            i += 1
+            continue
+        if len(text) > 1:
+            toks[i] = text[1:]
+        else:
+            i += 1
+        return i, [text[0]]
+    return i, []
+
+
+def _read_optional(toks: List[Any], i: int) -> Tuple[int, Optional[List[Any]]]:
+    # a [...] argument starting at toks[i], None if there is none
+    n = len(toks)
+    if i >= n or toks[i].__class__ is int or toks[i][0] in "\\{}^_":
+        return i, None
+    first = toks[i].lstrip()
+    if not first.startswith("["):
+        return i, None
+    if len(first) > 1:
+        toks[i] = first[1:]
+    else:
+        i += 1
+    arg: List[Any] = []
+    depth = 0
+    for j in range(i, n):
+        t = toks[j]
+        if t == "{":
+            depth += 1
+        elif t == "}":
+            depth -= 1
+        elif depth == 0 and t.__class__ is str and t[0] != "\\" and "]" in t:
+            text, _, rest = t.partition("]")
+            if text:
+                arg.append(text)
+            if rest:
+                toks[j] = rest
+                return j, arg
+            return j + 1, arg
+        arg.append(t)
+    return n, arg
+
+
+def _separate(out: List[Any], first: Any) -> None:
+    # keep "\alpha" + "b" from lexing as "\alphab" once the tokens are joined
+    if out and first.__class__ is str and first[0] in _LETTERS:
+        last = out[-1]
+        if last.__class__ is str and last[0] == "\\" and last[1:2] in _LETTERS:
+            out.append(" ")
+
+
+class MacroRegistry:
+    """宏定义表：收集 \\newcommand 等定义，并在转换前展开公式中的宏
+
+    定义的宏体在第一次展开时统一预展开（宏体中引用的其他宏被提前替换），
+    此后展开一个公式只需切分一次记号、逐个查表并代入参数，不做任何正则替换；
+    公式中没有用到已定义的宏时原样返回。参数先展开再代入宏体。
+    嵌套展开超过 max_depth 层（通常是循环定义）或结果超过 max_tokens 个记号时
+    抛出 MacroError。
+
+        macros = MacroRegistry()
+        macros.collect(r"\\newcommand{\\norm}[1]{\\left\\|#1\\right\\|}")
+        macros.expand(r"\\norm{x}")  # -> r"\\left\\|x\\right\\|"
+    """
+
+    def __init__(self, definitions: Optional[Mapping[str, str]] = None,
+                 max_depth: int = 32, max_tokens: int = 1 << 16) -> None:
+        if max_depth <= 0 or max_tokens <= 0:
+            raise ValueError("max_depth 和 max_tokens 必须为正数")
+        self.max_depth = max_depth
+        self.max_tokens = max_tokens
+        self._macros: Dict[str, MacroDefinition] = {}
+        self._pieces: Dict[str, List[Piece]] = {}
+        # pre-expanded bodies; rebuilt as a whole after any definition changes
+        self._prepared: Optional[Dict[str, List[Piece]]] = None
+        if definitions:
+            for name, body in definitions.items():
+                self.define(name, body)
+
+    def define(self, name: str, body: str, nargs: int = 0, default: Optional[str] = None) -> None:
+        """定义（或重新定义）宏，body 中以 #1..#9 引用参数；default 为可选首参数的默认值"""
+        if not _CONTROL_WORD_RE.fullmatch(name):
+            raise MacroError(f"无效的宏名：{name!r}（应形如 \\name）")
+        if not 0 <= nargs <= 9:
+            raise MacroError(f"{name} 的参数个数应为 0-9，实际为 {nargs}")
+        if default is not None and nargs == 0:
+            raise MacroError(f"{name} 没有参数，不能指定可选参数默认值")
+        pieces = _body_pieces(body)
+        used = max((p for p in pieces if p.__class__ is int), default=-1)
+        if used >= nargs:
+            raise MacroError(f"{name} 只有 {nargs} 个参数，宏体却引用了 #{used + 1}")
+        self._macros[name] = MacroDefinition(name, body, nargs, default)
+        self._pieces[name] = pieces
+        self._prepared = None
+
+    def declare_operator(self, name: str, text: str, limits: bool = False) -> None:
+        """相当于 \\DeclareMathOperator{name}{text}，limits 为 True 时相当于带 * 的版本"""
+        self.define(name, ("\\operatorname*{" if limits else "\\operatorname{") + text + "}")
+
+    def collect(self, text: str) -> int:
+        """收集文本（整篇文档或单个公式）中的全部宏定义，返回收集到的个数
+
+        \\providecommand 不覆盖已有定义；宏体引用了不存在的参数等无效定义被跳过。
+        """
+        count = 0
+        for _, _, command, definition in iter_definitions(text):
+            if command == "providecommand" and definition.name in self._macros:
+                continue
+            try:
+                self.define(*definition)
+            except MacroError:
+                continue
+            count += 1
+        return count
+
+    def copy(self) -> "MacroRegistry":
+        registry = MacroRegistry(max_depth=self.max_depth, max_tokens=self.max_tokens)
+        registry._macros = dict(self._macros)
+        registry._pieces = dict(self._pieces)
+        registry._prepared = self._prepared
+        return registry
+
+    def definitions(self) -> List[MacroDefinition]:
+        return list(self._macros.values())
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._macros
+
+    def __len__(self) -> int:
+        return len(self._macros)
+
+    def expand(self, latex: str) -> str:
+        """展开公式中的宏并删除其中的宏定义，没有用到宏时原样返回"""
+        if has_definitions(latex):
+            latex = strip_definitions(latex)
+        if self._macros.keys().isdisjoint(_CONTROL_WORD_RE.findall(latex)):
+            return latex
+        prepared = self._prepare()
+        return "".join(self._expand(split(latex), prepared, 0))
+
+    def _prepare(self) -> Dict[str, List[Piece]]:
+        prepared = self._prepared
+        if prepared is None:
+            prepared = {}
+            for name in self._macros:
+                self._prepare_one(name, prepared, [])
+            # published in one assignment, so concurrent callers never see a partial table
+            self._prepared = prepared
+        return prepared
+
+    def _prepare_one(self, name: str, prepared: Dict[str, List[Piece]], active: List[str]) -> List[Piece]:
+        pieces = prepared.get(name)
+        if pieces is not None:
+            return pieces
+        if name in active:
+            chain = " -> ".join(active[active.index(name):] + [name])
+            raise MacroError(f"宏循环定义：{chain}")
+        if len(active) >= self.max_depth:
+            raise MacroError(f"宏展开超过 {self.max_depth} 层：{' -> '.join(active)}")
+        active.append(name)
+        # macros used by the body are prepared first, then substituted as-is
+        for piece in self._pieces[name]:
+            if piece in self._macros:
+                self._prepare_one(piece, prepared, active)
+        pieces = prepared[name] = self._expand(list(self._pieces[name]), prepared, len(active))
+        active.pop()
+        return pieces
+
+    def _expand(self, toks: List[Any], prepared: Dict[str, List[Piece]], depth: int) -> List[Any]:
+        get = self._macros.get  # parameter pieces are ints and never match
+        out: List[Any] = []
+        start = 0  # first token of the literal run not yet copied to out
+        i = 0
+        n = len(toks)
+        while i < n:
+            macro = get(toks[i])
+            i += 1
+            if macro is None:
+                continue
+            if start < i - 1:
+                _separate(out, toks[start])
+                out += toks[start:i - 1]
+            body = prepared[macro.name]
+            if macro.nargs:
+                if depth >= self.max_depth:
+                    raise MacroError(f"宏展开超过 {self.max_depth} 层：{macro.name}")
+                args: List[List[Any]] = []
+                if macro.default is not None:
+                    i, opt = _read_optional(toks, i)
+                    args.append(self._expand(split(macro.default) if opt is None else opt,
+                                             prepared, depth + 1))
+                while len(args) < macro.nargs:
+                    i, arg = _read_argument(toks, i)
+                    args.append(self._expand(arg, prepared, depth + 1))
+                for piece in body:
+                    if piece.__class__ is int:
+                        arg = args[piece]
+                        if arg:
+                            _separate(out, arg[0])
+                            out += arg
+                    else:
+                        _separate(out, piece)
+                        out.append(piece)
+            elif body:
+                _separate(out, body[0])
+                out += body
+            if len(out) > self.max_tokens:
+                raise MacroError(f"宏展开结果超过 {self.max_tokens} 个记号")
+            start = i
+        if not start:
+            return toks
+        if start < n:
+            _separate(out, toks[start])
+            out += toks[start:]
+        return out
+
+
+def collect_macros(text: str, base: Optional[MacroRegistry] = None) -> MacroRegistry:
+    """收集 text 中的宏定义，返回新的定义表（在 base 的副本上添加，不修改 base）"""
+    registry = base.copy() if base is not None else MacroRegistry()
+    registry.collect(text)
+    return registry
@@ -0,0 +1,497 @@
+from itertools import accumulate
+from typing import Any, Dict, FrozenSet, List, Optional, Union
+
+from latex_lexer import _LETTERS, split
+
+# Commands that take braced (or single-token) arguments
+ARG_COUNTS: Dict[str, int] = {
+    "frac": 2, "dfrac": 2, "tfrac": 2, "binom": 2,
+    "sqrt": 1,
+    "text": 1, "mathrm": 1, "operatorname": 1,
+    "mathbb": 1,
+    "bar": 1, "overline": 1, "hat": 1, "dot": 1, "ddot": 1, "vec": 1,
+}
+# Commands taking an optional [..] argument before the required ones
+OPTIONAL_ARG: FrozenSet[str] = frozenset(["sqrt"])
+# Commands accepting a trailing * (\operatorname*)
+STARRED: FrozenSet[str] = frozenset(["operatorname"])
+# Large operators that own a directly following subscript
+LIMIT_OPS: FrozenSet[str] = frozenset(["sum", "prod", "lim"])
+# \begin{...} environments parsed into rows (\\) and cells (&)
+ENVIRONMENTS: FrozenSet[str] = frozenset([
+    "matrix", "pmatrix", "bmatrix", "Bmatrix", "vmatrix", "Vmatrix", "smallmatrix", "array",
+    "cases", "aligned", "align", "align*", "alignat", "alignat*", "alignedat",
+    "gathered", "gather", "gather*", "split", "eqnarray", "eqnarray*",
+])
+# Environments whose \begin{...} is followed by a {..} column spec or column count
+SPEC_ARG: FrozenSet[str] = frozenset(["array", "alignat", "alignat*", "alignedat"])
+# Layout commands dropped directly inside an environment (rules, equation numbers)
+ROW_MARKUP: FrozenSet[str] = frozenset(["hline", "nonumber", "notag"])
+
+
+class Group:
+    """一组节点：根、花括号分组或单记号参数"""
+
+    __slots__ = ("items", "braced", "bare", "closed", "raw_len")
+
+    def __init__(self, items: List["Node"], braced: bool = True, bare: bool = False,
+                 closed: bool = True, raw_len: int = 0) -> None:
+        self.items = items
+        self.braced = braced      # written as {...} in the source
+        self.bare = bare          # a plain {...} in a sequence, not an argument
+        self.closed = closed      # False if the source ended before "}"
+        self.raw_len = raw_len    # length of the source between the braces
+
+    def __repr__(self) -> str:
+        return f"Group({self.items!r}, braced={self.braced}, bare={self.bare})"
+
+
+class Command:
+    """控制序列及其参数
+
+    name 为源码中的控制序列（含反斜杠，如 "\\frac"、"\\,"），
+    为 "^"/"_" 时表示上下标。
+    """
+
+    __slots__ = ("name", "args", "opt")
+
+    def __init__(self, name: str, args: Optional[List[Optional[Group]]] = None,
+                 opt: Optional[Group] = None) -> None:
+        self.name = name
+        self.args = args if args is not None else []
+        self.opt = opt
+
+    def __repr__(self) -> str:
+        return f"Command({self.name!r}, {self.args!r}, opt={self.opt!r})"
+
+
+class Environment:
+    """\\begin{name}...\\end{name} 环境，rows 为行列表，每行是各单元格的 Group"""
+
+    __slots__ = ("name", "rows", "closed")
+
+    def __init__(self, name: str, rows: List[List[Group]], closed: bool = True) -> None:
+        self.name = name
+        self.rows = rows
+        self.closed = closed      # False if the source ended before \end
+
+    def __repr__(self) -> str:
+        return f"Environment({self.name!r}, {self.rows!r})"
+
+
+Node = Union[str, Group, Command, Environment]
+
+class AstBuilder:
+    """默认构建器：把解析结果组装成 Group / Command 语法树
+
+    解析器只通过 group / command / environment / root 四个回调产出结果，换用其他构建器
+    （例如直接拼接输出字符串）即可在一次解析中完成转换，不必先建树再遍历。
+    """
+
+    @staticmethod
+    def group(items: List[Any], braced: bool, bare: bool, closed: bool, raw_len: int) -> Group:
+        return Group(items, braced, bare, closed, raw_len)
+
+    @staticmethod
+    def command(name: str, args: List[Any], opt: Any) -> Command:
+        return Command(name, args, opt)
+
+    @staticmethod
+    def environment(name: str, rows: List[List[Any]], closed: bool) -> Environment:
+        return Environment(name, rows, closed)
+
+    @staticmethod
+    def root(items: List[Any]) -> Group:
+        return Group(items, braced=False)
+
+
+# First characters of the non-text tokens produced by latex_lexer.split
+_SPECIAL = frozenset("\\{}^_")
+
+# Frame kinds of the explicit parse stack
+_SEQ = 0       # root or {...}: collects items until "}" / end of input
+_BRACKET = 1   # [...] optional argument: collects items until "]"
+_ENV = 2       # \begin{..}: collects the items of the current cell until & / \\ / \end
+_ONE = 3       # single-token argument: wraps exactly one item
+_CMD = 4       # command waiting for its arguments
+
+
+class _Frame:
+    __slots__ = ("kind", "items", "bare", "open_end", "name", "args", "opt", "remaining",
+                 "rows", "row")
+
+    def __init__(self, kind: int, items: Optional[List[Any]] = None, bare: bool = False,
+                 open_end: int = 0) -> None:
+        self.kind = kind
+        self.items = items
+        self.bare = bare
+        self.open_end = open_end  # index of the first token inside the group / argument
+
+
+def _command_frame(name: str, count: int) -> _Frame:
+    frame = _Frame(_CMD)
+    frame.name = name
+    frame.args = []
+    frame.opt = None
+    frame.remaining = count
+    return frame
+
+
+class _Parser:
+    __slots__ = ("toks", "offsets", "pos", "n", "stack", "group", "command", "environment")
+
+    def __init__(self, toks: List[str], builder: Any) -> None:
+        # toks is consumed in place; offsets keep the source position of each token
+        self.toks = toks
+        self.offsets = [0, *accumulate(map(len, toks))]
+        self.pos = 0
+        self.n = len(toks)
+        self.stack: List[_Frame] = []
+        self.group = builder.group
+        self.command = builder.command
+        self.environment = builder.environment
+
+    def run(self) -> List[Any]:
+        root = _Frame(_SEQ, [])
+        stack = self.stack
+        stack.append(root)
+        toks = self.toks
+        n = self.n
+        while True:
+            top = stack[-1]
+            frame_kind = top.kind
+            if frame_kind == _CMD:
+                self._request_arg()
+                continue
+            pos = self.pos
+            if pos >= n:
+                if top is root:
+                    return root.items
+                self._unwind(top)
+                continue
+            tok = toks[pos]
+            self.pos = pos + 1
+            head = tok[0]
+            if head not in _SPECIAL:
+                # only sequences and [..] read text directly; arguments take it in _request_arg
+                if frame_kind == _BRACKET and "]" in tok:
+                    text, _, rest = tok.partition("]")
+                    if text:
+                        top.items.append(text)
+                    if rest:
+                        self.pos = pos
+                        toks[pos] = rest
+                    self._finish_bracket()
+                elif frame_kind == _ENV and "&" in tok:
+                    text, _, rest = tok.partition("&")
+                    if text:
+                        top.items.append(text)
+                    if rest:
+                        self.pos = pos
+                        toks[pos] = rest
+                    self._end_cell(top)
+                else:
+                    top.items.append(tok)
+            elif head == "\\":
+                if tok[1:2] in _LETTERS:
+                    self._control_word(tok)
+                elif frame_kind == _ENV and tok == "\\\\":
+                    self._end_cell(top)
+                    top.rows.append(top.row)
+                    top.row = []
+                    self._skip_row_spacing()
+                elif frame_kind == _SEQ:
+                    top.items.append(self.command(tok, [], None))
+                else:
+                    self._deliver(self.command(tok, [], None))
+            elif head == "{":
+                stack.append(_Frame(_SEQ, [], True, pos + 1))
+            elif head == "}":
+                if frame_kind == _BRACKET:
+                    # unterminated [..]; leave "}" for the enclosing group
+                    self.pos = pos
+                    self._finish_bracket()
+                elif frame_kind == _ENV:
+                    # likewise for an environment missing its \end
+                    self.pos = pos
+                    self._finish_environment(False)
+                elif top is root:
+                    root.items.append("}")
+                else:
+                    stack.pop()
+                    raw_len = self.offsets[pos] - self.offsets[top.open_end]
+                    self._deliver(self.group(top.items, True, top.bare, True, raw_len))
+            else:
+                nxt = toks[pos + 1] if pos + 1 < n else "\\"
+                if nxt[0] in _SPECIAL or nxt[0].isspace():
+                    stack.append(_command_frame(head, 1))
+                    continue
+                # common case x^2 / a_i: the argument is the next character
+                if len(nxt) > 1:
+                    toks[pos + 1] = nxt[1:]
+                else:
+                    self.pos = pos + 2
+                item = self.command(head, [self.group([nxt[0]], False, False, True, 1)], None)
+                if frame_kind == _SEQ:
+                    top.items.append(item)
+                else:
+                    self._deliver(item)
+
+    def _control_word(self, tok: str) -> None:
+        name = tok[1:]
+        if name in ROW_MARKUP and self.stack[-1].kind == _ENV:
+            return
+        if name == "begin" and self._begin():
+            return
+        if name == "end" and self.stack[-1].kind == _ENV:
+            # the name after \end is not checked: it closes the innermost environment
+            pos = self._after_ws()
+            if self._braced_word(pos) is not None:
+                self.pos = pos + 3
+            self._finish_environment(True)
+            return
+        count = ARG_COUNTS.get(name)
+        if count is not None:
+            if name in STARRED:
+                self._skip_star()
+            self.stack.append(_command_frame(tok, count))
+            if name in OPTIONAL_ARG:
+                self._open_bracket()
+            return
+        if name in LIMIT_OPS:
+            pos = self._after_ws()
+            if pos < self.n and self.toks[pos] == "_":
+                self.pos = pos + 1
+                self.stack.append(_command_frame(tok, 1))
+                return
+        top = self.stack[-1]
+        if top.kind == _SEQ:
+            top.items.append(self.command(tok, [], None))
+        else:
+            self._deliver(self.command(tok, [], None))
+
+    def _deliver(self, item: Any) -> None:
+        # hand a finished item to the frame on top; completed frames cascade
+        stack = self.stack
+        while True:
+            top = stack[-1]
+            kind = top.kind
+            if kind <= _ENV:
+                if item is not None:
+                    top.items.append(item)
+                return
+            if kind == _ONE:
+                stack.pop()
+                if item is not None:
+                    raw_len = self.offsets[self.pos] - self.offsets[top.open_end]
+                    item = self.group([item], False, False, True, raw_len)
+                continue
+            top.args.append(item)
+            top.remaining -= 1
+            if top.remaining > 0:
+                return
+            stack.pop()
+            item = self.command(top.name, top.args, top.opt)
+
+    def _request_arg(self) -> None:
+        toks = self.toks
+        while self.pos < self.n:
+            tok = toks[self.pos]
+            head = tok[0]
+            if head not in _SPECIAL:
+                text = tok.lstrip()
+                if not text:
+                    self.pos += 1
+                    continue
+                # take one character, leave the rest of the run in place
+                if len(text) > 1:
+                    toks[self.pos] = text[1:]
+                else:
+                    self.pos += 1
+                self._deliver(self.group([text[0]], False, False, True, 1))
+            elif head == "{":
+                self.pos += 1
+                self.stack.append(_Frame(_SEQ, [], False, self.pos))
+            elif head == "\\":
+                self.stack.append(_Frame(_ONE, None, False, self.pos))
+            else:
+                self._deliver(None)
+            return
+        self._deliver(None)
+
+    def _unwind(self, top: _Frame) -> None:
+        # end of input inside an open frame
+        if top.kind == _BRACKET:
+            self._finish_bracket()
+            return
+        if top.kind == _ENV:
+            self._finish_environment(False)
+            return
+        self.stack.pop()
+        if top.kind == _SEQ:
+            raw_len = self.offsets[self.n] - self.offsets[top.open_end]
+            self._deliver(self.group(top.items, True, top.bare, False, raw_len))
+
+    def _after_ws(self) -> int:
+        # index of the next token, skipping one whitespace-only text run
+        pos = self.pos
+        if pos < self.n and self.toks[pos].isspace():
+            return pos + 1
+        return pos
+
+    def _open_bracket(self) -> None:
+        if self.pos >= self.n:
+            return
+        tok = self.toks[self.pos]
+        if tok[0] in _SPECIAL:
+            return
+        text = tok.lstrip()
+        if not text.startswith("["):
+            return
+        if len(text) > 1:
+            self.toks[self.pos] = text[1:]
+        else:
+            self.pos += 1
+        self.stack.append(_Frame(_BRACKET, []))
+
+    def _finish_bracket(self) -> None:
+        frame = self.stack.pop()
+        self.stack[-1].opt = self.group(frame.items, False, False, True, 0)
+
+    def _braced_word(self, pos: int) -> Optional[str]:
+        # the text of a "{word}" starting at toks[pos], None if there is none
+        toks = self.toks
+        if pos + 2 < self.n and toks[pos] == "{" and toks[pos + 2] == "}" and toks[pos + 1][0] not in _SPECIAL:
+            return toks[pos + 1].strip()
+        return None
+
+    def _begin(self) -> bool:
+        # \begin{name} of a known environment: push its frame; False leaves
+        # \begin to be emitted as a plain command
+        pos = self._after_ws()
+        name = self._braced_word(pos)
+        if name not in ENVIRONMENTS:
+            return False
+        self.pos = pos + 3
+        if name in SPEC_ARG:
+            self._skip_group()
+        frame = _Frame(_ENV, [])
+        frame.name = name
+        frame.rows = []
+        frame.row = []
+        self.stack.append(frame)
+        return True
+
+    def _skip_group(self) -> None:
+        pos = self._after_ws()
+        toks = self.toks
+        if pos >= self.n or toks[pos] != "{":
+            return
+        depth = 0
+        while pos < self.n:
+            tok = toks[pos]
+            pos += 1
+            if tok == "{":
+                depth += 1
+            elif tok == "}":
+                depth -= 1
+                if not depth:
+                    break
+        self.pos = pos
+
+    def _skip_row_spacing(self) -> None:
+        # the optional [dim] after \\ is vertical spacing, not part of the next cell
+        toks = self.toks
+        pos = self.pos
+        if pos >= self.n or toks[pos][0] in _SPECIAL or toks[pos].lstrip()[:1] != "[":
+            return
+        while pos < self.n:
+            tok = toks[pos]
+            if tok[0] not in _SPECIAL and "]" in tok:
+                rest = tok.partition("]")[2]
+                if rest:
+                    toks[pos] = rest
+                    self.pos = pos
+                else:
+                    self.pos = pos + 1
+                return
+            pos += 1
+
+    def _end_cell(self, frame: _Frame) -> None:
+        frame.row.append(self.group(frame.items, False, False, True, 0))
+        frame.items = []
+
+    def _finish_environment(self, closed: bool) -> None:
+        frame = self.stack.pop()
+        # a trailing \\ before \end does not open another row
+        if frame.row or any(item.__class__ is not str or not item.isspace() for item in frame.items):
+            self._end_cell(frame)
+            frame.rows.append(frame.row)
+        self._deliver(self.environment(frame.name, frame.rows, closed))
+
+    def _skip_star(self) -> None:
+        if self.pos < self.n:
+            tok = self.toks[self.pos]
+            if tok[0] == "*":
+                if len(tok) > 1:
+                    self.toks[self.pos] = tok[1:]
+                else:
+                    self.pos += 1
+
+
+def build(latex: str, builder: Any) -> Any:
+    """解析 LaTeX 公式，由 builder 的回调直接组装结果（见 AstBuilder）"""
+    return builder.root(_Parser(split(latex), builder).run())
+
+
+def build_tokens(tokens: List[str], builder: Any) -> Any:
+    """与 build 相同，但输入为 latex_lexer.split 切分好的记号"""
+    return builder.root(_Parser(tokens, builder).run())
+
+
+def _children(node: Any) -> List[Any]:
+    if node.__class__ is Group:
+        return node.items
+    if node.__class__ is Environment:
+        return [cell for row in node.rows for cell in row]
+    children = [arg for arg in node.args if arg is not None]
+    if node.opt is not None:
+        children.insert(0, node.opt)
+    return children
+
+
+def rebuild(root: Group, builder: Any) -> Any:
+    """把 parse() 得到的语法树按解析时的顺序交给 builder 的回调，得到与 build 相同的结果
+
+    迭代后序遍历，与嵌套深度无关。
+    """
+    results: List[Any] = []
+    work: List[Any] = [(item, False) for item in reversed(root.items)]
+    while work:
+        node, ready = work.pop()
+        if node.__class__ is str:
+            results.append(node)
+            continue
+        children = _children(node)
+        if not ready:
+            work.append((node, True))
+            work.extend((child, False) for child in reversed(children))
+            continue
+        count = len(children)
+        values = iter(results[len(results) - count:] if count else [])
+        del results[len(results) - count:]
+        if node.__class__ is Group:
+            value = builder.group(list(values), node.braced, node.bare, node.closed, node.raw_len)
+        elif node.__class__ is Environment:
+            value = builder.environment(node.name, [[next(values) for _ in row] for row in node.rows],
+                                        node.closed)
+        else:
+            opt = next(values) if node.opt is not None else None
+            value = builder.command(node.name, [None if a is None else next(values) for a in node.args], opt)
+        results.append(value)
+    return builder.root(results)
+
+
+def parse(latex: str) -> Group:
+    """将 LaTeX 公式解析为语法树（显式栈实现，与嵌套深度无关，线性时间）"""
+    return build(latex, AstBuilder)
@@ -0,0 +1,307 @@
+from typing import Any, List, Optional
+
+from conversion_cache import cached
+from latex_parser import Group, build, rebuild
+from lazy_re import compile_lazy
+from latex_to_unicodemath import (
+    _ACCENT_MARKS,
+    _FRAC_CMDS,
+    _FUNC_TABLE,
+    _MATHBB_MAP,
+    _SPACING_CMDS,
+    _SYMBOL_TABLE,
+)
+
+# Office Math Markup Language namespace, bound to the "m" prefix by the caller
+OMML_NAMESPACE = "http://schemas.openxmlformats.org/officeDocument/2006/math"
+
+# n-ary operators; integrals take their limits to the side, the others under and over
+_NARY_OPS = {
+    "\\sum": "∑", "\\prod": "∏", "\\coprod": "∐", "\\bigcup": "⋃", "\\bigcap": "⋂",
+    "\\int": "∫", "\\iint": "∬", "\\iiint": "∭", "\\oint": "∮",
+}
+_SIDE_LIMITS = frozenset("∫∬∭∮")
+# escaped control symbols that stand for a character
+_ESCAPED_CHARS = {
+    "\\{": "{", "\\}": "}", "\\|": "‖", "\\%": "%", "\\$": "$", "\\&": "&", "\\#": "#", "\\_": "_",
+    "\\ ": " ",
+}
+# matrix environments and the brackets of the m:d around them
+_MATRIX_BRACKETS = {
+    "matrix": None, "smallmatrix": None, "array": None,
+    "pmatrix": ("(", ")"), "bmatrix": ("[", "]"), "Bmatrix": ("{", "}"),
+    "vmatrix": ("|", "|"), "Vmatrix": ("‖", "‖"),
+}
+# characters that are atoms of their own: an n-ary operand ends at the binary
+# and relational ones outside brackets
+_OPERATOR_CHARS = frozenset("+-=<>±∓×÷⋅·≤≥≠≈∼∝→←↔⇒⇐⇔∈∉⊂⊃⊆⊇∪∩,;:!|/()[]{}‖")
+_OPERAND_ENDS = frozenset("+-=<>±∓≤≥≠≈∼∝→←↔⇒⇐⇔∈∉⊂⊃⊆⊇,;:")
+_OPENING = frozenset("([{")
+_CLOSING = frozenset(")]}")
+# control characters XML 1.0 does not allow even as character references
+_XML_INVALID_CHARS = compile_lazy(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_TEXT = 0      # math run (italic letters)
+_UPRIGHT = 1   # upright run: function names, \mathrm
+_OPERATOR = 2  # a single operator character
+_XML = 3       # finished OMML element
+_NARY = 4      # n-ary operator waiting for its operand
+_LIMIT = 5     # lim with an under-limit
+_SUP = 6       # ^ script waiting for its base
+_SUB = 7       # _ script waiting for its base
+
+
+class _Atom:
+    """构建过程中的一个公式单元：文本、运算符、已完成的 OMML 元素或上下标"""
+
+    __slots__ = ("kind", "value", "plain", "sub", "sup")
+
+    def __init__(self, kind: int, value: str, plain: str = "", sub: Optional[str] = None,
+                 sup: Optional[str] = None) -> None:
+        self.kind = kind
+        self.value = value    # text of a run, or OMML for _XML and scripts
+        self.plain = plain    # best-effort plain text, used by \text and \mathrm
+        self.sub = sub
+        self.sup = sup
+
+
+def _escape(text: str) -> str:
+    text = _XML_INVALID_CHARS.sub("", text)
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def _run(text: str, style: str = "") -> str:
+    # xml:space is only needed to keep leading or trailing blanks (\text{if })
+    if text[:1].isspace() or text[-1:].isspace():
+        return f'<m:r>{style}<m:t xml:space="preserve">{_escape(text)}</m:t></m:r>'
+    return f"<m:r>{style}<m:t>{_escape(text)}</m:t></m:r>"
+
+
+_UPRIGHT_STYLE = '<m:rPr><m:sty m:val="p"/></m:rPr>'
+_NORMAL_TEXT_STYLE = '<m:rPr><m:nor/></m:rPr>'
+
+
+def _add_text(atoms: List[_Atom], text: str) -> None:
+    # whitespace is insignificant in math; operator characters become atoms of their own
+    start = -1
+    for i, ch in enumerate(text):
+        if ch in _OPERATOR_CHARS or ch.isspace():
+            if start >= 0:
+                atoms.append(_Atom(_TEXT, text[start:i], text[start:i]))
+                start = -1
+            if ch in _OPERATOR_CHARS:
+                atoms.append(_Atom(_OPERATOR, ch, ch))
+        elif start < 0:
+            start = i
+    if start >= 0:
+        atoms.append(_Atom(_TEXT, text[start:], text[start:]))
+
+
+def _attach(atoms: List[_Atom], script: _Atom) -> None:
+    # a script belongs to the last atom; only the last letter of a text run is its base
+    base = atoms[-1] if atoms else None
+    if base is not None and base.kind == _TEXT and len(base.value) > 1:
+        base.value, last = base.value[:-1], base.value[-1]
+        base.plain = base.value
+        base = _Atom(_TEXT, last, last)
+        atoms.append(base)
+    is_sub = script.kind == _SUB
+    if base is None or (base.sub if is_sub else base.sup) is not None:
+        base = _Atom(_TEXT, "")
+        atoms.append(base)
+    if is_sub:
+        base.sub = script.value
+    else:
+        base.sup = script.value
+
+
+def _operand_end(atoms: List[_Atom], start: int, stop: int) -> int:
+    # the operand of an n-ary operator runs to the next binary or relational
+    # operator outside brackets
+    depth = 0
+    for i in range(start, stop):
+        atom = atoms[i]
+        if atom.kind != _OPERATOR:
+            continue
+        ch = atom.value
+        if ch in _OPENING:
+            depth += 1
+        elif ch in _CLOSING:
+            depth -= 1
+            if depth < 0:
+                return i
+        elif depth == 0 and ch in _OPERAND_ENDS:
+            return i
+    return stop
+
+
+def _scripted(base: str, sub: Optional[str], sup: Optional[str]) -> str:
+    if sub is not None and sup is not None:
+        return f"<m:sSubSup><m:e>{base}</m:e><m:sub>{sub}</m:sub><m:sup>{sup}</m:sup></m:sSubSup>"
+    if sub is not None:
+        return f"<m:sSub><m:e>{base}</m:e><m:sub>{sub}</m:sub></m:sSub>"
+    if sup is not None:
+        return f"<m:sSup><m:e>{base}</m:e><m:sup>{sup}</m:sup></m:sSup>"
+    return base
+
+
+def _render(atoms: List[_Atom], start: int, stop: int) -> str:
+    parts = []
+    i = start
+    while i < stop:
+        atom = atoms[i]
+        i += 1
+        kind = atom.kind
+        if kind == _NARY:
+            end = _operand_end(atoms, i, stop)
+            char = atom.value
+            location = "subSup" if char in _SIDE_LIMITS else "undOvr"
+            props = f'<m:chr m:val="{char}"/><m:limLoc m:val="{location}"/>'
+            if atom.sub is None:
+                props += '<m:subHide m:val="1"/>'
+            if atom.sup is None:
+                props += '<m:supHide m:val="1"/>'
+            parts.append(f"<m:nary><m:naryPr>{props}</m:naryPr><m:sub>{atom.sub or ''}</m:sub>"
+                         f"<m:sup>{atom.sup or ''}</m:sup><m:e>{_render(atoms, i, end)}</m:e></m:nary>")
+            i = end
+            continue
+        if kind == _LIMIT:
+            base = f"<m:limLow><m:e>{_run('lim', _UPRIGHT_STYLE)}</m:e><m:lim>{atom.sub}</m:lim></m:limLow>"
+            parts.append(_scripted(base, None, atom.sup))
+            continue
+        if kind == _XML:
+            base = atom.value
+        elif kind == _UPRIGHT:
+            base = _run(atom.value, _UPRIGHT_STYLE)
+        else:
+            base = _run(atom.value) if atom.value else ""
+        parts.append(_scripted(base, atom.sub, atom.sup))
+    return "".join(parts)
+
+
+def _assemble(items: List[Any]) -> _Atom:
+    atoms: List[_Atom] = []
+    plain = []
+    for item in items:
+        if item.__class__ is str:
+            _add_text(atoms, item)
+            plain.append(item)
+            continue
+        kind = item.kind
+        if kind == _SUP or kind == _SUB:
+            _attach(atoms, item)
+            continue
+        if kind == _TEXT:
+            _add_text(atoms, item.value)
+        else:
+            atoms.append(item)
+        plain.append(item.plain)
+    return _Atom(_XML, _render(atoms, 0, len(atoms)), "".join(plain))
+
+
+def _delimited(body: str, opening: str, closing: str) -> str:
+    return (f'<m:d><m:dPr><m:begChr m:val="{_escape(opening)}"/><m:endChr m:val="{_escape(closing)}"/>'
+            f"</m:dPr><m:e>{body}</m:e></m:d>")
+
+
+def _matrix(rows: List[List[_Atom]], justify: List[str]) -> str:
+    columns = max((len(row) for row in rows), default=1) or 1
+    specs = "".join(
+        f'<m:mc><m:mcPr><m:count m:val="1"/><m:mcJc m:val="{justify[i % len(justify)]}"/></m:mcPr></m:mc>'
+        for i in range(columns)
+    )
+    body = "".join(
+        "<m:mr>" + "".join(f"<m:e>{cell.value}</m:e>" for cell in row)
+        + "<m:e/>" * (columns - len(row)) + "</m:mr>"
+        for row in rows
+    )
+    return f"<m:m><m:mPr><m:mcs>{specs}</m:mcs></m:mPr>{body}</m:m>"
+
+
+class _OmmlBuilder:
+    """解析器构建器：在解析过程中直接拼出 OMML，不生成语法树"""
+
+    @staticmethod
+    def group(items: List[Any], braced: bool, bare: bool, closed: bool, raw_len: int) -> _Atom:
+        return _assemble(items)
+
+    @staticmethod
+    def command(name: str, args: List[Optional[_Atom]], opt: Optional[_Atom]) -> _Atom:
+        if name == "^" or name == "_":
+            arg = args[0].value if args and args[0] is not None else ""
+            return _Atom(_SUP if name == "^" else _SUB, arg)
+        nary = _NARY_OPS.get(name)
+        if nary is not None:
+            return _Atom(_NARY, nary, nary, args[0].value if args and args[0] is not None else None)
+        if name == "\\lim":
+            if args and args[0] is not None:
+                return _Atom(_LIMIT, "lim", "lim", args[0].value)
+            return _Atom(_UPRIGHT, "lim", "lim")
+        if not args:
+            if name in _SPACING_CMDS:
+                return _Atom(_TEXT, "")
+            func = _FUNC_TABLE.get(name)
+            if func is not None:
+                return _Atom(_UPRIGHT, func, func)
+            char = _SYMBOL_TABLE.get(name) or _ESCAPED_CHARS.get(name) or name
+            return _Atom(_TEXT, char, char)
+        first = args[0]
+        if first is None:
+            return _Atom(_TEXT, name, name)
+        if name in _FRAC_CMDS or name == "\\binom":
+            second = args[1].value if args[1] is not None else ""
+            if name == "\\binom":
+                body = (f'<m:f><m:fPr><m:type m:val="noBar"/></m:fPr><m:num>{first.value}</m:num>'
+                        f"<m:den>{second}</m:den></m:f>")
+                return _Atom(_XML, _delimited(body, "(", ")"))
+            return _Atom(_XML, f"<m:f><m:num>{first.value}</m:num><m:den>{second}</m:den></m:f>")
+        if name == "\\sqrt":
+            if opt is not None and opt.value:
+                return _Atom(_XML, f"<m:rad><m:deg>{opt.value}</m:deg><m:e>{first.value}</m:e></m:rad>")
+            return _Atom(_XML, '<m:rad><m:radPr><m:degHide m:val="1"/></m:radPr><m:deg/>'
+                               f"<m:e>{first.value}</m:e></m:rad>")
+        if name == "\\text":
+            return _Atom(_XML, _run(first.plain, _NORMAL_TEXT_STYLE), first.plain)
+        if name == "\\mathrm" or name == "\\operatorname":
+            return _Atom(_UPRIGHT, first.plain.strip(), first.plain)
+        if name == "\\mathbb":
+            letter = first.plain.strip()
+            if letter in _MATHBB_MAP:
+                return _Atom(_TEXT, _MATHBB_MAP[letter], _MATHBB_MAP[letter])
+            return _Atom(_XML, _run(letter, '<m:rPr><m:scr m:val="double-struck"/></m:rPr>'), letter)
+        mark = _ACCENT_MARKS.get(name)
+        if mark is not None:
+            if name == "\\overline":
+                return _Atom(_XML, f'<m:bar><m:barPr><m:pos m:val="top"/></m:barPr><m:e>{first.value}</m:e></m:bar>')
+            return _Atom(_XML, f'<m:acc><m:accPr><m:chr m:val="{mark}"/></m:accPr><m:e>{first.value}</m:e></m:acc>')
+        return _Atom(_TEXT, name, name)
+
+    @staticmethod
+    def environment(name: str, rows: List[List[_Atom]], closed: bool) -> _Atom:
+        if name in _MATRIX_BRACKETS:
+            matrix = _matrix(rows, ["center"])
+            brackets = _MATRIX_BRACKETS[name]
+            return _Atom(_XML, _delimited(matrix, *brackets) if brackets else matrix)
+        if name == "cases":
+            return _Atom(_XML, _delimited(_matrix(rows, ["left"]), "{", ""))
+        # aligned and friends: right/left column pairs, as amsmath aligns them
+        return _Atom(_XML, _matrix(rows, ["right", "left"]))
+
+    @staticmethod
+    def root(items: List[Any]) -> str:
+        return "<m:oMath>" + _assemble(items).value + "</m:oMath>"
+
+
+@cached("omml")
+def latex_to_omml(latex: str) -> str:
+    """LaTeX 转 Word 原生公式（OMML），返回 <m:oMath> 元素
+
+    与 latex_to_unicodemath 共用解析器，在一次解析中直接生成 OMML；
+    m 前缀需在外层元素上绑定到 OMML_NAMESPACE。
+    """
+    return build(latex.replace("\r", ""), _OmmlBuilder)
+
+
+def ast_to_omml(root: Group) -> str:
+    """由 latex_parser.parse 得到的语法树生成 OMML，结果与 latex_to_omml 相同"""
+    return rebuild(root, _OmmlBuilder)
@@ -1,5 +1,12 @@
 import re
-from typing import Dict
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import conversion_profile
+from conversion_cache import cached
+from conversion_profile import run_stages
+from latex_lexer import split
+from latex_parser import Group, build, build_tokens, rebuild
+from lazy_re import compile_lazy
 
 # Common Greek and operator symbols
 _SYMBOLS: Dict[str, str] = {
@@ -25,23 +32,80 @@ _FUNCS = [
     "log", "ln", "exp", "max", "min",
 ]
 
-# Regex patterns
-_DEFOP_RE = re.compile(r"\\operatorname\*?\{([^}]+)\}")
-_FRAC_CAP_RE = re.compile(r"\\frac\s*\{([^}]*)\}\s*\{([^}]*)\}")
-_SQRT_RE = re.compile(r"\\sqrt\s*\{([^}]*)\}")
-_SQRT_N_RE = re.compile(r"\\sqrt\s*\[([^\]]+)\]\s*\{([^}]*)\}")
-_TEXT_RM_RE = re.compile(r"\\mathrm\s*\{([^}]*)\}")
-_TEXT_RE = re.compile(r"\\text\s*\{([^}]*)\}")
-_BINOM_RE = re.compile(r"\\binom\s*\{([^}]*)\}\s*\{([^}]*)\}")
-_MATHBB_RE = re.compile(r"\\mathbb\s*\{([A-Za-z])\}")
+# A control word is a maximal run of letters after the backslash, so a
+# lookup on the whole word is always the longest match (\to never eats \top)
+_CONTROL_WORD_RE = re.compile(r"\\[A-Za-z]+")
+
+
+class SymbolTable:
+    """控制词到替换文本的映射表
+
+    替换时只扫描一遍字符串：每个控制词整体匹配后查字典，
+    单字符开销与表的大小无关，可随时扩充条目。
+    """
+
+    def __init__(self, mapping: Optional[Mapping[str, str]] = None) -> None:
+        self._map: Dict[str, str] = {}
+        if mapping:
+            self.update(mapping)
+
+    def update(self, mapping: Mapping[str, str]) -> None:
+        for key in mapping:
+            if not _CONTROL_WORD_RE.fullmatch(key):
+                raise ValueError(f"无效的控制词：{key!r}（应形如 \\name）")
+        self._map.update(mapping)
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self._map.get(name, default)
+
+    def items(self):
+        return self._map.items()
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._map
+
+    def __len__(self) -> int:
+        return len(self._map)
+
+    def sub(self, s: str) -> str:
+        lookup = self._map.get
+        return _CONTROL_WORD_RE.sub(lambda m: lookup(m.group(0), m.group(0)), s)
+
+
+_SYMBOL_TABLE = SymbolTable(_SYMBOLS)
+_FUNC_TABLE = SymbolTable({"\\" + fn: fn for fn in _FUNCS})
+
+
+def register_symbols(mapping: Mapping[str, str]) -> None:
+    """扩充符号表，如 {"\\ell": "ℓ"}"""
+    _SYMBOL_TABLE.update(mapping)
+
+
+def register_functions(names: Iterable[str]) -> None:
+    """扩充函数名表，如 ["det", "gcd"]，输出为原样文本"""
+    _FUNC_TABLE.update({"\\" + name: name for name in names})
+
+
+# Regex patterns of the reference engine, compiled on first use: the
+# default single-pass engine never touches them
+_DEFOP_RE = compile_lazy(r"\\operatorname\*?\{([^}]+)\}")
+_FRAC_CAP_RE = compile_lazy(r"\\frac\s*\{([^}]*)\}\s*\{([^}]*)\}")
+_SQRT_RE = compile_lazy(r"\\sqrt\s*\{([^}]*)\}")
+_SQRT_N_RE = compile_lazy(r"\\sqrt\s*\[([^\]]+)\]\s*\{([^}]*)\}")
+_TEXT_RM_RE = compile_lazy(r"\\mathrm\s*\{([^}]*)\}")
+_TEXT_RE = compile_lazy(r"\\text\s*\{([^}]*)\}")
+_BINOM_RE = compile_lazy(r"\\binom\s*\{([^}]*)\}\s*\{([^}]*)\}")
+_MATHBB_RE = compile_lazy(r"\\mathbb\s*\{([A-Za-z])\}")
 # Large operator sub/sup
-_LARGE_OP_SUB = re.compile(r"\\(sum|prod)\s*_\{([^}]*)\}")
-_LARGE_OP_SUP = re.compile(r"(∑|∏)\s*\^\{([^}]*)\}")
+_LARGE_OP_SUB = compile_lazy(r"\\(sum|prod)\s*_\{([^}]*)\}")
+_LARGE_OP_SUP = compile_lazy(r"(∑|∏)\s*\^\{([^}]*)\}")
 # lim with subscript
-_LIM_SUB = re.compile(r"\\lim\s*_\{([^}]*)\}")
+_LIM_SUB = compile_lazy(r"\\lim\s*_\{([^}]*)\}")
+# whitespace runs; both engines use this one, so it is compiled right away
+_WS_RE = re.compile(r"\s+")
 # generic ^/_ brace collapsing
-_SUP_BRACED = re.compile(r"\^\{([^}]*)\}")
-_SUB_BRACED = re.compile(r"_\{([^}]*)\}")
+_SUP_BRACED = compile_lazy(r"\^\{([^}]*)\}")
+_SUB_BRACED = compile_lazy(r"_\{([^}]*)\}")
 
 # Combining marks
 _COMB_OVERLINE = "\u0305"
@@ -51,12 +115,12 @@ _COMB_DDOT = "\u0308"
 _COMB_VEC = "\u20D7"
 
 _ACCENTS = {
-    re.compile(r"\\bar\s*\{([^}]*)\}"): _COMB_OVERLINE,
-    re.compile(r"\\overline\s*\{([^}]*)\}"): _COMB_OVERLINE,
-    re.compile(r"\\hat\s*\{([^}]*)\}"): _COMB_HAT,
-    re.compile(r"\\dot\s*\{([^}]*)\}"): _COMB_DOT,
-    re.compile(r"\\ddot\s*\{([^}]*)\}"): _COMB_DDOT,
-    re.compile(r"\\vec\s*\{([^}]*)\}"): _COMB_VEC,
+    compile_lazy(r"\\bar\s*\{([^}]*)\}"): _COMB_OVERLINE,
+    compile_lazy(r"\\overline\s*\{([^}]*)\}"): _COMB_OVERLINE,
+    compile_lazy(r"\\hat\s*\{([^}]*)\}"): _COMB_HAT,
+    compile_lazy(r"\\dot\s*\{([^}]*)\}"): _COMB_DOT,
+    compile_lazy(r"\\ddot\s*\{([^}]*)\}"): _COMB_DDOT,
+    compile_lazy(r"\\vec\s*\{([^}]*)\}"): _COMB_VEC,
 }
 
 # map common mathbb letters
@@ -72,16 +136,30 @@ def _strip_formatting_tokens(s: str) -> str:
     return s
 
 
+# a control word and, if one follows right after it, the next control word
+_CONTROL_WORD_PAIR_RE = compile_lazy(r"\\[A-Za-z]+(?=(\\[A-Za-z]+)?)")
+
+
 def _apply_functions(s: str) -> str:
-    for fn in _FUNCS:
-        s = re.sub(rf"\\{fn}(?=\b)", fn, s)
-    return s
+    # "\cdot\sin" would become "\cdotsin", one unknown word for the symbol
+    # pass; a control word directly before a function is resolved here instead
+    functions = _FUNC_TABLE._map
+    symbols = _SYMBOL_TABLE._map
+
+    def repl(m: re.Match) -> str:
+        word = m.group(0)
+        name = functions.get(word)
+        if name is not None:
+            return name
+        if m.group(1) in functions:
+            return symbols.get(word, word)
+        return word
+
+    return _CONTROL_WORD_PAIR_RE.sub(repl, s)
 
 
 def _apply_symbols(s: str) -> str:
-    for k, v in _SYMBOLS.items():
-        s = s.replace(k, v)
-    return s
+    return _SYMBOL_TABLE.sub(s)
 
 
 def _apply_text_modes(s: str) -> str:
@@ -104,16 +182,22 @@ def _apply_mathbb(s: str) -> str:
     return _MATHBB_RE.sub(repl, s)
 
 
-def _apply_sqrt_frac_binom_iteratively(s: str) -> str:
+def _sqrt_frac_binom_fixpoint(s: str) -> Tuple[str, int]:
+    iterations = 0
     changed = True
     while changed:
+        iterations += 1
         before = s
         s = _SQRT_N_RE.sub(lambda m: f"√[{m.group(1)}]({m.group(2)})", s)
         s = _SQRT_RE.sub(lambda m: f"√({m.group(1)})", s)
         s = _FRAC_CAP_RE.sub(lambda m: f"({m.group(1)})/({m.group(2)})", s)
         s = _BINOM_RE.sub(lambda m: f"C({m.group(1)},{m.group(2)})", s)
         changed = (s != before)
-    return s
+    return s, iterations
+
+
+def _apply_sqrt_frac_binom_iteratively(s: str) -> str:
+    return _sqrt_frac_binom_fixpoint(s)[0]
 
 
 def _apply_large_ops(s: str) -> str:
@@ -133,19 +217,190 @@ def _collapse_braced_sup_sub(s: str) -> str:
     return s
 
 
-def latex_to_unicodemath(latex: str) -> str:
-    s = latex.replace("\r", "")
-    s = _strip_formatting_tokens(s)
-    s = _apply_text_modes(s)
-    s = _apply_functions(s)
+def _normalize_whitespace(s: str) -> str:
+    return _WS_RE.sub(" ", s).strip()
+
+
+# Stages of the reference engine in order, named for conversion_profile
+_REFERENCE_STAGES = (
+    ("reference:strip_formatting_tokens", _strip_formatting_tokens),
+    ("reference:apply_text_modes", _apply_text_modes),
+    ("reference:apply_functions", _apply_functions),
     # core transformations
-    s = _apply_sqrt_frac_binom_iteratively(s)
-    s = _apply_large_ops(s)
-    s = _collapse_braced_sup_sub(s)
+    ("reference:apply_sqrt_frac_binom_iteratively", _apply_sqrt_frac_binom_iteratively),
+    ("reference:apply_large_ops", _apply_large_ops),
+    ("reference:collapse_braced_sup_sub", _collapse_braced_sup_sub),
     # accents/symbols/mathbb
-    s = _apply_accents(s)
-    s = _apply_symbols(s)
-    s = _apply_mathbb(s)
-    # whitespace normalize
-    s = re.sub(r"\s+", " ", s).strip()
+    ("reference:apply_accents", _apply_accents),
+    ("reference:apply_symbols", _apply_symbols),
+    ("reference:apply_mathbb", _apply_mathbb),
+    ("reference:normalize_whitespace", _normalize_whitespace),
+)
+_FIXPOINT_STAGES = {_apply_sqrt_frac_binom_iteratively: _sqrt_frac_binom_fixpoint}
+
+
+def _latex_to_unicodemath_reference(latex: str) -> str:
+    s = latex.replace("\r", "")
+    for _, stage in _REFERENCE_STAGES:
+        s = stage(s)
     return s
+
+
+# ---------------------------------------------------------------------------
+# Single-pass engine: lex once, parse into an AST, emit from the AST
+# ---------------------------------------------------------------------------
+
+ENGINE_FAST = "fast"
+ENGINE_REFERENCE = "reference"
+
+# large operators whose braced subscript is always parenthesised
+_LARGE_OPS = {"\\sum": "∑", "\\prod": "∏", "\\lim": "lim"}
+_FRAC_CMDS = frozenset(["\\frac", "\\dfrac", "\\tfrac"])
+_TEXT_CMDS = frozenset(["\\text", "\\mathrm", "\\operatorname"])
+_SPACING_CMDS = frozenset(["\\left", "\\right", "\\quad", "\\qquad", "\\;", "\\,", "\\!", "\\:"])
+_ACCENT_MARKS = {
+    "\\bar": _COMB_OVERLINE,
+    "\\overline": _COMB_OVERLINE,
+    "\\hat": _COMB_HAT,
+    "\\dot": _COMB_DOT,
+    "\\ddot": _COMB_DDOT,
+    "\\vec": _COMB_VEC,
+}
+
+
+# Matrix environments and the brackets around their ■(...) body
+_MATRIX_BRACKETS = {
+    "matrix": ("", ""), "smallmatrix": ("", ""), "array": ("", ""),
+    "pmatrix": ("(", ")"), "bmatrix": ("[", "]"), "Bmatrix": ("{", "}"),
+    "vmatrix": ("|", "|"), "Vmatrix": ("‖", "‖"),
+}
+
+
+def _format_environment(name: str, rows: List[List[str]]) -> str:
+    # cells are joined with & and rows with @, as in UnicodeMath ■(a&b@c&d)
+    body = "@".join(["&".join([cell.strip() for cell in row]) for row in rows])
+    brackets = _MATRIX_BRACKETS.get(name)
+    if brackets is not None:
+        return brackets[0] + "■(" + body + ")" + brackets[1]
+    if name == "cases":
+        return "{█(" + body + ")┤"
+    # aligned, gathered, split ...: an equation array
+    return "█(" + body + ")"
+
+
+# An emitted argument: (text, written in braces, source length between the braces)
+_Arg = Tuple[str, bool, int]
+
+
+def _format_command(name: str, args: List[Optional[_Arg]], opt: Optional[_Arg]) -> str:
+    if not args:
+        if name in _SPACING_CMDS:
+            return ""
+        text = _LARGE_OPS.get(name) or _FUNC_TABLE.get(name) or _SYMBOL_TABLE.get(name)
+        return text if text is not None else name
+    arg = args[0]
+    first = arg[0] if arg is not None else None
+
+    if name == "^" or name == "_":
+        if first is None:
+            return name
+        # a_{ij} -> a_(ij); a^{bc} -> a^bc
+        if name == "_" and arg[1] and arg[2] != 1:
+            return "_(" + first + ")"
+        return name + first
+    op = _LARGE_OPS.get(name)
+    if op is not None:
+        if first is None:
+            return op + "_"
+        return op + ("_(" + first + ")" if arg[1] else "_" + first)
+    if name in _FRAC_CMDS or name == "\\binom":
+        if first is None:
+            return name
+        second = args[1][0] if args[1] is not None else ""
+        if name == "\\binom":
+            return f"C({first},{second})"
+        return f"({first})/({second})"
+    if name == "\\sqrt":
+        radicand = first or ""
+        opt_text = opt[0] if opt is not None else None
+        return f"√[{opt_text}]({radicand})" if opt_text else f"√({radicand})"
+    if name in _TEXT_CMDS:
+        return first or ""
+    comb = _ACCENT_MARKS.get(name)
+    if comb is not None:
+        if first is None:
+            return name
+        return "".join(ch + comb for ch in first)
+    if name == "\\mathbb":
+        if first is None:
+            return name
+        if len(first) == 1 and first.isascii() and first.isalpha():
+            return _MATHBB_MAP.get(first, first)
+        return "\\mathbb{" + first + "}" if arg[1] else "\\mathbb" + first
+    sym = _SYMBOL_TABLE.get(name)
+    if sym is not None:
+        return sym
+    return name
+
+
+class _UnicodeMathBuilder:
+    """解析器构建器：在解析过程中直接拼出 UnicodeMath，不生成语法树"""
+
+    @staticmethod
+    def group(items: List[str], braced: bool, bare: bool, closed: bool, raw_len: int) -> object:
+        content = "".join(items)
+        if bare:
+            return "{" + content + "}" if closed else "{" + content
+        return (content, braced, raw_len)
+
+    command = staticmethod(_format_command)
+
+    @staticmethod
+    def environment(name: str, rows: List[List[_Arg]], closed: bool) -> str:
+        return _format_environment(name, [[cell[0] for cell in row] for row in rows])
+
+    @staticmethod
+    def root(items: List[str]) -> str:
+        return "".join(items)
+
+
+def _emit(root: Group) -> str:
+    """从语法树生成 UnicodeMath（与 latex_to_unicodemath 的单遍输出一致）"""
+    return rebuild(root, _UnicodeMathBuilder)
+
+
+def _latex_to_unicodemath_fast(latex: str) -> str:
+    out = build(latex.replace("\r", ""), _UnicodeMathBuilder)
+    return _WS_RE.sub(" ", out).strip()
+
+
+def _parse_emit(tokens: List[str]) -> str:
+    return build_tokens(tokens, _UnicodeMathBuilder)
+
+
+# The fast engine split at its seams, used only while profiling
+_FAST_STAGES = (
+    ("fast:tokenize", split),
+    ("fast:parse_emit", _parse_emit),
+    ("fast:normalize_whitespace", _normalize_whitespace),
+)
+
+
+@cached("unicodemath")
+def latex_to_unicodemath(latex: str, engine: str = ENGINE_FAST) -> str:
+    """LaTeX 转 UnicodeMath
+
+    默认使用单遍记号化 + 语法树引擎；engine="reference" 时使用原多遍正则实现，
+    便于对照两者输出。conversion_profile.enable_profiling() 开启后记录各阶段耗时
+    （缓存命中时不经过各阶段，也就没有记录）。
+    """
+    profiler = conversion_profile._active_profiler
+    if engine == ENGINE_FAST:
+        if profiler is None:
+            return _latex_to_unicodemath_fast(latex)
+        return run_stages(_FAST_STAGES, latex.replace("\r", ""), profiler)
+    if engine == ENGINE_REFERENCE:
+        if profiler is None:
+            return _latex_to_unicodemath_reference(latex)
+        return run_stages(_REFERENCE_STAGES, latex.replace("\r", ""), profiler, _FIXPOINT_STAGES)
+    raise ValueError(f"未知的转换引擎：{engine}")
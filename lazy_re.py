@@ -0,0 +1,40 @@
+import re
+from typing import Any, AnyStr, Generic, Optional, Pattern
+
+
+class LazyPattern(Generic[AnyStr]):
+    """首次使用时才编译的正则表达式
+
+    用法与 re.compile 的结果相同（search、sub、finditer 等方法转发给编译后的对象），
+    但只在第一次调用方法时编译，只在少数路径上用到的模式不会拖慢模块导入。
+    """
+
+    __slots__ = ("pattern", "flags", "_compiled")
+
+    def __init__(self, pattern: AnyStr, flags: int = 0) -> None:
+        self.pattern = pattern
+        self.flags = flags
+        self._compiled: Optional[Pattern[AnyStr]] = None
+
+    @property
+    def compiled(self) -> Pattern[AnyStr]:
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compiled = re.compile(self.pattern, self.flags)
+        return compiled
+
+    @property
+    def is_compiled(self) -> bool:
+        return self._compiled is not None
+
+    def __getattr__(self, name: str) -> Any:
+        # only reached for attributes not defined above, i.e. the Pattern methods
+        return getattr(self.compiled, name)
+
+    def __repr__(self) -> str:
+        return f"LazyPattern({self.pattern!r}, flags={self.flags})"
+
+
+def compile_lazy(pattern: AnyStr, flags: int = 0) -> LazyPattern[AnyStr]:
+    """返回延迟编译的正则，参数与 re.compile 相同"""
+    return LazyPattern(pattern, flags)
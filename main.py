@@ -1,4 +1,5 @@
 import sys
+import threading
 from PySide6.QtWidgets import (
     QApplication,
     QWidget,
@@ -8,6 +9,7 @@ from PySide6.QtWidgets import (
     QTextEdit,
     QPushButton,
     QMessageBox,
+    QCheckBox,
     QComboBox,
     QFrame,
     QScrollArea,
@@ -16,12 +18,100 @@ from PySide6.QtWidgets import (
     QProgressBar,
     QSizePolicy,
 )
-from PySide6.QtCore import Qt, QTimer, Signal
+from PySide6.QtCore import QObject, QRunnable, Qt, QThreadPool, QTimer, Signal
 from PySide6.QtGui import QFont, QIcon, QPalette, QColor
 import pyperclip
 
-from markdown_to_latex import extract_first_formula_latex, normalize_latex_for_word, extract_all_formulas, validate_latex
-from latex_to_unicodemath import latex_to_unicodemath
+from converter import (
+    ConversionCancelled,
+    FormulaNotFoundError,
+    MODE_LATEX_TO_UNIMATH,
+    MODE_MD_DOC_TO_UNIMATH,
+    MODE_MD_TO_LATEX,
+    MODE_MD_TO_UNIMATH,
+    WRAP_DISPLAY,
+    WRAP_INLINE,
+    WRAP_KEEP,
+    convert_formula,
+    extract_formula,
+)
+
+# 实时预览：停止输入这么久（毫秒）后才转换，连续的编辑合并为一次
+_PREVIEW_DELAY_MS = 300
+
+# 界面上的模式/包装选项与 converter 常量的对应关系
+_MODE_BY_LABEL = {
+    "Markdown→LaTeX": MODE_MD_TO_LATEX,
+    "Markdown→UnicodeMath": MODE_MD_TO_UNIMATH,
+    "LaTeX→UnicodeMath": MODE_LATEX_TO_UNIMATH,
+    "Markdown 文档→UnicodeMath": MODE_MD_DOC_TO_UNIMATH,
+}
+_WRAP_BY_LABEL = {
+    "保持原样": WRAP_KEEP,
+    "强制行内 $...$": WRAP_INLINE,
+    "强制展示 $$...$$": WRAP_DISPLAY,
+}
+
+
+class _ConversionSignals(QObject):
+    progress = Signal(int, int, str)   # job id, percent, stage
+    finished = Signal(int, str)        # job id, result
+    failed = Signal(int, bool, str)    # job id, formula not found, message
+    unchanged = Signal(int)            # job id; formula same as skip_key, nothing converted
+
+
+class ConversionWorker(QRunnable):
+    """在线程池中执行一次转换，进度和结果通过信号回到界面线程
+
+    取消是协作式的：cancel() 后在下一个阶段边界中止，已取消的任务不再发出结果。
+    提取出的公式与 skip_key 相同时不再转换，只发出 unchanged。
+    """
+
+    def __init__(self, job_id: int, text: str, mode: str, wrap: str,
+                 live: bool = False, skip_key: object = None) -> None:
+        super().__init__()
+        self.job_id = job_id
+        self.text = text
+        self.mode = mode
+        self.wrap = wrap
+        self.live = live
+        self.skip_key = skip_key
+        self.key: object = None  # (mode, wrap, latex, display_mode) once extracted
+        self.signals = _ConversionSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _progress(self, percent: int, stage: str) -> None:
+        if self._cancelled.is_set():
+            raise ConversionCancelled()
+        self.signals.progress.emit(self.job_id, percent, stage)
+
+    def run(self) -> None:
+        try:
+            latex, display_mode = extract_formula(self.text, self.mode, self._progress)
+            self.key = (self.mode, self.wrap, latex, display_mode)
+            if self.key == self.skip_key:
+                if not self._cancelled.is_set():
+                    self.signals.unchanged.emit(self.job_id)
+                return
+            result = convert_formula(latex, display_mode, self.mode, self.wrap, self._progress)
+        except ConversionCancelled:
+            return
+        except FormulaNotFoundError as e:
+            if not self._cancelled.is_set():
+                self.signals.failed.emit(self.job_id, True, str(e))
+            return
+        except Exception as e:
+            if not self._cancelled.is_set():
+                self.signals.failed.emit(self.job_id, False, str(e))
+            return
+        if not self._cancelled.is_set():
+            self.signals.finished.emit(self.job_id, result)
 
 
 class FormulaTool(QWidget):
@@ -56,6 +146,19 @@ class FormulaTool(QWidget):
         # 状态栏
         self._create_status_bar(main_layout)
 
+        # 后台转换：界面线程只负责派发任务和显示结果
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(2)
+        self._job_id = 0
+        self._worker = None
+        self._last_key: object = None  # 当前输出对应的公式，用于跳过重复的预览转换
+
+        # 实时预览的防抖定时器：每次编辑都重新计时
+        self._preview_timer = QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(_PREVIEW_DELAY_MS)
+        self._preview_timer.timeout.connect(self._run_live_preview)
+
         # 连接信号
         self._connect_signals()
         
@@ -255,6 +358,7 @@ class FormulaTool(QWidget):
             "Markdown→LaTeX",
             "Markdown→UnicodeMath", 
             "LaTeX→UnicodeMath",
+            "Markdown 文档→UnicodeMath",
         ])
         self.combo_mode.setStyleSheet("""
             QComboBox {
@@ -368,8 +472,17 @@ class FormulaTool(QWidget):
         wrap_row.addWidget(wrap_label)
         wrap_row.addWidget(self.combo_wrap)
         
+        self.chk_live = QCheckBox("实时预览（输入停顿后自动转换）")
+        self.chk_live.setStyleSheet("""
+            QCheckBox {
+                font-size: 11pt;
+                color: #2c3e50;
+            }
+        """)
+        
         options_layout.addLayout(mode_row)
         options_layout.addLayout(wrap_row)
+        options_layout.addWidget(self.chk_live)
         layout.addWidget(options_group)
 
     def _create_output_section(self, layout: QVBoxLayout) -> None:
@@ -454,7 +567,31 @@ class FormulaTool(QWidget):
             }
         """)
         
+        self.btn_cancel = QPushButton("⏹ 取消")
+        self.btn_cancel.setMinimumHeight(45)
+        self.btn_cancel.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
+        self.btn_cancel.setStyleSheet("""
+            QPushButton {
+                background-color: #dc3545;
+                color: white;
+                border: none;
+                border-radius: 8px;
+                padding: 12px 25px;
+                font-weight: bold;
+                font-size: 12pt;
+                min-height: 20px;
+            }
+            QPushButton:hover {
+                background-color: #c82333;
+            }
+            QPushButton:pressed {
+                background-color: #bd2130;
+            }
+        """)
+        self.btn_cancel.setVisible(False)
+        
         btn_layout.addWidget(self.btn_convert)
+        btn_layout.addWidget(self.btn_cancel)
         btn_layout.addWidget(self.btn_copy)
         btn_layout.addStretch()
         
@@ -463,13 +600,21 @@ class FormulaTool(QWidget):
     def _create_status_bar(self, layout: QVBoxLayout) -> None:
         self.status_bar = QStatusBar()
         self.status_bar.showMessage("就绪")
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.setVisible(False)
+        self.status_bar.addPermanentWidget(self.progress_bar)
         layout.addWidget(self.status_bar)
 
     def _connect_signals(self) -> None:
         self.btn_convert.clicked.connect(self.on_convert)
         self.btn_copy.clicked.connect(self.on_copy)
+        self.btn_cancel.clicked.connect(self.on_cancel)
         self.combo_mode.currentTextChanged.connect(self.on_mode_changed)
         self.txt_input.textChanged.connect(self.on_input_changed)
+        self.combo_wrap.currentTextChanged.connect(self._schedule_live_preview)
+        self.chk_live.toggled.connect(self.on_live_toggled)
 
     def on_mode_changed(self, mode: str) -> None:
         """转换模式改变时的处理"""
@@ -478,14 +623,45 @@ class FormulaTool(QWidget):
         else:
             self.combo_wrap.setEnabled(False)
         self._update_status(f"已切换到 {mode} 模式")
+        self._schedule_live_preview()
 
     def on_input_changed(self) -> None:
         """输入文本改变时的处理"""
-        text = self.txt_input.toPlainText().strip()
-        if text:
-            self._update_status(f"输入文本长度: {len(text)} 字符")
+        # 每次按键都会触发，只读文档的字符数，不复制整段文本
+        document = self.txt_input.document()
+        if not document.isEmpty():
+            self._update_status(f"输入文本长度: {document.characterCount() - 1} 字符")
         else:
             self._update_status("就绪")
+        self._schedule_live_preview()
+
+    def on_live_toggled(self, checked: bool) -> None:
+        """实时预览开关"""
+        if checked:
+            self._schedule_live_preview()
+        else:
+            self._preview_timer.stop()
+            if self._worker is not None and self._worker.live:
+                self._cancel_conversion()
+
+    def _schedule_live_preview(self) -> None:
+        # 在每次编辑时调用，必须足够轻：不读取文本，只作废进行中的预览并重新计时
+        if not self.chk_live.isChecked():
+            return
+        if self._worker is not None and self._worker.live:
+            self._cancel_conversion()
+        self._preview_timer.start()
+
+    def _run_live_preview(self) -> None:
+        if self._worker is not None and not self._worker.live:
+            self._preview_timer.start()  # 手动转换进行中，不打断，稍后再试
+            return
+        text = self.txt_input.toPlainText()
+        if not text or text.isspace():
+            return
+        mode = _MODE_BY_LABEL[self.combo_mode.currentText()]
+        wrap = _WRAP_BY_LABEL.get(self.combo_wrap.currentText(), WRAP_KEEP)
+        self._start_conversion(text, mode, wrap, live=True)
 
     def _update_status(self, message: str) -> None:
         """更新状态栏"""
@@ -499,75 +675,99 @@ class FormulaTool(QWidget):
         # 强制重新计算布局
         self.layout().update()
 
-    def _md_to_latex(self, md_text: str) -> str:
-        """Markdown 转 LaTeX"""
-        latex, display_mode = extract_first_formula_latex(md_text)
-        if latex is None:
-            return ""
-        
-        wrapping = self.combo_wrap.currentText()
-        if wrapping == "强制行内 $...$":
-            return f"${latex}$"
-        elif wrapping == "强制展示 $$...$$":
-            return f"$${latex}$$"
-        else:
-            return f"$${latex}$$" if display_mode == "display" else f"${latex}$"
-
-    def _md_to_unimath(self, md_text: str) -> str:
-        """Markdown 转 UnicodeMath"""
-        latex, _ = extract_first_formula_latex(md_text)
-        if latex is None:
-            return ""
-        return latex_to_unicodemath(latex)
-
-    def _latex_to_unimath(self, latex_text: str) -> str:
-        """LaTeX 转 UnicodeMath"""
-        # 验证 LaTeX 语法
-        is_valid, error_msg = validate_latex(latex_text)
-        if not is_valid:
-            raise ValueError(f"LaTeX 语法错误：{error_msg}")
-        
-        return latex_to_unicodemath(latex_text)
-
     def on_convert(self) -> None:
-        """转换按钮点击事件"""
-        text = self.txt_input.toPlainText().strip()
-        if not text:
+        """转换按钮点击事件：在线程池中转换，界面保持响应"""
+        # 公式提取和转换都会忽略首尾空白，这里不再 strip 复制整段文本
+        text = self.txt_input.toPlainText()
+        if not text or text.isspace():
             QMessageBox.information(self, "提示", "请输入 Markdown 或 LaTeX 文本。")
             return
         
-        self._update_status("正在转换...")
-        self.btn_convert.setEnabled(False)
-        
-        try:
-            mode = self.combo_mode.currentText()
-            if mode == "Markdown→LaTeX":
-                result = self._md_to_latex(text)
-                if not result:
-                    QMessageBox.warning(self, "未找到公式", 
-                        "未检测到 $...$、$$...$$ 或 ```math 公式块。\n\n"
-                        "请检查输入格式或尝试其他转换模式。")
-                    self._update_status("转换失败：未找到公式")
-                    return
-            elif mode == "Markdown→UnicodeMath":
-                result = self._md_to_unimath(text)
-                if not result:
-                    QMessageBox.warning(self, "未找到公式", 
-                        "未检测到 $...$、$$...$$ 或 ```math 公式块。\n\n"
-                        "请检查输入格式或尝试其他转换模式。")
-                    self._update_status("转换失败：未找到公式")
-                    return
-            else:  # LaTeX→UnicodeMath
-                result = self._latex_to_unimath(text)
-            
-            self.txt_output.setPlainText(result)
-            self._update_status(f"转换完成：{mode}")
-            
-        except Exception as e:
-            QMessageBox.critical(self, "转换错误", f"转换过程中发生错误：\n{str(e)}")
+        mode = self.combo_mode.currentText()
+        wrap = _WRAP_BY_LABEL.get(self.combo_wrap.currentText(), WRAP_KEEP)
+        self._start_conversion(text, _MODE_BY_LABEL[mode], wrap)
+
+    def on_cancel(self) -> None:
+        """取消按钮点击事件"""
+        self._cancel_conversion()
+        self._set_busy(False)
+        self._update_status("已取消转换")
+
+    def _start_conversion(self, text: str, mode: str, wrap: str, live: bool = False) -> None:
+        self._cancel_conversion()
+        self._job_id += 1
+        worker = ConversionWorker(self._job_id, text, mode, wrap,
+                                  live=live, skip_key=self._last_key if live else None)
+        worker.signals.progress.connect(self._on_convert_progress)
+        worker.signals.finished.connect(self._on_convert_finished)
+        worker.signals.failed.connect(self._on_convert_failed)
+        worker.signals.unchanged.connect(self._on_convert_unchanged)
+        self._worker = worker
+        if not live:
+            # 预览在后台安静进行，不切换按钮和进度条
+            self._set_busy(True)
+            self._update_status("正在转换...")
+        self._pool.start(worker)
+
+    def _cancel_conversion(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def _set_busy(self, busy: bool) -> None:
+        self.btn_convert.setEnabled(not busy)
+        self.btn_cancel.setVisible(busy)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(busy)
+
+    def _is_current(self, job_id: int) -> bool:
+        # 已取消或被新任务取代的结果直接丢弃
+        return self._worker is not None and job_id == self._job_id
+
+    def _on_convert_progress(self, job_id: int, percent: int, stage: str) -> None:
+        if self._is_current(job_id) and not self._worker.live:
+            self.progress_bar.setValue(percent)
+            self._update_status(f"正在转换：{stage}...")
+
+    def _on_convert_finished(self, job_id: int, result: str) -> None:
+        if not self._is_current(job_id):
+            return
+        self._last_key = self._worker.key
+        self._worker = None
+        self._set_busy(False)
+        self.txt_output.setPlainText(result)
+        self._update_status(f"转换完成：{self.combo_mode.currentText()}")
+
+    def _on_convert_unchanged(self, job_id: int) -> None:
+        if self._is_current(job_id):
+            self._worker = None
+            self._set_busy(False)
+
+    def _on_convert_failed(self, job_id: int, not_found: bool, message: str) -> None:
+        if not self._is_current(job_id):
+            return
+        live = self._worker.live
+        self._last_key = None
+        self._worker = None
+        self._set_busy(False)
+        if live:
+            # 输入到一半时公式常常还不完整，预览只在状态栏提示
+            self._update_status("预览：未找到公式" if not_found else f"预览：{message}")
+        elif not_found:
+            QMessageBox.warning(self, "未找到公式", 
+                "未检测到 $...$、$$...$$ 或 ```math 公式块。\n\n"
+                "请检查输入格式或尝试其他转换模式。")
+            self._update_status("转换失败：未找到公式")
+        else:
+            QMessageBox.critical(self, "转换错误", f"转换过程中发生错误：\n{message}")
             self._update_status("转换失败")
-        finally:
-            self.btn_convert.setEnabled(True)
+
+    def closeEvent(self, event) -> None:
+        """关闭窗口时取消后台转换"""
+        self._preview_timer.stop()
+        self._cancel_conversion()
+        self._pool.waitForDone()
+        super().closeEvent(event)
 
     def on_copy(self) -> None:
         """复制按钮点击事件"""
@@ -1,13 +1,172 @@
+import mmap
 import re
-from typing import Optional, Tuple, List, Dict
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Any, Optional, Tuple, List, Dict, Iterator, NamedTuple, TextIO, Union, overload
 
-INLINE_PATTERN = re.compile(r"\$(.+?)\$", re.DOTALL)
-DISPLAY_PATTERN = re.compile(r"\$\$(.+?)\$\$", re.DOTALL)
-FENCED_MATH_PATTERN = re.compile(r"```(?:math|latex)\n([\s\S]+?)\n```", re.IGNORECASE)
+from conversion_cache import cached, strip_text
+from lazy_re import compile_lazy
+
+# 各模式在第一次使用时才编译，只用到其中一部分的调用不必为其余的付出导入时间
+INLINE_PATTERN = compile_lazy(r"\$(.+?)\$", re.DOTALL)
+DISPLAY_PATTERN = compile_lazy(r"\$\$(.+?)\$\$", re.DOTALL)
+FENCED_MATH_PATTERN = compile_lazy(r"```(?:math|latex)\n([\s\S]+?)\n```", re.IGNORECASE)
+
+# 单遍扫描用的总模式，在每个 $ 或 ` 处尝试，各分支按优先级排列：
+# ```math 围栏、代码（`...`、```...```）、$$...$$、$...$，
+# 以及没有闭合的 ```math 和其他定界符。公式内容跳过反斜杠转义，且至少一个字符。
+_FORMULA_SCAN_PATTERN = compile_lazy(
+    r"```(?i:math|latex)\n(?P<fenced>[\s\S]+?)\n```"
+    r"|(?P<openfence>```(?i:math|latex)\n)"
+    r"|(?P<code>`+)(?!`)[\s\S]*?(?<!`)(?P=code)(?!`)"
+    r"|\$\$(?!\$\$)(?P<display>[^\\$]*(?:(?:\\[\s\S]|\$(?!\$))[^\\$]*)*)\$\$"
+    r"|\$(?!\$)(?P<inline>[^\\$]*(?:\\[\s\S][^\\$]*)*)\$"
+    r"|(?P<unclosed>`+|\$)"
+)
+# 同一模式的字节版本，用于直接扫描内存映射的文件。定界符都是 ASCII，
+# UTF-8 多字节字符中不会出现 ASCII 字节，所以按字节匹配的结果与按字符相同
+_FORMULA_SCAN_PATTERN_BYTES = compile_lazy(_FORMULA_SCAN_PATTERN.pattern.encode("ascii"))
+_MAX_OPEN_DELIM = 9  # len("```latex\n")
+_LEADING_WS_PATTERN = re.compile(r"\s*")
+
+# (type, start, end, content_start, content_end)
+_Span = Tuple[str, int, int, int, int]
+
+# Formula types in a fixed order; FormulaList stores the index as one byte
+_KINDS = ("inline", "display", "fenced")
+_KIND_CODES = {kind: code for code, kind in enumerate(_KINDS)}
+_FORMULA_KEYS = ("content", "type", "display_mode", "start", "end")
+
+
+class Formula(Mapping):
+    """一个公式的紧凑记录
+
+    用属性访问 content/type/display_mode/start/end；同时实现只读的 Mapping 接口，
+    formula['content'] 等旧的字典写法照常可用，to_dict() 转为普通字典。
+    content 在首次访问时才从原文切出。
+    """
+
+    __slots__ = ("type", "start", "end", "_text", "_content_start", "_content_end", "_content")
+
+    def __init__(self, type: str, start: int, end: int, text: Optional[str] = None,
+                 content_start: int = 0, content_end: int = 0, content: Optional[str] = None) -> None:
+        self.type = type
+        self.start = start
+        self.end = end
+        self._text = text
+        self._content_start = content_start
+        self._content_end = content_end
+        self._content = content
+
+    @property
+    def content(self) -> str:
+        content = self._content
+        if content is None:
+            content = self._content = self._text[self._content_start:self._content_end].strip()
+            self._text = None
+        return content
+
+    @property
+    def display_mode(self) -> str:
+        return "inline" if self.type == "inline" else "display"
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FORMULA_KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(_FORMULA_KEYS)
+
+    def __len__(self) -> int:
+        return len(_FORMULA_KEYS)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in _FORMULA_KEYS}
+
+    def __repr__(self) -> str:
+        return f"Formula({self.to_dict()!r})"
+
+
+class FormulaList(Sequence):
+    """extract_all_formulas 的结果：按列存储的公式偏移
+
+    每个公式只占一个类型字节和四个 64 位偏移，不为每个公式生成字典和内容字符串；
+    按下标或迭代取出时才生成 Formula 记录。to_dicts() 返回旧的字典列表。
+    """
+
+    __slots__ = ("_text", "_lead", "_kinds", "_offsets")
+
+    def __init__(self, text: str, spans: List[_Span], lead: int = 0) -> None:
+        self._text = text
+        self._lead = lead
+        self._kinds = bytes(_KIND_CODES[span[0]] for span in spans)
+        self._offsets = array("q")
+        for span in spans:
+            self._offsets.extend(span[1:])
+
+    def __len__(self) -> int:
+        return len(self._kinds)
+
+    @overload
+    def __getitem__(self, index: int) -> Formula: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Formula]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        kind = _KINDS[self._kinds[index]]  # raises IndexError past the end
+        if index < 0:
+            index += len(self)
+        start, end, content_start, content_end = self._offsets[4 * index:4 * index + 4]
+        lead = self._lead
+        return Formula(kind, start - lead, end - lead, self._text, content_start, content_end)
+
+    def __iter__(self) -> Iterator[Formula]:
+        text, lead, offsets = self._text, self._lead, self._offsets
+        for i, code in enumerate(self._kinds):
+            j = 4 * i
+            yield Formula(_KINDS[code], offsets[j] - lead, offsets[j + 1] - lead,
+                          text, offsets[j + 2], offsets[j + 3])
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, FormulaList):
+            return self.to_dicts() == other.to_dicts()
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return [formula.to_dict() for formula in self]
+
+    def __repr__(self) -> str:
+        return f"FormulaList({len(self)} 个公式)"
+
+
+def iter_formula_candidates(markdown_text: str) -> Iterator[Tuple[str, str]]:
+    """按 extract_first_formula_latex 的优先级逐个产出 (latex, display_mode)
+
+    依次为所有 ```math 块、$$...$$、$...$（取自 extract_all_formulas，互不重叠）；
+    一个也没有时，像 LaTeX 的整段文本作为唯一候选。第一个候选不可用时
+    （如只含宏定义）可以继续取下一个。
+    """
+    formulas = extract_all_formulas(markdown_text)
+    for kind in ("fenced", "display", "inline"):
+        for formula in formulas:
+            if formula.type == kind:
+                yield formula.content, formula.display_mode
+    # as a fallback, treat the whole text as latex if it seems latex-like
+    if not formulas and any(token in markdown_text for token in
+                            ["\\frac", "\\sum", "\\int", "\\alpha", "\\beta", "\\gamma", "^", "_"]):
+        yield markdown_text.strip(), "inline"
 
 
 def extract_first_formula_latex(markdown_text: str) -> Tuple[Optional[str], Optional[str]]:
-    text = markdown_text.strip()
+    # the patterns are unanchored, so surrounding whitespace never changes the
+    # match; only the fallback below needs a stripped copy of the whole text
+    text = markdown_text
     # prefer fenced block, then display, then inline
     fenced = FENCED_MATH_PATTERN.search(text)
     if fenced:
@@ -23,53 +182,179 @@ def extract_first_formula_latex(markdown_text: str) -> Tuple[Optional[str], Opti
         return content, "inline"
     # as a fallback, treat the whole text as latex if it seems latex-like
     if any(token in text for token in ["\\frac", "\\sum", "\\int", "\\alpha", "\\beta", "\\gamma", "^", "_"]):
-        return text, "inline"
+        return text.strip(), "inline"
     return None, None
 
 
-def extract_all_formulas(markdown_text: str) -> List[Dict[str, str]]:
-    """提取所有公式，返回包含公式内容和类型信息的列表"""
-    text = markdown_text.strip()
-    formulas = []
-    
-    # 提取 fenced 代码块
-    for match in FENCED_MATH_PATTERN.finditer(text):
-        content = match.group(1).strip()
-        formulas.append({
-            'content': content,
-            'type': 'fenced',
-            'display_mode': 'display',
-            'start': match.start(),
-            'end': match.end()
-        })
-    
-    # 提取显示公式
-    for match in DISPLAY_PATTERN.finditer(text):
-        content = match.group(1).strip()
-        formulas.append({
-            'content': content,
-            'type': 'display',
-            'display_mode': 'display',
-            'start': match.start(),
-            'end': match.end()
-        })
-    
-    # 提取行内公式
-    for match in INLINE_PATTERN.finditer(text):
-        content = match.group(1).strip()
-        formulas.append({
-            'content': content,
-            'type': 'inline',
-            'display_mode': 'inline',
-            'start': match.start(),
-            'end': match.end()
-        })
-    
-    # 按位置排序
-    formulas.sort(key=lambda x: x['start'])
-    return formulas
+def extract_all_formulas(markdown_text: str) -> FormulaList:
+    """提取所有公式，返回包含公式内容和类型信息的 Formula 记录序列
+
+    单遍扫描，公式互不重叠；start/end 为相对去除首尾空白后文本的偏移。
+    结果按列紧凑存储，需要旧的字典列表时调用 to_dicts()。
+    """
+    # 不复制文本，只计算被 strip 掉的前导空白长度
+    lead = _LEADING_WS_PATTERN.match(markdown_text).end()
+    spans, _ = _scan_formulas(markdown_text, lead, True)
+    return FormulaList(markdown_text, spans, lead)
+
+
+def _scan_formulas(buf: Union[str, bytes, mmap.mmap], pos: int, final: bool,
+                   max_formula_chars: Optional[int] = None,
+                   stop: Optional[int] = None,
+                   skipped: Optional[List[int]] = None) -> Tuple[List[_Span], int]:
+    """从 pos 起单遍扫描 buf 中互不重叠的公式
+
+    一次扫描同时识别 ```math 围栏、$$...$$、$...$、转义的 \\$ 和代码
+    （`...` 与 ```...``` 中的内容不当作公式）。
+    返回找到的公式区间和下次扫描的起点。final 为 False 时表示后面还有数据：
+    靠近 buf 末尾、尚不能确定的匹配（如 "$$" 的前一半、被切断的 ```math、
+    暂未闭合的定界符）会留到下一次扫描。stop 限制本次只处理在它之前开始的公式。
+    buf 也可以是 bytes 或 mmap，此时所有偏移都是字节偏移。
+    给出 skipped 时，被当作普通文本跳过的未闭合定界符位置会追加到其中
+    （它们是否闭合取决于其后的全部文本，增量重扫时需要知道）。
+    """
+    spans: List[_Span] = []
+    n = len(buf)
+    stop = n if stop is None else stop
+    limit = n if final else n - _MAX_OPEN_DELIM
+    find = buf.find
+    if isinstance(buf, str):
+        match = _FORMULA_SCAN_PATTERN.match
+        dollar, tick, backslash = "$", "`", "\\"
+    else:
+        match = _FORMULA_SCAN_PATTERN_BYTES.match
+        dollar, tick, backslash = b"$", b"`", b"\\"
+    # $ 和 ` 各自的下一个位置，过期时才重新查找
+    next_dollar = next_tick = -1
+    while True:
+        if next_dollar < pos:
+            next_dollar = find(dollar, pos) % (n + 1)
+        if next_tick < pos:
+            next_tick = find(tick, pos) % (n + 1)
+        start = next_dollar if next_dollar < next_tick else next_tick
+        if start >= stop:
+            if start < n:
+                # 从 pos 继续，下次仍能看到 start 前面的反斜杠
+                return spans, pos
+            break
+        if start == next_dollar and start > pos and buf[start - 1:start] == backslash:
+            # 前面有奇数个反斜杠时是转义的 \$
+            slashes = 1
+            while start - slashes > pos and buf[start - slashes - 1:start - slashes] == backslash:
+                slashes += 1
+            if slashes % 2:
+                if start >= limit:
+                    break
+                pos = start + 1
+                continue
+        m = match(buf, start)
+        end = m.end()
+        if end > limit:
+            return spans, start
+        kind = m.lastgroup
+        if kind == "unclosed" or kind == "openfence":
+            if not final and (max_formula_chars is None or n - start <= max_formula_chars):
+                return spans, start
+            if skipped is not None:
+                skipped.append(start)
+        elif kind != "code":
+            content_start, content_end = m.span(kind)
+            spans.append((kind, start, end, content_start, content_end))
+        pos = end
+    if final:
+        return spans, n
+    # 保留末尾可能被切断的定界符，以及可能转义下一个 $ 的反斜杠
+    resume = max(pos, limit + 1)
+    while resume > pos and buf[resume - 1:resume] == backslash:
+        resume -= 1
+    return spans, resume
+
+
+def _span_to_formula(buf: str, span: _Span, offset: int = 0) -> Formula:
+    # the buffer is discarded after each chunk, so the content is sliced eagerly
+    kind, start, end, content_start, content_end = span
+    return Formula(kind, start + offset, end + offset, content=buf[content_start:content_end].strip())
+
+
+def iter_formulas(stream: TextIO, chunk_size: int = 1 << 16,
+                  max_formula_chars: Optional[int] = 1 << 20) -> Iterator[Formula]:
+    """从文件类对象中分块读取并逐个产出公式
+
+    产出的记录与 extract_all_formulas 相同，start/end 为相对整个流的绝对偏移；
+    公式互不重叠（$$...$$ 不会再被当作行内公式重复产出）。
+    内存占用只与 chunk_size 和单个公式长度有关；未闭合的定界符
+    超过 max_formula_chars 个字符后按普通文本处理。
+    """
+    buf = ""
+    base = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        final = not chunk
+        buf += chunk
+        spans, pos = _scan_formulas(buf, 0, final, max_formula_chars)
+        for span in spans:
+            yield _span_to_formula(buf, span, base)
+        if final:
+            return
+        buf = buf[pos:]
+        base += pos
+
+
+def iter_document(stream: TextIO, chunk_size: int = 1 << 16,
+                  max_formula_chars: Optional[int] = 1 << 20) -> Iterator[Union[str, Formula]]:
+    """与 iter_formulas 相同地分块读取，但按原文顺序产出公式之间的文本（str）和公式
 
+    所有产出的文本与公式原文依次拼接即为整个流，适合边读边写出整篇文档；
+    同一段文本可能被分成几个 str 产出。
+    """
+    buf = ""
+    base = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        final = not chunk
+        buf += chunk
+        spans, pos = _scan_formulas(buf, 0, final, max_formula_chars)
+        done = 0
+        for span in spans:
+            if span[1] > done:
+                yield buf[done:span[1]]
+            yield _span_to_formula(buf, span, base)
+            done = span[2]
+        if final:
+            if done < len(buf):
+                yield buf[done:]
+            return
+        # everything before pos has been scanned, so it is plain text
+        if pos > done:
+            yield buf[done:pos]
+        buf = buf[pos:]
+        base += pos
 
+
+def map_formulas(path: str, encoding: str = "utf-8",
+                 window: int = 1 << 24) -> Iterator[Formula]:
+    """以内存映射方式扫描大文件并逐个产出公式
+
+    文件不会整体读入或解码：定界符直接在映射上按字节匹配，只解码公式内容。
+    产出的记录与 extract_all_formulas 相同，但 start/end 为文件内的字节偏移。
+    encoding 中的多字节字符不能包含 ASCII 字节（UTF-8 满足，GBK 不满足）；
+    每次只处理 window 字节内开始的公式，中间结果的大小与文件大小无关。
+    """
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return  # 空文件无法映射
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            pos = stop = 0
+            while pos < size:
+                stop = min(stop + window, size)
+                spans, pos = _scan_formulas(mm, pos, True, stop=stop)
+                for kind, start, end, content_start, content_end in spans:
+                    content = mm[content_start:content_end].decode(encoding).strip()
+                    yield Formula(kind, start, end, content=content)
+
+
+@cached("normalize", strip_text)
 def normalize_latex_for_word(latex: str) -> str:
     """标准化 LaTeX 以适配 Word"""
     s = latex.replace("\r", "").strip()
@@ -84,35 +369,63 @@ def normalize_latex_for_word(latex: str) -> str:
     return s
 
 
+class LatexDiagnostic(NamedTuple):
+    """语法检查发现的问题；offset 为出错字符的下标，line/column 从 1 开始，无位置时 offset 为 -1"""
+    message: str
+    offset: int = -1
+    line: int = 0
+    column: int = 0
+
+    def __str__(self) -> str:
+        if self.offset < 0:
+            return self.message
+        return f"{self.message}（第 {self.line} 行第 {self.column} 列）"
+
+
+# (opening, closing, name) checked in this order
+_BALANCE_PAIRS = (("(", ")", "括号"), ("[", "]", "方括号"), ("{", "}", "花括号"))
+_PAIR_PATTERNS = {opening: compile_lazy(re.escape(opening) + "|" + re.escape(closing))
+                  for opening, closing, _ in _BALANCE_PAIRS}
+
+
+def _unmatched_offset(latex: str, opening: str, balance: int) -> int:
+    # only runs once the counts disagree: returns the first surplus closing
+    # character, or else the outermost opening character left unclosed
+    open_offsets: List[int] = []
+    for m in _PAIR_PATTERNS[opening].finditer(latex):
+        if m.group() == opening:
+            open_offsets.append(m.start())
+        elif open_offsets:
+            open_offsets.pop()
+        elif balance < 0:
+            return m.start()
+    return open_offsets[0] if open_offsets else -1
+
+
+def check_latex(latex: str) -> Optional[LatexDiagnostic]:
+    """检查 LaTeX 的括号配对，返回第一个问题（含行列位置），没有问题时返回 None
+
+    配对检查只用 str.count，在 C 中完成；只有计数不平衡时才扫描括号字符定位出错位置。
+    """
+    if not latex or latex.isspace():
+        return LatexDiagnostic("空公式")
+    for opening, closing, name in _BALANCE_PAIRS:
+        balance = latex.count(opening) - latex.count(closing)
+        if balance:
+            missing = closing if balance > 0 else opening
+            offset = _unmatched_offset(latex, opening, balance)
+            line = latex.count("\n", 0, offset) + 1
+            column = offset - latex.rfind("\n", 0, offset)
+            return LatexDiagnostic(f"{name}不匹配：缺少 {abs(balance)} 个 {missing}", offset, line, column)
+    return None
+
+
+# keyed on the raw text: a \r shifts the reported column, so removing it
+# could hand one input another's message
+@cached("validate", None)
 def validate_latex(latex: str) -> Tuple[bool, str]:
-    """验证 LaTeX 语法"""
-    if not latex.strip():
-        return False, "空公式"
-    
-    # 检查括号匹配
-    paren_count = 0
-    bracket_count = 0
-    brace_count = 0
-    
-    for char in latex:
-        if char == '(':
-            paren_count += 1
-        elif char == ')':
-            paren_count -= 1
-        elif char == '[':
-            bracket_count += 1
-        elif char == ']':
-            bracket_count -= 1
-        elif char == '{':
-            brace_count += 1
-        elif char == '}':
-            brace_count -= 1
-    
-    if paren_count != 0:
-        return False, f"括号不匹配：缺少 {abs(paren_count)} 个 {'(' if paren_count > 0 else ')'}"
-    if bracket_count != 0:
-        return False, f"方括号不匹配：缺少 {abs(bracket_count)} 个 {'[' if bracket_count > 0 else ']'}"
-    if brace_count != 0:
-        return False, f"花括号不匹配：缺少 {abs(brace_count)} 个 {'{' if brace_count > 0 else '}'}"
-    
+    """验证 LaTeX 语法，出错时消息中包含出错位置（详见 check_latex）"""
+    diagnostic = check_latex(latex)
+    if diagnostic is not None:
+        return False, str(diagnostic)
     return True, "语法正确"
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+公式转换本地服务
+常驻进程通过 HTTP/JSON（或 Unix 套接字上的 HTTP）提供转换接口，
+编辑器和构建工具每次调用只需一次请求往返，无需重新启动 Python
+
+    POST /latex_to_unicodemath   {"input": "\\frac{a}{b}"}           -> {"result": "(a)/(b)"}
+    POST /validate_latex         {"inputs": ["x^2", "\\frac{a"]}      -> {"results": [{"result": {"valid": true, ...}},
+                                                                       {"result": {"valid": false, "line": 1, "column": 6, ...}}]}
+    POST /extract_all_formulas   {"input": "文本 $x$"}                -> {"result": [{"content": "x", ...}]}
+    GET  /health                                                       -> 进程数与缓存统计
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from conversion_cache import ConversionCache
+from latex_to_unicodemath import latex_to_unicodemath
+from markdown_to_latex import check_latex, extract_all_formulas
+
+
+def _validation_result(latex: str) -> Dict[str, Any]:
+    diagnostic = check_latex(latex)
+    if diagnostic is None:
+        return {"valid": True, "message": "语法正确"}
+    result = {"valid": False, "message": str(diagnostic)}
+    if diagnostic.offset >= 0:
+        result.update(offset=diagnostic.offset, line=diagnostic.line, column=diagnostic.column)
+    return result
+
+
+def _extraction_result(markdown_text: str) -> List[Dict[str, Any]]:
+    return extract_all_formulas(markdown_text).to_dicts()
+
+
+# Operations exposed by the server, keyed by URL path (without the slash)
+OPERATIONS: Dict[str, Callable[[str], Any]] = {
+    "latex_to_unicodemath": latex_to_unicodemath,
+    "extract_all_formulas": _extraction_result,
+    "validate_latex": _validation_result,
+}
+
+# (succeeded, JSON fragment): workers serialise results themselves, so cached
+# entries have an exact size and a cache hit is written out without re-encoding
+_Outcome = Tuple[bool, str]
+
+_MAX_BODY_BYTES = 64 << 20
+_MISSING = object()
+
+
+def _run_chunk(operation: str, items: List[str]) -> List[_Outcome]:
+    func = OPERATIONS[operation]
+    outcomes = []
+    for text in items:
+        try:
+            outcomes.append((True, json.dumps({"result": func(text)}, ensure_ascii=False)))
+        except Exception as e:
+            outcomes.append((False, json.dumps({"error": str(e)}, ensure_ascii=False)))
+    return outcomes
+
+
+def _warm_up(_: int) -> int:
+    # the first call in each worker pays for regex compilation and table setup
+    latex_to_unicodemath("\\frac{a}{b}")
+    return os.getpid()
+
+
+class ConversionService:
+    """转换服务的核心：常驻进程池和所有请求共享的结果缓存
+
+    缓存位于服务进程中，请求先查缓存，只转换未命中且去重后的输入。
+    未命中的输入合计不足 inline_chars 个字符时直接在请求线程内转换
+    （进程间往返比转换本身还慢），否则按 chunksize 分块交给进程池；
+    workers 为 0 时总是在请求线程内转换。
+    """
+
+    def __init__(self, workers: Optional[int] = None, cache_entries: int = 65536,
+                 cache_bytes: Optional[int] = 256 << 20, chunksize: int = 64,
+                 inline_chars: int = 1 << 14) -> None:
+        if chunksize <= 0:
+            raise ValueError("chunksize 必须为正数")
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.chunksize = chunksize
+        self.inline_chars = inline_chars
+        self.cache = ConversionCache(cache_entries, cache_bytes)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            # start every worker now rather than on the first requests
+            list(self._executor.map(_warm_up, range(self.workers)))
+
+    def run(self, operation: str, items: List[str]) -> List[_Outcome]:
+        """对每条输入执行 operation，结果按输入顺序返回"""
+        if operation not in OPERATIONS:
+            raise KeyError(operation)
+        outcomes: List[Optional[_Outcome]] = [None] * len(items)
+        pending: Dict[str, List[int]] = {}
+        for i, text in enumerate(items):
+            hit = self.cache.get((operation, text), _MISSING)
+            if hit is _MISSING:
+                pending.setdefault(text, []).append(i)
+            else:
+                outcomes[i] = hit
+        texts = list(pending)
+        for text, outcome in zip(texts, self._compute(operation, texts)):
+            # failures are deterministic too, so they are cached like results
+            self.cache.put((operation, text), outcome)
+            for i in pending[text]:
+                outcomes[i] = outcome
+        return outcomes  # type: ignore[return-value]
+
+    def _compute(self, operation: str, texts: List[str]) -> List[_Outcome]:
+        if not texts:
+            return []
+        if self._executor is None or sum(map(len, texts)) < self.inline_chars:
+            return _run_chunk(operation, texts)
+        size = self.chunksize
+        futures = [
+            self._executor.submit(_run_chunk, operation, texts[start:start + size])
+            for start in range(0, len(texts), size)
+        ]
+        outcomes: List[_Outcome] = []
+        for future in futures:
+            outcomes.extend(future.result())
+        return outcomes
+
+    def health(self) -> Dict[str, Any]:
+        return {"status": "ok", "workers": self.workers, "cache": self.cache.stats()._asdict()}
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 长连接处理器；请求体为 {"input": 文本} 或 {"inputs": [文本, ...]}"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "FormulaConverter/1.0"
+    # send headers and body as one segment; with Nagle's algorithm and the
+    # client's delayed ACK, a split response stalls each keep-alive request ~40 ms
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+    service: ConversionService  # set on the subclass created by make_server
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/health":
+            self._send(200, json.dumps(self.service.health(), ensure_ascii=False))
+        else:
+            self._send_error(404, f"未知的路径：{self.path}")
+
+    def do_POST(self) -> None:
+        operation = self.path.strip("/")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # rfile.read(-1) would block until the client closes the connection
+            self.close_connection = True
+            self._send_error(400, "Content-Length 无效")
+            return
+        if length > _MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_error(413, f"请求体超过 {_MAX_BODY_BYTES} 字节")
+            return
+        body = self.rfile.read(length)
+        if operation not in OPERATIONS:
+            self._send_error(404, f"未知的接口：{self.path}，可用：{', '.join(OPERATIONS)}")
+            return
+        try:
+            request = json.loads(body or b"{}")
+            batch = "inputs" in request
+            items = request["inputs"] if batch else [request["input"]]
+            # a bare string would otherwise be iterated as single characters
+            if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+                raise TypeError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._send_error(400, '请求体应为 {"input": "..."} 或 {"inputs": ["...", ...]}')
+            return
+
+        try:
+            outcomes = self.service.run(operation, items)
+        except Exception as e:  # e.g. a worker process died
+            self._send_error(500, f"服务内部错误：{e}")
+            return
+        if batch:
+            self._send(200, '{"results": [' + ", ".join(text for _, text in outcomes) + "]}")
+        else:
+            ok, text = outcomes[0]
+            self._send(200 if ok else 422, text)
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send(status, json.dumps({"error": message}, ensure_ascii=False))
+
+    def _send(self, status: int, text: str) -> None:
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if not self.server.quiet:  # type: ignore[attr-defined]
+            super().log_message(format, *args)
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def make_server(service: ConversionService, host: str = "127.0.0.1", port: int = 8765,
+                unix_socket: Optional[str] = None, quiet: bool = False) -> socketserver.BaseServer:
+    """创建多线程服务器（尚未开始监听请求，调用 serve_forever() 启动）
+
+    给出 unix_socket 时改为监听该路径的 Unix 套接字（仅 POSIX 系统）。
+    """
+    handler = type("Handler", (ConversionRequestHandler,), {"service": service})
+    if unix_socket is not None:
+        if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+            raise OSError("当前系统不支持 Unix 套接字")
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server: socketserver.BaseServer = _ThreadingUnixHTTPServer(unix_socket, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+    server.quiet = quiet  # type: ignore[attr-defined]
+    return server
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="server.py", description="公式转换本地 HTTP/JSON 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认 %(default)s）")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口（默认 %(default)s）")
+    parser.add_argument("--unix", metavar="PATH", help="改为监听 Unix 套接字（仅 POSIX）")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="常驻转换进程数，0 表示在请求线程内转换（默认 CPU 核数）")
+    parser.add_argument("--cache-entries", type=int, default=65536,
+                        help="共享缓存的最大条目数（默认 %(default)s）")
+    parser.add_argument("--cache-mb", type=int, default=256,
+                        help="共享缓存的最大内存（MB，默认 %(default)s）")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不输出访问日志")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if hasattr(sys.stderr, "reconfigure"):
+        sys.stderr.reconfigure(encoding="utf-8")
+    service = ConversionService(args.workers, args.cache_entries, args.cache_mb << 20)
+    server = make_server(service, args.host, args.port, args.unix, args.quiet)
+    where = args.unix or f"http://{args.host}:{server.server_address[1]}"
+    print(f"公式转换服务已启动：{where}（{service.workers} 个转换进程），Ctrl+C 退出", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,8 +4,27 @@
 用于验证各种转换功能是否正常工作
 """
 
-from markdown_to_latex import extract_first_formula_latex, extract_all_formulas, validate_latex
-from latex_to_unicodemath import latex_to_unicodemath
+import asyncio
+import http.client
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from markdown_to_latex import extract_first_formula_latex, extract_all_formulas, validate_latex, check_latex, iter_formulas, map_formulas, normalize_latex_for_word
+from formula_document import FormulaDocument
+from conversion_cache import enable_cache, enable_disk_cache, disable_cache, ConversionCache
+from docx_export import export_docx
+from latex_to_omml import latex_to_omml, ast_to_omml
+from conversion_profile import enable_profiling, disable_profiling, profile_stats
+from converter import convert, convert_many, convert_documents, plan_batch, convert_formula, extract_formula, ConversionCancelled, LatexSyntaxError, MODE_LATEX_TO_UNIMATH, MODE_MD_TO_UNIMATH, MODE_MD_DOC_TO_UNIMATH
+from latex_to_unicodemath import latex_to_unicodemath, SymbolTable
+from latex_macros import MacroRegistry, MacroError, collect_macros
 
 def test_markdown_extraction():
     """测试 Markdown 公式提取"""
@@ -31,6 +50,97 @@ def test_markdown_extraction():
         all_formulas = extract_all_formulas(text)
         print(f"  找到 {len(all_formulas)} 个公式")
 
+def test_streaming_extraction():
+    """测试分块流式提取：结果与分块大小无关"""
+    print("\n=== 测试流式公式提取 ===")
+    
+    doc = ("文本 $E = mc^2$ 与 $$\\frac{1}{2}$$\n"
+           "```math\n\\sum_i x_i\n```\n"
+           "结尾 $$x$$$y$ 和 $a+b$\n") * 20
+    expected = list(iter_formulas(io.StringIO(doc), chunk_size=len(doc)))
+    for chunk_size in (1, 2, 3, 7, 64):
+        got = list(iter_formulas(io.StringIO(doc), chunk_size=chunk_size))
+        status = "✓" if got == expected else "✗"
+        print(f"{status} 分块 {chunk_size:>3} 字符 -> {len(got)} 个公式")
+        assert got == expected
+    
+    first = expected[0]
+    assert doc[first['start']:first['end']] == "$E = mc^2$"
+    assert [f['type'] for f in expected[:5]] == ['inline', 'display', 'fenced', 'display', 'inline']
+
+def test_single_scan_extraction():
+    """测试单遍提取：转义美元符、行内代码和重叠定界符"""
+    print("\n=== 测试单遍公式提取 ===")
+    
+    text = "价格 \\$5 和 \\$6，代码 `$x$` 不算，$$a$$ 与 $b$"
+    formulas = extract_all_formulas(text)
+    contents = [f['content'] for f in formulas]
+    status = "✓" if contents == ['a', 'b'] else "✗"
+    print(f"{status} {text} -> {contents}")
+    assert contents == ['a', 'b']
+    
+    # 紧凑记录：属性和旧的字典写法都可用
+    first = formulas[0]
+    assert first.content == first['content'] == 'a' and first.display_mode == 'display'
+    assert formulas.to_dicts()[1] == dict(formulas[1]) == {
+        'content': 'b', 'type': 'inline', 'display_mode': 'inline',
+        'start': formulas[1].start, 'end': formulas[1].end,
+    }
+    assert formulas[-1] == formulas[1] and len(formulas[0:1]) == 1
+    
+    overlap = extract_all_formulas("$$x$$ ```math\ny\n```")
+    spans = [(f['start'], f['end']) for f in overlap]
+    assert [f['type'] for f in overlap] == ['display', 'fenced']
+    assert all(a[1] <= b[0] for a, b in zip(spans, spans[1:]))
+    print(f"✓ 结果互不重叠 -> {spans}")
+
+def test_mapped_extraction():
+    """测试内存映射提取：字节偏移，只解码公式内容"""
+    print("\n=== 测试内存映射公式提取 ===")
+    
+    doc = "中文 $\\alpha$ 说明\n$$\\frac{1}{2}$$\n```math\nx^2\n```\n" * 50
+    fd, path = tempfile.mkstemp(suffix=".md")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(doc.encode("utf-8"))
+        expected = extract_all_formulas(doc)
+        for window in (7, 1 << 24):
+            got = list(map_formulas(path, window=window))
+            ok = [f['content'] for f in got] == [f['content'] for f in expected]
+            print(f"{'✓' if ok else '✗'} 窗口 {window:>8} 字节 -> {len(got)} 个公式")
+            assert ok
+        data = doc.encode("utf-8")
+        first = got[0]
+        assert data[first['start']:first['end']].decode("utf-8") == "$\\alpha$"
+    finally:
+        os.remove(path)
+
+def test_incremental_document():
+    """测试增量文档：只重新转换被编辑的公式"""
+    print("\n=== 测试增量文档模型 ===")
+    
+    converted = []
+    def convert(latex):
+        converted.append(latex)
+        return latex_to_unicodemath(latex)
+    
+    doc = FormulaDocument("第 1 节 $\\alpha$ 与 $$\\frac{a}{b}$$\n" * 100, convert=convert)
+    assert len(doc) == 200 and len(converted) == 2  # 相同内容只转换一次
+    
+    converted.clear()
+    start = doc.formulas()[100]['start']
+    doc.edit(start + 1, start + 7, "\\beta")  # $\\alpha$ -> $\\beta$
+    print(f"  编辑后重新转换: {converted}")
+    assert converted == ["\\beta"]
+    
+    doc.set_text("前言 " + doc.text)
+    expected = [(f['content'], f['start']) for f in extract_all_formulas(doc.text)]
+    got = [(f['content'], f['start']) for f in doc.formulas()]
+    status = "✓" if got == expected and len(converted) == 1 else "✗"
+    print(f"{status} 插入前缀后偏移整体平移，{len(got)} 个公式")
+    assert got == expected and len(converted) == 1
+    assert doc.formulas()[100]['output'] == "β"
+
 def test_latex_validation():
     """测试 LaTeX 语法验证"""
     print("\n=== 测试 LaTeX 语法验证 ===")
@@ -48,6 +158,20 @@ def test_latex_validation():
         is_valid, msg = validate_latex(latex)
         status = "✓" if is_valid == expected else "✗"
         print(f"{status} {latex[:20]:<20} -> {msg}")
+    
+    # 诊断信息给出出错字符的行列位置
+    diagnostic = check_latex("a + b\n\\frac{x}{y")
+    assert (diagnostic.line, diagnostic.column, diagnostic.offset) == (2, 9, 14)
+    assert diagnostic.message == "花括号不匹配：缺少 1 个 }"
+    diagnostic = check_latex("(a))")
+    assert (diagnostic.line, diagnostic.column) == (1, 4) and diagnostic.message.endswith("缺少 1 个 (")
+    assert check_latex("\\frac{a}{b}") is None
+    try:
+        convert("x^{2", MODE_LATEX_TO_UNIMATH)
+        raise AssertionError("应抛出 LatexSyntaxError")
+    except LatexSyntaxError as e:
+        assert e.diagnostic.column == 3
+        print(f"✓ {e}")
 
 def test_unicodemath_conversion():
     """测试 UnicodeMath 转换"""
@@ -69,6 +193,539 @@ def test_unicodemath_conversion():
         except Exception as e:
             print(f"✗ {latex:<30} -> 错误: {e}")
 
+def test_engine_equivalence():
+    """测试单遍引擎与参考实现输出一致"""
+    print("\n=== 测试单遍引擎与参考实现一致性 ===")
+    
+    test_cases = [
+        "\\frac{-b \\pm \\sqrt{b^2-4ac}}{2a}",
+        "\\lim_{n \\to \\infty} \\sum_{i=1}^{n} \\frac{1}{i^2} = \\frac{\\pi^2}{6}",
+        "\\int_{-\\infty}^{\\infty} e^{-x^2} dx = \\sqrt{\\pi}",
+        "\\sqrt[3]{x+1} + \\binom{n}{k}",
+        "\\mathbb{R}^n \\times \\bar{x} + \\vec{v}",
+        "\\text{if } x > 0, \\operatorname{tr}(A)",
+        "\\left( a_{ij} + b_{k} \\right) \\cdot \\sin\\theta",
+        "\\prod_{k} a_k^{2}",
+    ]
+    
+    mismatches = 0
+    for latex in test_cases:
+        fast = latex_to_unicodemath(latex)
+        reference = latex_to_unicodemath(latex, engine="reference")
+        status = "✓" if fast == reference else "✗"
+        if fast != reference:
+            mismatches += 1
+        print(f"{status} {latex[:30]:<30} -> {fast}")
+    assert mismatches == 0
+
+def test_nested_structures():
+    """测试嵌套分组（连分数、嵌套根式等）"""
+    print("\n=== 测试嵌套结构转换 ===")
+    
+    test_cases = [
+        ("\\frac{1}{1+\\frac{1}{1+\\frac{1}{x}}}", "(1)/(1+(1)/(1+(1)/(x)))"),
+        ("\\frac{a^{2}}{b}", "(a^2)/(b)"),
+        ("\\sqrt[n+1]{\\frac{a}{b}}", "√[n+1]((a)/(b))"),
+        ("\\hat{\\theta}", "θ\u0302"),
+    ]
+    
+    for latex, expected in test_cases:
+        um = latex_to_unicodemath(latex)
+        status = "✓" if um == expected else "✗"
+        print(f"{status} {latex[:30]:<30} -> {um}")
+        assert um == expected
+    
+    # 矩阵、cases 和 aligned 环境按 & 和 \\ 切分行列
+    environments = [
+        ("\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}", "(■(a&b@c&d))"),
+        ("\\begin{bmatrix}1&0\\\\0&1\\\\\\end{bmatrix}", "[■(1&0@0&1)]"),
+        ("|x| = \\begin{cases} x & x \\geq 0 \\\\ -x & \\text{otherwise} \\end{cases}",
+         "|x| = {█(x&x ≥ 0@-x&otherwise)┤"),
+        ("\\begin{aligned} a &= b \\\\ &= \\frac{c}{d} \\end{aligned}", "█(a&= b@&= (c)/(d))"),
+        ("\\begin{array}{c|c} 1 & 2 \\end{array}", "■(1&2)"),
+        ("\\begin{vmatrix} \\begin{matrix}a\\\\b\\end{matrix} & x_{ij} \\end{vmatrix}", "|■(■(a@b)&x_(ij))|"),
+        ("\\begin{unknown} a & b \\end{unknown}", "\\begin{unknown} a & b \\end{unknown}"),
+        ("\\begin{pmatrix}\\frac12&x^2\\\\[2pt]3&\\sqrt y\\end{pmatrix}", "(■((1)/(2)&x^2@3&√(y)))"),
+        ("\\begin{array}{cc}\\hline a&b\\\\ \\hline c&d\\\\ \\hline\\end{array}", "■(a&b@c&d)"),
+        ("\\begin{aligned}x&= 1 \\nonumber\\\\ [1ex] y&=2\\end{aligned}", "█(x&= 1@y&=2)"),
+    ]
+    for latex, expected in environments:
+        um = latex_to_unicodemath(latex)
+        assert um == expected, (latex, um)
+    n = 300
+    big = "\\begin{matrix}" + "\\\\".join("&".join("x" for _ in range(n)) for _ in range(n)) + "\\end{matrix}"
+    assert latex_to_unicodemath(big).count("&") == n * (n - 1)
+    print(f"✓ 矩阵与方程组环境正常（{n}×{n} 矩阵）")
+
+    # 深层嵌套不应触发递归上限
+    depth = 5000
+    deep = "\\frac{1}{1+" * depth + "x" + "}" * depth
+    um = latex_to_unicodemath(deep)
+    print(f"✓ 嵌套深度 {depth} -> 输出长度 {len(um)}")
+
+def test_symbol_table():
+    """测试符号表整词匹配与扩充"""
+    print("\n=== 测试符号表 ===")
+    
+    test_cases = [
+        ("a \\to b \\top", "a → b \\top"),
+        ("\\cdots \\cdot", "⋯ ⋅"),
+        ("\\sinh x + \\sin x", "sinh x + sin x"),
+        ("a\\cdot\\sin x", "a⋅sin x"),
+        ("\\alpha\\cos\\theta", "αcosθ"),
+        ("2\\pi\\ln 2", "2πln 2"),
+    ]
+    
+    for latex, expected in test_cases:
+        for engine in ("fast", "reference"):
+            um = latex_to_unicodemath(latex, engine=engine)
+            status = "✓" if um == expected else "✗"
+            print(f"{status} [{engine}] {latex:<20} -> {um}")
+            assert um == expected
+    
+    table = SymbolTable({"\\alpha": "α"})
+    table.update({f"\\sym{chr(97 + i // 26)}{chr(97 + i % 26)}": "*" for i in range(500)})
+    table.update({"\\ell": "ℓ"})
+    result = table.sub("\\alpha + \\ell + \\elll")
+    print(f"✓ 扩充后 {len(table)} 个条目 -> {result}")
+    assert result == "α + ℓ + \\elll"
+
+def test_macro_expansion():
+    """测试 \\newcommand 等宏定义的收集与展开"""
+    print("\n=== 测试宏展开 ===")
+    preamble = ("\\newcommand{\\R}{\\mathbb{R}}\\newcommand{\\norm}[1]{\\left\\|#1\\right\\|}"
+                "\\newcommand\\nsq[1]{\\norm{#1}^2}\\newcommand{\\vx}[2][x]{#1_{#2}}"
+                "\\DeclareMathOperator{\\Tr}{Tr}\\def\\pair#1#2{(#1,#2)}")
+    macros = collect_macros(preamble)
+    assert len(macros) == 6
+    cases = [
+        ("x \\in \\R", "x \\in \\mathbb{R}"),
+        ("\\nsq{a+b}", "\\left\\|a+b\\right\\|^2"),
+        ("\\vx{i}+\\vx[y]{j}", "x_{i}+y_{j}"),
+        ("\\Tr A", "\\operatorname{Tr} A"),
+        ("\\pair ab", "(a,b)"),
+        ("\\alpha + 1", "\\alpha + 1"),
+    ]
+    for latex, expected in cases:
+        assert macros.expand(latex) == expected, (latex, macros.expand(latex))
+    assert macros.expand(preamble) == ""
+    # a control word spliced before letters keeps its boundary
+    assert MacroRegistry({"\\g": "b"}).expand("\\alpha\\g") == "\\alpha b"
+
+    cyclic = MacroRegistry({"\\a": "\\b", "\\b": "\\a x"})
+    try:
+        cyclic.expand("\\a")
+        raised = False
+    except MacroError:
+        raised = True
+    assert raised
+
+    document = f"$${preamble}$$\n范数 $\\nsq{{v}}$，迹 $\\Tr A$，集合 $\\R$\n"
+    assert convert(document, MODE_MD_DOC_TO_UNIMATH) == "\n范数 \\|v\\|^2，迹 Tr A，集合 ℝ\n"
+    assert convert("$\\R^n$", MODE_MD_TO_UNIMATH, macros=macros) == "ℝ^n"
+    # the definitions formula comes first by priority but converts to nothing
+    in_document = "$$\\newcommand{\\R}{\\mathbb{R}}$$\n集合 $\\R^n$\n"
+    assert extract_formula(in_document, MODE_MD_TO_UNIMATH) == ("\\mathbb{R}^n", "inline")
+    assert convert(in_document, MODE_MD_TO_UNIMATH) == "ℝ^n"
+    print("✓ 宏定义收集、参数代入与循环检测正常")
+
+
+def test_conversion_cache():
+    """测试转换缓存的命中统计与淘汰"""
+    print("\n=== 测试转换缓存 ===")
+    
+    cache = enable_cache(max_entries=2)
+    try:
+        formula = "\\frac{\\partial L}{\\partial \\theta}"
+        results = {latex_to_unicodemath(formula) for _ in range(10)}
+        validate_latex(formula)
+        latex_to_unicodemath("x^2")
+        stats = cache.stats()
+        print(f"  结果: {results}")
+        print(f"  命中 {stats.hits} / 未命中 {stats.misses} / 淘汰 {stats.evictions}，命中率 {stats.hit_rate:.0%}")
+        assert results == {"(∂ L)/(∂ θ)"}
+        assert (stats.hits, stats.misses, stats.evictions, stats.entries) == (9, 3, 1, 2)
+        cache.reset_stats()
+        normalized = {normalize_latex_for_word(" \\dfrac{a}{b}\r\n") for _ in range(3)}
+        assert normalized == {"\\frac{a}{b}"} and cache.stats()[:2] == (2, 1)
+        print("✓ normalize_latex_for_word 重复调用命中缓存")
+        # \r shifts the column, so it must not share a cache entry with the plain text
+        assert validate_latex("\\frac{a")[1].endswith("第 6 列）")
+        assert validate_latex("\r\r\\frac{a")[1].endswith("第 8 列）")
+    finally:
+        disable_cache()
+    
+    small = ConversionCache(max_entries=100, max_bytes=400)
+    for i in range(20):
+        small.put(("unicodemath", f"x_{i}"), f"x_{i}")
+    stats = small.stats()
+    print(f"  字节预算 400：保留 {stats.entries} 条，{stats.size_bytes} 字节，淘汰 {stats.evictions} 条")
+    assert stats.size_bytes <= 400 and stats.evictions > 0
+
+def test_disk_cache():
+    """测试持久缓存：跨实例、跨进程复用，转换表改动后失效，按大小淘汰"""
+    print("\n=== 测试持久缓存 ===")
+    from disk_cache import DiskCache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+        formulas = [f"\\frac{{x_{i}}}{{2}}" for i in range(50)]
+        cache = enable_disk_cache(path)
+        try:
+            expected = [latex_to_unicodemath(f) for f in formulas]
+            cache.close()
+            cache = enable_disk_cache(path)  # a later run
+            assert [latex_to_unicodemath(f) for f in formulas] == expected
+            stats = cache.stats()
+            print(f"  重新打开后命中 {stats.hits} / 未命中 {stats.misses}，{stats.entries} 条")
+            assert (stats.hits, stats.misses, stats.entries) == (50, 0, 50)
+            cache.clear()
+            results = convert_many(formulas, workers=2, chunksize=10)
+            assert [r.output for r in results] == expected and len(cache) == 50
+            print("✓ 进程池子进程写入同一个缓存文件")
+            cache.close()
+        finally:
+            disable_cache()
+        # a separate run (new interpreter, new hash seed) must find the entries
+        code = ("import sys; from conversion_cache import enable_disk_cache; "
+                "from latex_to_unicodemath import latex_to_unicodemath; "
+                "c = enable_disk_cache(sys.argv[1]); latex_to_unicodemath(r'\\frac{x_0}{2}'); "
+                "print(len(c), c.stats().hits)")
+        result = subprocess.run([sys.executable, "-c", code, path], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        assert result.stdout.split() == ["50", "1"], result.stdout
+        print("✓ 另一个进程重新打开缓存后命中已有结果")
+        assert len(DiskCache(path, fingerprint="changed tables")) == 0
+        print("✓ 转换表指纹改变后旧结果失效")
+
+        small = DiskCache(os.path.join(tmp, "small.db"), max_bytes=4000, memory_entries=1)
+        for i in range(200):
+            small.put(("unicodemath", f"x_{i}"), f"x_{i}")
+        stats = small.stats()
+        print(f"✓ 大小上限 4000：保留 {stats.entries} 条，{stats.size_bytes} 字节，淘汰 {stats.evictions} 条")
+        assert stats.size_bytes <= 4000 and stats.evictions > 0
+        small.close()
+
+def test_stage_profiling():
+    """测试分阶段性能统计"""
+    print("\n=== 测试分阶段性能统计 ===")
+    latex = "\\frac{x}{\\sqrt{y}} + \\alpha"
+    expected = {engine: latex_to_unicodemath(latex, engine=engine) for engine in ("fast", "reference")}
+    assert profile_stats() is None
+
+    events = []
+    enable_profiling(callback=events.append)
+    try:
+        for engine in ("fast", "reference"):
+            assert latex_to_unicodemath(latex, engine=engine) == expected[engine]
+        stats = profile_stats()
+    finally:
+        disable_profiling()
+
+    assert list(stats)[:3] == ["fast:tokenize", "fast:parse_emit", "fast:normalize_whitespace"]
+    assert len(stats) == 13 and len(events) == 13
+    fixpoint = stats["reference:apply_sqrt_frac_binom_iteratively"]
+    # \sqrt and then \frac are rewritten in the first pass, the second finds nothing left
+    assert fixpoint.calls == 1 and fixpoint.iterations == 2
+    assert stats["reference:strip_formatting_tokens"].bytes_in == len(latex)
+    assert stats["reference:normalize_whitespace"].bytes_out == len(expected["reference"].encode("utf-8"))
+    assert profile_stats() is None
+
+    # parse_emit consumes its token list; its input is still what tokenize produced
+    enable_profiling()
+    try:
+        latex_to_unicodemath("x^2 + a_b + \\frac ab + \\sqrt[3]x")
+        sizes = profile_stats()
+    finally:
+        disable_profiling()
+    assert sizes["fast:parse_emit"].bytes_in == sizes["fast:tokenize"].bytes_out == 32
+    print(f"✓ 记录 {len(stats)} 个阶段，不动点迭代 {fixpoint.iterations} 次")
+
+
+def test_batch_conversion():
+    """测试批量转换：顺序、错误捕获与进程池"""
+    print("\n=== 测试批量转换 ===")
+    
+    inputs = ["\\frac{a}{b}", "\\frac{a}{b", "\\alpha^2"] * 50
+    serial = convert_many(inputs, workers=1, chunksize=16)
+    parallel = convert_many(inputs, workers=2, chunksize=16)
+    print(f"  {len(inputs)} 条输入，失败 {sum(not r.ok for r in serial)} 条")
+    print(f"  第 1 条: {serial[0].output}；第 2 条错误: {serial[1].error}")
+    assert serial == parallel
+    assert [r.index for r in serial] == list(range(len(inputs)))
+    assert serial[0].output == "(a)/(b)" and not serial[1].ok
+    
+    md = convert_many(["文本 $E = mc^2$", "没有公式"], mode=MODE_MD_TO_UNIMATH, workers=1)
+    print(f"  Markdown: {md[0].output} / {md[1].error}")
+    assert md[0].output == "E = mc^2" and not md[1].ok
+    
+    # with -l, errors point at the line in the file even after blank lines
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "formulas.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("x^2\n\n\n\\frac{a\n\ny\n")
+        result = subprocess.run([sys.executable, "cli.py", "-l", path], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 1 and result.stderr.startswith(f"{path}:4: "), result.stderr
+    print(f"  命令行错误位置: {result.stderr.strip()}")
+    
+    # a file that is not UTF-8 is reported and skipped; the rest of the batch is written
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "in")
+        os.makedirs(source)
+        with open(os.path.join(source, "good.md"), "w", encoding="utf-8") as f:
+            f.write("$\\alpha$")
+        with open(os.path.join(source, "bad.md"), "wb") as f:
+            f.write("$\\beta$".encode("gbk") + b"\xff\xfe")
+        out = os.path.join(tmp, "out")
+        result = subprocess.run([sys.executable, "cli.py", "-m", "md2unimath", source, "-o", out],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert result.returncode == 1 and "bad.md: 读取失败" in result.stderr, result.stderr
+        assert "Traceback" not in result.stderr
+        with open(os.path.join(out, "good.md.txt"), encoding="utf-8") as f:
+            assert f.read() == "α\n"
+
+def test_progress_and_cancel():
+    """测试转换进度回调与取消"""
+    print("\n=== 测试进度回调与取消 ===")
+    
+    stages = []
+    result = convert("文本 $\\alpha^2$", MODE_MD_TO_UNIMATH, progress=lambda p, s: stages.append((p, s)))
+    print(f"  阶段: {stages} -> {result}")
+    assert result == "α^2"
+    assert [p for p, _ in stages] == sorted(p for p, _ in stages) and stages[-1][0] == 100
+    
+    def cancel(percent, stage):
+        if percent >= 50:
+            raise ConversionCancelled()
+    try:
+        convert("\\frac{a}{b}", progress=cancel)
+    except ConversionCancelled:
+        print("✓ 转换在阶段边界被取消")
+    else:
+        raise AssertionError("转换没有被取消")
+
+def test_extract_then_convert():
+    """测试分步转换：周围文字变化时提取出的公式不变，可跳过重复转换"""
+    print("\n=== 测试分步转换 ===")
+    
+    first = extract_formula("说明 $\\frac{a}{b}$ 结尾", MODE_MD_TO_UNIMATH)
+    second = extract_formula("改过的说明 $\\frac{a}{b}$ 新结尾", MODE_MD_TO_UNIMATH)
+    result = convert_formula(*first, MODE_MD_TO_UNIMATH)
+    status = "✓" if first == second and result == "(a)/(b)" else "✗"
+    print(f"{status} {first} -> {result}")
+    assert first == second
+    assert result == convert("说明 $\\frac{a}{b}$ 结尾", MODE_MD_TO_UNIMATH)
+
+def test_document_rewrite():
+    """测试整篇文档改写：所有公式原地替换，其余文字不变"""
+    print("\n=== 测试整篇文档改写 ===")
+    
+    doc = "  标题\n行内 $\\alpha^2$，价格 \\$5，代码 `$x$`。\n\n$$\\frac{a}{b}$$\n```math\n\\sum_{i} x_i\n```\n结尾"
+    result = convert(doc, MODE_MD_DOC_TO_UNIMATH)
+    expected = "  标题\n行内 α^2，价格 \\$5，代码 `$x$`。\n\n(a)/(b)\n∑_(i) x_i\n结尾"
+    status = "✓" if result == expected else "✗"
+    print(f"{status} {result!r}")
+    assert result == expected
+    assert convert("没有公式", MODE_MD_DOC_TO_UNIMATH) == "没有公式"
+
+
+def test_dedup_planner():
+    """测试去重批处理：不同的公式只转换一次，结果按偏移写回每一处"""
+    print("\n=== 测试去重批处理 ===")
+    
+    plan = plan_batch(["x", "n", "x", "\\alpha", "x", "n"])
+    assert plan.unique == ["x", "n", "\\alpha"] and plan.slots == [0, 1, 0, 2, 0, 1]
+    assert plan.scatter(["X", "N", "A"]) == ["X", "N", "X", "A", "X", "N"]
+    assert plan.dedup_ratio == 0.5 and plan_batch([]).dedup_ratio == 0.0
+    
+    docs = ["$x$ 与 $\\alpha$，又见 $x$", "$$\\newcommand{\\R}{\\mathbb{R}}$$ $x \\in \\R$ 和 $x$",
+            "无公式", "分式 $\\frac{a}{b}$ $x$"]
+    results, plan = convert_documents(docs, workers=1)
+    expected = convert_many(docs, MODE_MD_DOC_TO_UNIMATH, workers=1)
+    assert [r.output for r in results] == [r.output for r in expected]
+    assert results[0].output == "x 与 α，又见 x" and results[2].output == "无公式"
+    print(f"✓ 公式 {plan.occurrences} 个，不同的 {len(plan.unique)} 个，重复 {plan.dedup_ratio:.0%}")
+    assert plan.occurrences == 8 and len(plan.unique) == 5
+
+
+def test_benchmark_suite():
+    """测试基准测试套件的结果格式与退化判断"""
+    print("\n=== 测试基准测试套件 ===")
+    from benchmark import compare_results, percentile, run_suite
+
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 99) == 4.0
+    result = run_suite(repeat=1, only=["normalize_latex_for_word/many"], log=None)
+    assert list(result["results"]) == ["normalize_latex_for_word/many_small"]
+    stats = result["results"]["normalize_latex_for_word/many_small"]
+    assert stats["calls"] > 0 and stats["p50_us"] <= stats["p99_us"] <= stats["max_us"]
+
+    slower = {"results": {key: dict(v, mean_us=v["mean_us"] * 1.5) for key, v in result["results"].items()}}
+    (key, _, _, change), = compare_results(result, slower)
+    assert change > 0.10
+    print(f"✓ {key}: 人为放慢 50% 后检测到退化 {change:+.0%}")
+
+
+def test_async_api():
+    """测试 asyncio 转换接口"""
+    print("\n=== 测试 asyncio 转换接口 ===")
+    from async_converter import AsyncConverter
+
+    document = "".join(f"第 {i} 行 $x_{{{i}}}$\n" for i in range(1000))
+
+    async def run():
+        async with AsyncConverter(max_concurrency=2, queue_size=4) as converter:
+            outputs = await asyncio.gather(*(converter.latex_to_unicodemath(f"a^{{{i}}}") for i in range(20)))
+            assert outputs == [f"a^{i}" for i in range(20)]
+            assert await converter.validate_latex("\\frac{a") == (False, "花括号不匹配：缺少 1 个 }（第 1 行第 6 列）")
+            assert len(await converter.extract_all_formulas(document)) == 1000
+
+            streamed = [f async for f in converter.iter_formulas(document, convert=True)]
+            assert [f['output'] for f in streamed[:2]] == ["x_0", "x_1"] and len(streamed) == 1000
+            async for formula in converter.iter_formulas(document):
+                break  # leaving early stops the extraction thread
+
+            task = asyncio.create_task(converter.convert(document * 20, MODE_MD_DOC_TO_UNIMATH))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            try:
+                await task
+                cancelled = False
+            except asyncio.CancelledError:
+                cancelled = True
+            assert cancelled
+            # the freed slots still serve new requests
+            assert await converter.latex_to_unicodemath("\\alpha") == "α"
+
+    asyncio.run(run())
+    print("✓ 并发转换、流式提取和取消均正常")
+
+    async def consume(converter):
+        # awaiting another conversion inside the loop must not wait on the stream itself
+        return [await converter.latex_to_unicodemath(f.content)
+                async for f in converter.iter_formulas(document)]
+
+    async def nested():
+        async with AsyncConverter(max_concurrency=1, queue_size=2) as converter:
+            outputs = await asyncio.wait_for(consume(converter), 10)
+            assert outputs[:2] == ["x_0", "x_1"] and len(outputs) == 1000
+        async with AsyncConverter(max_concurrency=2, queue_size=2) as converter:
+            both = await asyncio.wait_for(asyncio.gather(consume(converter), consume(converter)), 10)
+            assert [len(outputs) for outputs in both] == [1000, 1000]
+
+    asyncio.run(nested())
+    print("✓ 循环体中 await 其他转换不会死锁")
+
+
+def test_conversion_server():
+    """测试本地 HTTP/JSON 转换服务"""
+    print("\n=== 测试本地转换服务 ===")
+    from server import ConversionService, make_server
+
+    # inline_chars=0 sends every cache miss through the worker process
+    service = ConversionService(workers=1, inline_chars=0)
+    server = make_server(service, port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def post(path, body):
+        request = urllib.request.Request(base + path, json.dumps(body).encode("utf-8"))
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    try:
+        assert post("/latex_to_unicodemath", {"input": "\\frac{a}{b}"}) == (200, {"result": "(a)/(b)"})
+        status, body = post("/validate_latex", {"inputs": ["x^2", "\\frac{a", "x^2"]})
+        assert status == 200 and [r["result"]["valid"] for r in body["results"]] == [True, False, True]
+        status, body = post("/extract_all_formulas", {"input": "文本 $x$ 和 $$y$$"})
+        assert [f["content"] for f in body["result"]] == ["x", "y"]
+        assert post("/latex_to_unicodemath", {"inputs": ["\\frac{a}{b}"]})[1] == {"results": [{"result": "(a)/(b)"}]}
+        assert post("/latex_to_unicodemath", {"input": 1})[0] == 400
+        assert post("/latex_to_unicodemath", {"inputs": "x^2"})[0] == 400
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        connection.putrequest("POST", "/latex_to_unicodemath")
+        connection.putheader("Content-Length", "-1")
+        connection.endheaders()
+        assert connection.getresponse().status == 400
+        connection.close()
+        assert post("/unknown", {"input": "x"})[0] == 404
+        with urllib.request.urlopen(base + "/health") as response:
+            health = json.loads(response.read())
+        # x^2 is converted once within its batch; the second \frac{a}{b} comes from the cache
+        assert health["workers"] == 1 and health["cache"]["hits"] == 1
+        print(f"✓ 服务正常，缓存命中 {health['cache']['hits']} 次")
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def test_lazy_startup():
+    """测试导入时不编译少用的正则、不加载多进程模块"""
+    print("\n=== 测试延迟导入 ===")
+    code = ("import sys, cli, latex_to_unicodemath as l2u; "
+            "print(l2u._DEFOP_RE.is_compiled, 'concurrent.futures.process' in sys.modules, "
+            "'PySide6' in sys.modules); "
+            "l2u.latex_to_unicodemath(r'\\operatorname{sgn}(x)', engine='reference'); "
+            "print(l2u._DEFOP_RE.is_compiled)")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    assert result.stdout.split() == ["False", "False", "False", "True"], result.stdout
+    print("✓ 正则在首次使用时编译，cli 不加载 multiprocessing 和 Qt")
+
+
+def test_docx_export():
+    """测试导出 .docx：公式为原生 OMML，文档 XML 合法、公式个数正确"""
+    print("\n=== 测试 Word 导出 ===")
+    from xml.dom import minidom
+    import zipfile
+    from latex_parser import parse
+
+    for latex in ["\\frac{a}{b}", "\\sum_{i=1}^{n} x_i^2", "\\sqrt[3]{x+1}",
+                  "\\begin{pmatrix}1&2\\\\3&4\\end{pmatrix}"]:
+        omml = latex_to_omml(latex)
+        minidom.parseString(omml.replace("<m:oMath>", '<m:oMath xmlns:m="m">', 1))
+        assert ast_to_omml(parse(latex)) == omml
+        print(f"✓ {latex} -> {len(omml)} 字节 OMML")
+
+    doc = "段落 $a<b$ 与 A&B\n\n$$\\newcommand{\\R}{\\mathbb{R}}$$\n\n$$\\frac{1}{x}\\in\\R$$\n" * 200
+    buf = io.BytesIO()
+    count = export_docx(doc, buf, chunk_size=97)
+    xml = zipfile.ZipFile(buf).read("word/document.xml").decode("utf-8")
+    dom = minidom.parseString(xml)
+    assert count == 400
+    assert len(dom.getElementsByTagName("m:oMath")) == 400
+    assert len(dom.getElementsByTagName("m:oMathPara")) == 200
+    assert len(dom.getElementsByTagName("m:f")) == 200 and "ℝ" in xml and "A&amp;B" in xml
+    print(f"✓ 导出 {count} 个公式，document.xml {len(xml)} 字符")
+
+    # form feeds and other control characters are not allowed in XML 1.0
+    buf = io.BytesIO()
+    export_docx("第一页\x0c第二页 $x\x0c+\x01y$\n", buf)
+    xml = zipfile.ZipFile(buf).read("word/document.xml").decode("utf-8")
+    minidom.parseString(xml)
+    assert "第一页第二页" in xml and "\x0c" not in xml and "\x01" not in xml
+    print("✓ 控制字符从 document.xml 中去除")
+
+    import contextlib
+    import docx_export
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "cyclic.md")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write("$$\\newcommand{\\a}{\\b}\\newcommand{\\b}{\\a}$$ $\\a$\n")
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            status = docx_export.main([source, "-o", os.path.join(tmp, "cyclic.docx")])
+    assert status == 1 and stderr.getvalue().startswith("导出失败："), stderr.getvalue()
+    print(f"✓ 宏循环定义时报错退出：{stderr.getvalue().strip()}")
+
+
 def test_integration():
     """测试完整转换流程"""
     print("\n=== 测试完整转换流程 ===")
@@ -112,8 +769,29 @@ if __name__ == "__main__":
     
     try:
         test_markdown_extraction()
+        test_streaming_extraction()
+        test_single_scan_extraction()
+        test_mapped_extraction()
+        test_incremental_document()
         test_latex_validation()
         test_unicodemath_conversion()
+        test_engine_equivalence()
+        test_nested_structures()
+        test_symbol_table()
+        test_macro_expansion()
+        test_conversion_cache()
+        test_disk_cache()
+        test_stage_profiling()
+        test_batch_conversion()
+        test_progress_and_cancel()
+        test_extract_then_convert()
+        test_document_rewrite()
+        test_dedup_planner()
+        test_benchmark_suite()
+        test_async_api()
+        test_conversion_server()
+        test_lazy_startup()
+        test_docx_export()
         test_integration()
         
         print("\n" + "=" * 50)